@@ -5,10 +5,18 @@ set -e
 
 echo "Starting service in $NC_CONFIGURATION mode"
 
+# When NC_SUPERVISE is set, a supervisor runs and scales a number of
+# worker processes, instead of a single one
+if [[ -n "$NC_SUPERVISE" ]]; then
+    server="supervise.py"
+else
+    server="server.py"
+fi
+
 if [[ "$NC_CONFIGURATION" == @("development"|"test") ]]; then
     python -m unittest discover /test *_test.py
-    exec python server.py
+    exec python $server
 else
     # Acceptance, production
-    exec python server.py
+    exec python $server
 fi
@@ -1,13 +1,79 @@
-import ast
 import json
+import logging
 import os.path
-import sys
-import traceback
+import time
 from flask import Config
 import pika
 import requests
 from .configuration import configuration
 from .data_tools import *
+from .log import MessageLogger, configure_logging, correlation_id, summarise
+from .profiling import MessageProfiler
+from .threaded_consumer import ThreadedConsumer
+from .scatter_gather import gather, gathering, process_tile, \
+    read_manifest, scatter, tile_queue_name
+
+
+logger = logging.getLogger(__name__)
+
+
+def heavy_queue_name(
+        queue_name):
+    """
+    Return the name of the queue for large jobs corresponding with
+    *queue_name*
+    """
+    return "{}_heavy".format(queue_name)
+
+
+def is_heavy_queue_name(
+        queue_name):
+
+    return queue_name.endswith("_heavy")
+
+
+def light_queue_name(
+        queue_name):
+    """
+    Return the name of the queue for regular jobs corresponding with
+    *queue_name*
+    """
+    return queue_name[:-len("_heavy")] if is_heavy_queue_name(queue_name) \
+        else queue_name
+
+
+def retry_queue_name(
+        queue_name,
+        delay):
+    """
+    Return the name of the queue in which failed messages received from
+    *queue_name* wait *delay* seconds before being retried
+
+    Each delay has its own queue, so messages expire in the order in which
+    they are queued. RabbitMQ only expires messages at the head of a
+    queue.
+    """
+    return "{}.retry-{}ms".format(queue_name, int(delay * 1000))
+
+
+def dead_letter_queue_name(
+        queue_name):
+    """
+    Return the name of the queue in which messages received from
+    *queue_name* end up after all retries have failed
+    """
+    return "{}.dead".format(queue_name)
+
+
+# Names of the queues of the operations handled, in addition to the tile
+# queue
+operation_queue_names = [
+    "register_raster",
+    "georeference_raster",
+    "retrieve_colors_of_raster",
+    "classify_raster",
+    "compute_raster_statistics",
+]
 
 
 class DataTools(object):
@@ -16,21 +82,132 @@ class DataTools(object):
         self.config = Config(__name__)
 
 
+    def message_logger(self,
+            method_frame,
+            header_frame):
+        """
+        Return a logger which adds the correlation id of the message
+        received, and the queue it was received from, to each record
+        """
+        return MessageLogger(logger, {
+            "correlation_id": correlation_id(header_frame),
+            "queue": method_frame.routing_key
+        })
+
+
+    def message_timestamp(self,
+            header_frame):
+        """
+        Return the timestamp of the message whose properties are passed in
+
+        Messages without a timestamp are assigned the current time. It is
+        stored in the message properties, so it is passed on when the
+        message is republished.
+        """
+        if header_frame.timestamp is None:
+            header_frame.timestamp = int(time.time())
+
+        return header_frame.timestamp
+
+
+    def is_heavy_job(self,
+            method_frame,
+            pathname):
+        """
+        Return whether the job for a message received should be handled by
+        a worker consuming the heavy queues
+
+        This depends on the size of the raster, read from its header.
+        Messages received from a heavy queue are always handled.
+        """
+        return not is_heavy_queue_name(method_frame.routing_key) and \
+            raster_size(pathname) > self.config["NC_HEAVY_RASTER_SIZE"]
+
+
+    def republish_to_heavy_queue(self,
+            channel,
+            method_frame,
+            header_frame,
+            body):
+
+        queue_name = heavy_queue_name(method_frame.routing_key)
+
+        self.message_logger(method_frame, header_frame).info(
+            "Republishing message to %s", queue_name)
+
+        channel.basic_publish(
+            exchange="",
+            routing_key=queue_name,
+            body=body,
+            properties=header_frame)
+
+
+    def retry_later(self,
+            channel,
+            method_frame,
+            header_frame,
+            body):
+        """
+        Republish a message which could not be handled, to be retried later
+
+        The message is published to the retry queue of the queue it was
+        received from, for the current delay. Once the delay has expired,
+        the broker moves it back. The delay doubles with each retry. After
+        NC_MAX_RETRIES retries, the message is moved to the dead-letter
+        queue instead.
+        """
+        queue_name = method_frame.routing_key
+        headers = dict(header_frame.headers or {})
+        nr_retries = headers.get("x-nr-retries", 0)
+        retry_delays = self.retry_delays()
+
+        if nr_retries < len(retry_delays):
+            headers["x-nr-retries"] = nr_retries + 1
+            routing_key = retry_queue_name(
+                queue_name, retry_delays[nr_retries])
+        else:
+            routing_key = dead_letter_queue_name(queue_name)
+
+        self.message_logger(method_frame, header_frame).warning(
+            "Republishing message to %s", routing_key,
+            fields={"nr_retries": nr_retries})
+
+        channel.basic_publish(
+            exchange="",
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=header_frame.content_type,
+                correlation_id=header_frame.correlation_id,
+                timestamp=header_frame.timestamp,
+                delivery_mode=2,  # Persistent
+                headers=headers))
+
+
+    def retry_delays(self):
+        """
+        Return the delays, in seconds, before successive retries of a
+        failed message
+        """
+        return [self.config["NC_RETRY_DELAY"] * 2 ** i for i in
+            range(self.config["NC_MAX_RETRIES"])]
+
+
     def on_register_raster(self,
             channel,
             method_frame,
             header_frame,
             body):
 
-        sys.stdout.write("received message: {}\n".format(body))
-        sys.stdout.flush()
+        logger = self.message_logger(method_frame, header_frame)
+        logger.info("Received message", fields={"size": len(body)})
 
         try:
 
             body = body.decode("utf-8")
-            sys.stdout.write("{}\n".format(body))
-            sys.stdout.flush()
             data = json.loads(body)
+            logger.debug("Decoded message", fields={"payload": summarise(
+                data, self.config["NC_LOG_PAYLOAD_SIZE"])})
             plan_uri = data["uri"]
             workspace_name = data["workspace"]
             response = requests.get(plan_uri)
@@ -44,9 +221,16 @@ class DataTools(object):
 
 
             if status != "uploaded":
-                sys.stderr.write("Skipping plan because 'status' is not "
-                    "'uploaded', but '{}'".format(status))
-                sys.stderr.flush()
+                logger.warning("Skipping plan because 'status' is not "
+                    "'uploaded', but '%s'", status)
+                skip_registration = True
+
+
+            if not skip_registration and self.is_heavy_job(
+                    method_frame, pathname):
+                # Let a worker dedicated to large rasters handle this job
+                self.republish_to_heavy_queue(
+                    channel, method_frame, header_frame, body)
                 skip_registration = True
 
 
@@ -73,8 +257,8 @@ class DataTools(object):
 
         except Exception as exception:
 
-            sys.stderr.write("{}\n".format(traceback.format_exc()))
-            sys.stderr.flush()
+            logger.exception("Handling message failed")
+            self.retry_later(channel, method_frame, header_frame, body)
 
 
         channel.basic_ack(delivery_tag=method_frame.delivery_tag)
@@ -86,15 +270,15 @@ class DataTools(object):
             header_frame,
             body):
 
-        sys.stdout.write("received message: {}\n".format(body))
-        sys.stdout.flush()
+        logger = self.message_logger(method_frame, header_frame)
+        logger.info("Received message", fields={"size": len(body)})
 
         try:
 
             body = body.decode("utf-8")
-            sys.stdout.write("{}\n".format(body))
-            sys.stdout.flush()
             data = json.loads(body)
+            logger.debug("Decoded message", fields={"payload": summarise(
+                data, self.config["NC_LOG_PAYLOAD_SIZE"])})
             plan_uri = data["uri"]
             response = requests.get(plan_uri)
 
@@ -117,9 +301,16 @@ class DataTools(object):
 
 
             if status != "registered":
-                sys.stderr.write("Skipping plan because 'status' is not "
-                    "'registered', but '{}'".format(status))
-                sys.stderr.flush()
+                logger.warning("Skipping plan because 'status' is not "
+                    "'registered', but '%s'", status)
+                skip_georeference = True
+
+
+            if not skip_georeference and self.is_heavy_job(
+                    method_frame, pathname):
+                # Let a worker dedicated to large rasters handle this job
+                self.republish_to_heavy_queue(
+                    channel, method_frame, header_frame, body)
                 skip_georeference = True
 
 
@@ -128,14 +319,37 @@ class DataTools(object):
                 assert status == "registered", status
 
                 gcps = data["gcps"]
-                georeference_raster(
-                    pathname,
-                    gcps,
-                    geoserver_uri=self.config["NC_GEOSERVER_URI"],
-                    geoserver_user=self.config["NC_GEOSERVER_USER"],
-                    geoserver_password=self.config["NC_GEOSERVER_PASSWORD"],
-                    workspace_name=workspace_name,
-                    layer_name=layer_name)
+
+                # A redelivered message for the same plan and GCPs does not
+                # warp the raster again
+                idempotency_key = stage_key(plan_uri, "georeference", gcps)
+
+                # Cancelled once a newer job for the same plan starts
+                cancellation_token = SupersedingCancellationToken(
+                    pathname, "georeference",
+                    self.message_timestamp(header_frame))
+
+                try:
+                    residuals = georeference_raster(
+                        pathname,
+                        gcps,
+                        geoserver_uri=self.config["NC_GEOSERVER_URI"],
+                        geoserver_user=self.config["NC_GEOSERVER_USER"],
+                        geoserver_password=
+                            self.config["NC_GEOSERVER_PASSWORD"],
+                        workspace_name=workspace_name,
+                        layer_name=layer_name,
+                        idempotency_key=idempotency_key,
+                        affine_tolerance=data.get("affine_tolerance",
+                            self.config["NC_GEOREFERENCE_AFFINE_TOLERANCE"]),
+                        cancellation_token=cancellation_token,
+                        warp_memory=self.config["NC_GDAL_WARP_MEMORY"])
+                finally:
+                    cancellation_token.release()
+
+                if residuals is not None:
+                    logger.info("Fitted affine transformation to GCPs",
+                        fields={"residuals": residuals})
 
                 # Mark plan as 'georeferenced'.
                 payload = {
@@ -146,10 +360,16 @@ class DataTools(object):
                 assert response.status_code == 200, response.text
 
 
+        except Cancelled:
+
+            logger.info("Job cancelled, superseded by a newer job on the "
+                "same plan")
+
+
         except Exception as exception:
 
-            sys.stderr.write("{}\n".format(traceback.format_exc()))
-            sys.stderr.flush()
+            logger.exception("Handling message failed")
+            self.retry_later(channel, method_frame, header_frame, body)
 
 
         channel.basic_ack(delivery_tag=method_frame.delivery_tag)
@@ -161,16 +381,16 @@ class DataTools(object):
             header_frame,
             body):
 
-        sys.stdout.write("received message: {}\n".format(body))
-        sys.stdout.flush()
+        logger = self.message_logger(method_frame, header_frame)
+        logger.info("Received message", fields={"size": len(body)})
 
 
         try:
 
             body = body.decode("utf-8")
-            sys.stdout.write("{}\n".format(body))
-            sys.stdout.flush()
             data = json.loads(body)
+            logger.debug("Decoded message", fields={"payload": summarise(
+                data, self.config["NC_LOG_PAYLOAD_SIZE"])})
             plan_uri = data["uri"]
             response = requests.get(plan_uri)
 
@@ -191,9 +411,16 @@ class DataTools(object):
 
 
             if status != "georeferenced":
-                sys.stderr.write("Skipping plan because 'status' is not "
-                    "'georeferenced', but '{}'".format(status))
-                sys.stderr.flush()
+                logger.warning("Skipping plan because 'status' is not "
+                    "'georeferenced', but '%s'", status)
+                skip_retrieve_colors = True
+
+
+            if not skip_retrieve_colors and self.is_heavy_job(
+                    method_frame, pathname):
+                # Let a worker dedicated to large rasters handle this job
+                self.republish_to_heavy_queue(
+                    channel, method_frame, header_frame, body)
                 skip_retrieve_colors = True
 
 
@@ -202,23 +429,58 @@ class DataTools(object):
                 assert status == "georeferenced", status
 
                 client_id = data["client_id"]
-                colors = retrieve_colors(pathname)
-                notify_uri = self.config["NC_CLIENT_NOTIFIER_URI"]
-                payload = {
-                    "client_id": client_id,
-                    "result": {
-                        "colors": colors
-                    }
-                }
 
-                response = requests.post(notify_uri, json=payload)
-                assert response.status_code == 201, response.text
+                # Clients previewing a legend only need the dominant
+                # colors, which are estimated within a fixed time
+                nr_colors = data.get("nr_colors")
+
+                # Clients can request the colors in a compact format,
+                # with their counts, sorted by frequency, and page by
+                # page. Subsequent pages are requested by passing the
+                # continuation token of the previous page.
+                page_options = {name: data[name] for name in
+                    ["color_format", "sort", "page_size"] if name in data}
+
+                if "continuation" in data:
+                    page_options = decode_continuation(data["continuation"])
+
+                if page_options:
+                    colors, counts = count_colors(pathname,
+                        max_memory=self.config["NC_MAX_MEMORY"])
+                    page = color_page(colors, counts, **page_options)
+                    self.notify_colors(client_id, page.pop("colors"),
+                        statistics=page)
+                elif nr_colors is not None:
+                    dominant_colors = retrieve_dominant_colors(pathname,
+                        nr_colors=nr_colors,
+                        exact=data.get("exact", False),
+                        sample_size=
+                            self.config["NC_DOMINANT_COLORS_SAMPLE_SIZE"],
+                        time_budget=
+                            self.config["NC_DOMINANT_COLORS_TIME_BUDGET"],
+                        max_memory=self.config["NC_MAX_MEMORY"])
+                    self.notify_colors(client_id,
+                        dominant_colors.pop("colors"),
+                        statistics=dominant_colors)
+                elif self.is_scatter_job(pathname):
+                    job_directory_pathname = scatter(
+                        channel, "retrieve_colors", pathname,
+                        arguments={},
+                        continuation={"client_id": client_id},
+                        tile_size=self.config["NC_SCATTER_TILE_SIZE"],
+                        properties=header_frame)
+                    logger.info("Scattered job over tiles",
+                        fields={"job": job_directory_pathname})
+                else:
+                    colors = retrieve_colors(pathname,
+                        max_memory=self.config["NC_MAX_MEMORY"])
+                    self.notify_colors(client_id, colors)
 
 
         except Exception as exception:
 
-            sys.stderr.write("{}\n".format(traceback.format_exc()))
-            sys.stderr.flush()
+            logger.exception("Handling message failed")
+            self.retry_later(channel, method_frame, header_frame, body)
 
 
         channel.basic_ack(delivery_tag=method_frame.delivery_tag)
@@ -230,16 +492,16 @@ class DataTools(object):
             header_frame,
             body):
 
-        sys.stdout.write("received message: {}\n".format(body))
-        sys.stdout.flush()
+        logger = self.message_logger(method_frame, header_frame)
+        logger.info("Received message", fields={"size": len(body)})
 
 
         try:
 
             body = body.decode("utf-8")
-            sys.stdout.write("{}\n".format(body))
-            sys.stdout.flush()
             data = json.loads(body)
+            logger.debug("Decoded message", fields={"payload": summarise(
+                data, self.config["NC_LOG_PAYLOAD_SIZE"])})
             plan_uri = data["uri"]
             response = requests.get(plan_uri)
 
@@ -260,9 +522,16 @@ class DataTools(object):
 
 
             if status != "georeferenced":
-                sys.stderr.write("Skipping plan because 'status' is not "
-                    "'georeferenced', but '{}'".format(status))
-                sys.stderr.flush()
+                logger.warning("Skipping plan because 'status' is not "
+                    "'georeferenced', but '%s'", status)
+                skip_classify_raster = True
+
+
+            if not skip_classify_raster and self.is_heavy_job(
+                    method_frame, pathname):
+                # Let a worker dedicated to large rasters handle this job
+                self.republish_to_heavy_queue(
+                    channel, method_frame, header_frame, body)
                 skip_classify_raster = True
 
 
@@ -270,6 +539,9 @@ class DataTools(object):
 
                 assert status == "georeferenced", status
 
+                # The LUT is encoded as a dict with stringified color
+                # keys, or compactly, as (base64-encoded) parallel arrays
+                # of colors and class ids (see decode_lut)
                 lut = data["lut"]
                 # "lut": {
                 #     "(0, 127, 0)": 2,
@@ -280,96 +552,493 @@ class DataTools(object):
                 #     "(0, 255, 0)": 3,
                 #     "(0, 0, 127)": 3
                 # }
-                lut = {ast.literal_eval(key): value for key, value in
-                    lut.items()}
-                result_pathname = classify_raster(
-                    pathname,
-                    lut,
-                    geoserver_uri=self.config["NC_GEOSERVER_URI"],
-                    geoserver_user=self.config["NC_GEOSERVER_USER"],
-                    geoserver_password=self.config["NC_GEOSERVER_PASSWORD"],
-                    workspace_name=workspace_name)
-                    # layer_name=layer_name)
 
+                # Optionally embed a color table in the result, so the
+                # classes can be rendered without a style. Either true, to
+                # derive the table from the LUT, or an explicit table.
+                color_table = data.get("color_table", False)
+
+                # Optionally assign colors missing from the LUT to the
+                # class of the nearest color in the LUT within this
+                # distance
+                max_color_distance = data.get("max_color_distance",
+                    self.config["NC_CLASSIFY_MAX_COLOR_DISTANCE"])
+
+                # A redelivered message for the same plan, LUT, color
+                # table and color distance does not classify the raster
+                # again
+                idempotency_key = stage_key(plan_uri, "classify", lut,
+                    color_table, max_color_distance)
+
+                if self.is_scatter_job(pathname) and not stage_completed(
+                        classified_raster_pathname(pathname),
+                        idempotency_key):
+                    job_directory_pathname = scatter(
+                        channel, "classify_raster", pathname,
+                        arguments={
+                            "lut": lut,
+                            "color_table": color_table,
+                            "max_color_distance": max_color_distance
+                        },
+                        continuation={
+                            "plan_uri": plan_uri,
+                            "workspace_name": workspace_name,
+                            "idempotency_key": idempotency_key
+                        },
+                        tile_size=self.config["NC_SCATTER_TILE_SIZE"],
+                        properties=header_frame)
+                    logger.info("Scattered job over tiles",
+                        fields={"job": job_directory_pathname})
+                else:
+                    # Cancelled once a newer job for the same plan starts
+                    cancellation_token = SupersedingCancellationToken(
+                        pathname, "classify",
+                        self.message_timestamp(header_frame))
+
+                    try:
+                        result_pathname = classify_raster(
+                            pathname,
+                            decode_lut(lut),
+                            geoserver_uri=self.config["NC_GEOSERVER_URI"],
+                            geoserver_user=self.config["NC_GEOSERVER_USER"],
+                            geoserver_password=
+                                self.config["NC_GEOSERVER_PASSWORD"],
+                            workspace_name=workspace_name,
+                            color_table=parse_color_table(color_table),
+                            idempotency_key=idempotency_key,
+                            cancellation_token=cancellation_token,
+                            max_memory=self.config["NC_MAX_MEMORY"],
+                            max_color_distance=max_color_distance)
+                            # layer_name=layer_name)
+                    finally:
+                        cancellation_token.release()
+
+                    self.mark_plan_classified(plan_uri, pathname)
+
+
+        except Cancelled:
+
+            logger.info("Job cancelled, superseded by a newer job on the "
+                "same plan")
 
-                # Mark plan as 'classified'.
-                payload = {
-                    "pathname": pathname,
-                    "status": "classified"
-                }
-                response = requests.patch(plan_uri, json=payload)
 
-                assert response.status_code == 200, response.text
+        except Exception as exception:
+
+            logger.exception("Handling message failed")
+            self.retry_later(channel, method_frame, header_frame, body)
+
+
+
+        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+
+
+    def on_compute_raster_statistics(self,
+            channel,
+            method_frame,
+            header_frame,
+            body):
+        """
+        Compute the statistics of the bands of a raster, optionally of a
+        window only, and send them to the client
+        """
+
+        logger = self.message_logger(method_frame, header_frame)
+        logger.info("Received message", fields={"size": len(body)})
+
+
+        try:
+
+            body = body.decode("utf-8")
+            data = json.loads(body)
+            logger.debug("Decoded message", fields={"payload": summarise(
+                data, self.config["NC_LOG_PAYLOAD_SIZE"])})
+            pathname = data["pathname"]
+            assert os.path.exists(pathname), pathname
+
+            if self.is_heavy_job(method_frame, pathname):
+                # Let a worker dedicated to large rasters handle this job
+                self.republish_to_heavy_queue(
+                    channel, method_frame, header_frame, body)
+            else:
+                window = data.get("window")
+                statistics = raster_statistics(pathname,
+                    window=None if window is None else
+                        tuple(tuple(range_) for range_ in window),
+                    nr_bins=data.get("nr_bins", statistics_nr_bins))
+                self.notify_statistics(
+                    data["client_id"], pathname, statistics)
 
 
         except Exception as exception:
 
-            sys.stderr.write("{}\n".format(traceback.format_exc()))
-            sys.stderr.flush()
+            logger.exception("Handling message failed")
+            self.retry_later(channel, method_frame, header_frame, body)
+
+
+        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+
+
+    def on_process_raster_tile(self,
+            channel,
+            method_frame,
+            header_frame,
+            body):
+        """
+        Process a tile sub-task of a job scattered over tiles
+
+        The worker processing the last tile of the job gathers the
+        results and finishes the job.
+        """
+
+        logger = self.message_logger(method_frame, header_frame)
+        logger.info("Received message", fields={"size": len(body)})
+
+        try:
+
+            body = body.decode("utf-8")
+            data = json.loads(body)
+            job_directory_pathname = data["job"]
+            tile_index = data["tile"]
+            logger.debug("Decoded message", fields={"payload": summarise(
+                data, self.config["NC_LOG_PAYLOAD_SIZE"])})
+
+            if process_tile(job_directory_pathname, tile_index,
+                    max_memory=self.config["NC_MAX_MEMORY"]):
+
+                logger.info("Gathering results of tiles",
+                    fields={"job": job_directory_pathname})
+
+                with gathering(job_directory_pathname):
+                    manifest = read_manifest(job_directory_pathname)
+                    pathname = manifest["pathname"]
+                    continuation = manifest["continuation"]
+
+                    if manifest["operation"] == "classify_raster":
+                        result_pathname = gather(job_directory_pathname,
+                            classified_raster_pathname(pathname))
+
+                        if continuation is not None:
+                            publish_classified_raster(
+                                pathname,
+                                result_pathname,
+                                geoserver_uri=
+                                    self.config["NC_GEOSERVER_URI"],
+                                geoserver_user=
+                                    self.config["NC_GEOSERVER_USER"],
+                                geoserver_password=
+                                    self.config["NC_GEOSERVER_PASSWORD"],
+                                workspace_name=
+                                    continuation["workspace_name"])
+                            self.mark_plan_classified(
+                                continuation["plan_uri"], pathname)
+
+                    elif manifest["operation"] == "retrieve_colors":
+                        colors = gather(job_directory_pathname)
+
+                        if continuation is not None:
+                            self.notify_colors(
+                                continuation["client_id"], colors)
+
 
+        except Exception as exception:
+
+            logger.exception("Handling message failed")
+            self.retry_later(channel, method_frame, header_frame, body)
 
 
         channel.basic_ack(delivery_tag=method_frame.delivery_tag)
 
 
-    def run(self,
-            host):
+    def is_scatter_job(self,
+            pathname):
+        """
+        Return whether the job on the raster pointed to by *pathname* must
+        be split into tile sub-tasks, to be processed in parallel
+        """
+        return raster_size(pathname) > self.config["NC_SCATTER_RASTER_SIZE"]
+
+
+    def mark_plan_classified(self,
+            plan_uri,
+            pathname):
+
+        # Mark plan as 'classified'.
+        payload = {
+            "pathname": pathname,
+            "status": "classified"
+        }
+        response = requests.patch(plan_uri, json=payload)
+
+        assert response.status_code == 200, response.text
+
+
+    def notify_colors(self,
+            client_id,
+            colors,
+            statistics=None):
+        """
+        Send the colors retrieved to the client
+
+        *statistics* is a dict with additional information about the
+        colors (e.g. their frequencies), which is added to the result.
+        """
+        notify_uri = self.config["NC_CLIENT_NOTIFIER_URI"]
+        payload = {
+            "client_id": client_id,
+            "result": {
+                "colors": colors
+            }
+        }
+        payload["result"].update(statistics or {})
+
+        response = requests.post(notify_uri, json=payload)
+        assert response.status_code == 201, response.text
+
+
+    def notify_statistics(self,
+            client_id,
+            pathname,
+            statistics):
+        """
+        Send the statistics of the bands of a raster to the client
+        """
+        notify_uri = self.config["NC_CLIENT_NOTIFIER_URI"]
+        payload = {
+            "client_id": client_id,
+            "result": {
+                "pathname": pathname,
+                "bands": statistics
+            }
+        }
+
+        response = requests.post(notify_uri, json=payload)
+        assert response.status_code == 201, response.text
+
+
+    def declare_queue(self,
+            queue_name):
+        """
+        Declare the queue named *queue_name*, as well as its retry and
+        dead-letter queues
+
+        There is a retry queue per retry delay. Messages whose delay
+        expires in a retry queue are moved back to the queue they came
+        from.
+        """
+        self.channel.queue_declare(
+            queue=queue_name,
+            durable=True)
+
+        for delay in self.retry_delays():
+            self.channel.queue_declare(
+                queue=retry_queue_name(queue_name, delay),
+                durable=True,
+                arguments={
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": queue_name,
+                    "x-message-ttl": int(delay * 1000),  # Milliseconds
+                })
+        self.channel.queue_declare(
+            queue=dead_letter_queue_name(queue_name),
+            durable=True)
+
+
+    def connection_parameters(self):
 
         self.credentials = pika.PlainCredentials(
             self.config["NC_RABBITMQ_DEFAULT_USER"],
             self.config["NC_RABBITMQ_DEFAULT_PASS"]
         )
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+
+        return pika.ConnectionParameters(
             host="rabbitmq",
             virtual_host=self.config["NC_RABBITMQ_DEFAULT_VHOST"],
             credentials=self.credentials,
             # Keep trying for 8 minutes.
             connection_attempts=100,
-            retry_delay=5  # Seconds
-        ))
-        self.channel = self.connection.channel()
-        self.channel.basic_qos(prefetch_count=1)
+            retry_delay=5,  # Seconds
+            heartbeat=self.config["NC_RABBITMQ_HEARTBEAT"]
+        )
 
-        self.channel.queue_declare(
-            queue="register_raster",
-            durable=True)
-        self.channel.basic_consume(
-            self.on_register_raster,
-            queue="register_raster")
 
-        self.channel.queue_declare(
-            queue="georeference_raster",
-            durable=True)
-        self.channel.basic_consume(
-            self.on_georeference_raster,
-            queue="georeference_raster")
+    def run(self,
+            host):
 
-        self.channel.queue_declare(
-            queue="retrieve_colors_of_raster",
-            durable=True)
-        self.channel.basic_consume(
-            self.on_retrieve_colors_of_raster,
-            queue="retrieve_colors_of_raster")
+        self.connection = pika.BlockingConnection(
+            self.connection_parameters())
+        self.channel = self.connection.channel()
 
-        self.channel.queue_declare(
-            queue="classify_raster",
-            durable=True)
-        self.channel.basic_consume(
-            self.on_classify_raster,
-            queue="classify_raster")
+        # Jobs run on a worker thread, while this thread keeps servicing
+        # heartbeats. Otherwise the broker drops the connection during
+        # long jobs, and redelivers their messages to other workers.
+        consumer = ThreadedConsumer(
+            self.connection, retry_later=self.retry_later)
+        self.setup_consumers(consumer=consumer)
 
         try:
-            sys.stdout.write("Start consuming...\n")
-            sys.stdout.flush()
+            logger.info("Start consuming...")
             self.channel.start_consuming()
         except KeyboardInterrupt:
             self.channel.stop_consuming()
 
-        sys.stdout.write("Close connection...\n")
-        sys.stdout.flush()
+        logger.info("Wait for running job...")
+        consumer.shutdown()
+
+        logger.info("Close connection...")
         self.connection.close()
 
 
+    def gdal_options(self,
+            queue_name):
+        """
+        Return the GDAL configuration options to apply while handling
+        messages from *queue_name*
+        """
+        options = dict(self.config["NC_GDAL_ENVIRONMENT"])
+        options.update(self.config["NC_GDAL_OPERATION_ENVIRONMENT"].get(
+            light_queue_name(queue_name), {}))
+
+        return options
+
+
+    def in_gdal_environment(self,
+            handler):
+        """
+        Return a message handler which calls *handler* with the GDAL
+        configuration options of the message's queue applied
+        """
+
+        def configured_handler(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            with gdal_environment(**self.gdal_options(
+                    method_frame.routing_key)) as options:
+                self.message_logger(method_frame, header_frame).debug(
+                    "Applied GDAL environment",
+                    fields={"gdal_environment": options})
+
+                return handler(channel, method_frame, header_frame, body)
+
+
+        return configured_handler
+
+
+    def profiler(self):
+        """
+        Return the profiler of messages, or None if profiling is not
+        enabled
+        """
+        directory_pathname = self.config["NC_PROFILE_DIRECTORY"]
+
+        if directory_pathname is None:
+            return None
+
+        queue_names = self.config["NC_PROFILE_QUEUES"]
+
+        if queue_names is not None:
+            queue_names = [name.strip() for name in queue_names.split(",")]
+
+        return MessageProfiler(
+            directory_pathname,
+            queue_names=queue_names,
+            sample_rate=self.config["NC_PROFILE_SAMPLE_RATE"])
+
+
+    def setup_consumers(self,
+            consumer=None):
+        """
+        Declare the queues and register the handlers of their messages
+        with the channel
+
+        In case a *consumer* (e.g. a ThreadedConsumer) is passed, handlers
+        are wrapped by it.
+        """
+        self.channel.basic_qos(prefetch_count=1)
+        logger.info("GDAL environment", extra={"fields": {
+            "gdal_environment": self.config["NC_GDAL_ENVIRONMENT"],
+            "gdal_operation_environment":
+                self.config["NC_GDAL_OPERATION_ENVIRONMENT"],
+            "gdal_warp_memory": self.config["NC_GDAL_WARP_MEMORY"],
+        }})
+
+        handler_by_queue_name = [
+            ("register_raster", self.on_register_raster),
+            ("georeference_raster", self.on_georeference_raster),
+            ("retrieve_colors_of_raster", self.on_retrieve_colors_of_raster),
+            ("classify_raster", self.on_classify_raster),
+            ("compute_raster_statistics",
+                self.on_compute_raster_statistics),
+        ]
+        worker_class = self.config["NC_WORKER_CLASS"]
+        assert worker_class in ["light", "heavy", "all"], worker_class
+        profiler = self.profiler()
+
+        def wrap(
+                handler):
+
+            handler = self.in_gdal_environment(handler)
+
+            if profiler is not None:
+                handler = profiler.wrap(handler)
+
+            if consumer is not None:
+                handler = consumer.wrap(handler)
+
+            return handler
+
+        handler_by_queue_name = [(queue_name, wrap(handler))
+            for queue_name, handler in handler_by_queue_name]
+
+        for queue_name, handler in handler_by_queue_name:
+
+            # Both queues are always declared, since light workers
+            # republish large jobs to the heavy queues
+            queue_names = [queue_name, heavy_queue_name(queue_name)]
+
+            for name in queue_names:
+                self.declare_queue(name)
+
+            if worker_class == "light":
+                queue_names = queue_names[:1]
+            elif worker_class == "heavy":
+                queue_names = queue_names[1:]
+
+            for name in queue_names:
+                self.channel.basic_consume(
+                    handler,
+                    queue=name)
+
+        # Tile sub-tasks are small, and are handled by all workers
+        self.declare_queue(tile_queue_name)
+        self.channel.basic_consume(
+            wrap(self.on_process_raster_tile),
+            queue=tile_queue_name)
+
+
+    def consumed_queue_names(self):
+        """
+        Return the names of the queues consumed by workers of the
+        configured worker class
+        """
+        worker_class = self.config["NC_WORKER_CLASS"]
+        assert worker_class in ["light", "heavy", "all"], worker_class
+        queue_names = []
+
+        for queue_name in operation_queue_names:
+            if worker_class in ["light", "all"]:
+                queue_names.append(queue_name)
+
+            if worker_class in ["heavy", "all"]:
+                queue_names.append(heavy_queue_name(queue_name))
+
+        queue_names.append(tile_queue_name)
+
+        return queue_names
+
+
 def create_app(
         configuration_name):
 
@@ -379,4 +1048,6 @@ def create_app(
     app.config.from_object(configuration_)
     configuration_.init_app(app)
 
+    configure_logging(app.config["NC_LOG_LEVEL"])
+
     return app
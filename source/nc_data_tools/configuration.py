@@ -1,3 +1,4 @@
+import json
 import os
 
 
@@ -7,12 +8,116 @@ class Configuration:
     NC_RABBITMQ_DEFAULT_PASS = os.environ.get("NC_RABBITMQ_DEFAULT_PASS")
     NC_RABBITMQ_DEFAULT_VHOST = os.environ.get("NC_RABBITMQ_DEFAULT_VHOST")
 
+    # Interval, in seconds, of heartbeats between the workers and the
+    # broker. Long jobs run on a worker thread, so heartbeats continue
+    # while they run.
+    NC_RABBITMQ_HEARTBEAT = int(os.environ.get("NC_RABBITMQ_HEARTBEAT") or 60)
+
     NC_GEOSERVER_URI = os.environ.get("NC_GEOSERVER_URI")
     NC_GEOSERVER_USER = os.environ.get("NC_GEOSERVER_USER")
     NC_GEOSERVER_PASSWORD = os.environ.get("NC_GEOSERVER_PASSWORD")
 
     NC_CLIENT_NOTIFIER_URI = os.environ.get("NC_CLIENT_NOTIFIER_URI")
 
+    NC_LOG_LEVEL = os.environ.get("NC_LOG_LEVEL") or "INFO"
+
+    # Collections in logged message payloads are truncated to this number
+    # of elements
+    NC_LOG_PAYLOAD_SIZE = int(os.environ.get("NC_LOG_PAYLOAD_SIZE") or 20)
+
+    # Rasters with more cells than this (width x height x bands) are
+    # handled by workers consuming the heavy queues
+    NC_HEAVY_RASTER_SIZE = int(
+        os.environ.get("NC_HEAVY_RASTER_SIZE") or 50 * 1024 * 1024)
+
+    # Which queues to consume: "light", "heavy" or "all". Deployments
+    # running dedicated heavy workers configure the other workers as light.
+    NC_WORKER_CLASS = os.environ.get("NC_WORKER_CLASS") or "all"
+
+    # The supervisor (supervisor.py) runs between NC_MIN_WORKERS and
+    # NC_MAX_WORKERS worker processes. Every NC_SCALE_INTERVAL seconds, it
+    # starts a worker per NC_SCALE_BACKLOG_PER_WORKER messages waiting, as
+    # long as the load average per CPU is below NC_SCALE_MAX_LOAD, or stops
+    # a worker if there are fewer messages waiting.
+    NC_MIN_WORKERS = int(os.environ.get("NC_MIN_WORKERS") or 1)
+    NC_MAX_WORKERS = int(
+        os.environ.get("NC_MAX_WORKERS") or os.cpu_count() or 1)
+    NC_SCALE_BACKLOG_PER_WORKER = int(
+        os.environ.get("NC_SCALE_BACKLOG_PER_WORKER") or 10)
+    NC_SCALE_MAX_LOAD = float(os.environ.get("NC_SCALE_MAX_LOAD") or 0.9)
+    NC_SCALE_INTERVAL = float(os.environ.get("NC_SCALE_INTERVAL") or 15)
+
+    # Jobs on rasters with more cells than this are split into tiles of
+    # the size passed (in cells along both dimensions), which are
+    # processed by all workers in parallel
+    NC_SCATTER_RASTER_SIZE = int(
+        os.environ.get("NC_SCATTER_RASTER_SIZE") or 400 * 1024 * 1024)
+    NC_SCATTER_TILE_SIZE = int(
+        os.environ.get("NC_SCATTER_TILE_SIZE") or 4096)
+
+    # When set, georeferencing only updates the raster header, instead of
+    # warping the raster, if an affine transformation fits the GCPs within
+    # this tolerance (in target CRS units)
+    NC_GEOREFERENCE_AFFINE_TOLERANCE = \
+        float(os.environ["NC_GEOREFERENCE_AFFINE_TOLERANCE"]) \
+            if os.environ.get("NC_GEOREFERENCE_AFFINE_TOLERANCE") else None
+
+    # When set, classification assigns colors missing from the LUT to the
+    # class of the nearest color in the LUT within this (Euclidean RGB)
+    # distance. Messages can override it.
+    NC_CLASSIFY_MAX_COLOR_DISTANCE = \
+        float(os.environ["NC_CLASSIFY_MAX_COLOR_DISTANCE"]) \
+            if os.environ.get("NC_CLASSIFY_MAX_COLOR_DISTANCE") else None
+
+    # Dominant colors are estimated from a sample of about this number of
+    # cells, read within this number of seconds
+    NC_DOMINANT_COLORS_SAMPLE_SIZE = int(
+        os.environ.get("NC_DOMINANT_COLORS_SAMPLE_SIZE") or 1024 * 1024)
+    NC_DOMINANT_COLORS_TIME_BUDGET = float(
+        os.environ.get("NC_DOMINANT_COLORS_TIME_BUDGET") or 5)
+
+    # Memory budget, in bytes, of processing a raster. Operations whose
+    # estimated peak memory usage exceeds it process rasters window by
+    # window.
+    NC_MAX_MEMORY = int(os.environ.get("NC_MAX_MEMORY") or 1024 ** 3)
+
+    # GDAL configuration options applied while handling messages. Options
+    # passed as a JSON object in NC_GDAL_ENVIRONMENT override these
+    # defaults. Options for specific operations (queue names) can be
+    # passed as a JSON object mapping operations to options in
+    # NC_GDAL_OPERATION_ENVIRONMENT.
+    #
+    # GDAL_DISABLE_READDIR_ON_OPEN is not set by default: it hides sidecar
+    # files (.ovr, .msk, .aux.xml, .prj), like the external overviews used
+    # when reprojecting, and the CRS of ASCII grids and PNG uploads.
+    NC_GDAL_ENVIRONMENT = dict({
+            "GDAL_CACHEMAX": 512,  # MB
+            "GDAL_NUM_THREADS": "ALL_CPUS",
+            "VSI_CACHE": True,
+            "VSI_CACHE_SIZE": 64 * 1024 * 1024,
+            "GDAL_TIFF_INTERNAL_MASK": True,
+            "GDAL_TIFF_OVR_BLOCKSIZE": 256,
+        }, **json.loads(os.environ.get("NC_GDAL_ENVIRONMENT") or "{}"))
+    NC_GDAL_OPERATION_ENVIRONMENT = json.loads(
+        os.environ.get("NC_GDAL_OPERATION_ENVIRONMENT") or "{}")
+
+    # Memory, in MB, the warper may use while georeferencing
+    NC_GDAL_WARP_MEMORY = int(os.environ.get("NC_GDAL_WARP_MEMORY") or 256)
+
+    # Failed jobs are retried this many times, with exponential backoff
+    # starting at the delay passed (in seconds), before their messages are
+    # moved to the dead-letter queue
+    NC_MAX_RETRIES = int(os.environ.get("NC_MAX_RETRIES") or 5)
+    NC_RETRY_DELAY = float(os.environ.get("NC_RETRY_DELAY") or 10)
+
+    # When set, a sampled fraction of the messages from the queues passed
+    # (comma-separated, all queues when unset) is profiled. CPU and memory
+    # profiles are stored in this directory.
+    NC_PROFILE_DIRECTORY = os.environ.get("NC_PROFILE_DIRECTORY")
+    NC_PROFILE_QUEUES = os.environ.get("NC_PROFILE_QUEUES")
+    NC_PROFILE_SAMPLE_RATE = float(
+        os.environ.get("NC_PROFILE_SAMPLE_RATE") or 1.0)
+
 
     @staticmethod
     def init_app(
@@ -22,7 +127,7 @@ class Configuration:
 
 class DevelopmentConfiguration(Configuration):
 
-    pass
+    NC_LOG_LEVEL = os.environ.get("NC_LOG_LEVEL") or "DEBUG"
 
 
 class TestConfiguration(Configuration):
@@ -1,15 +1,50 @@
+import logging
 import os.path
-import shutil
 import shlex
 import subprocess
 import sys
+import tempfile
+import time
 import numpy
 import rasterio
 from geoserver.catalog import Catalog
+from . affine_fit import *
+from . cancellation import *
 from . clip_raster import *
+from . color_lookup import *
+from . color_results import *
+from . gdal_environment import *
+from . memory_budget import *
+from . pipeline import *
 from . reformat_raster import *
 from . reproject_raster import *
+from . sparse import *
+from . stages import *
+from . statistics import *
 from . subtract_raster import *
+from . tiles import *
+
+
+logger = logging.getLogger(__name__)
+
+
+# Classified rasters are written tiled, using square blocks of this size.
+classified_raster_block_size = 256
+
+# Estimated peak memory usage, in bytes per cell, of reading and
+# processing RGB(A) rasters
+retrieve_colors_bytes_per_cell = 20
+classify_raster_bytes_per_cell = 32
+nearest_color_bytes_per_cell = 56
+
+# Estimated peak memory usage, in bytes per cell, of reading and
+# processing palette rasters
+palette_bytes_per_cell = 12
+
+# Maximum number of cells of a raster covered by a single decimated read
+# when estimating its dominant colors. Without overviews, GDAL reads all
+# of them, so this bounds the time between checks of the time budget.
+dominant_colors_cells_per_read = 4 * 1024 * 1024
 
 
 def is_name_of_graphics_file(
@@ -30,6 +65,32 @@ def geotiff_pathname(
     return "{}.tif".format(os.path.splitext(pathname)[0])
 
 
+def raster_palette(
+        raster):
+    """
+    Return the palette of single-band uint8 rasters with a color table, as
+    a 256 x 4 array of RGBA colors indexed by cell value, or None
+
+    Entries missing from the color table are transparent black.
+    """
+    if raster.count != 1 or raster.dtypes[0] != "uint8":
+        return None
+
+    try:
+        color_table = raster.colormap(1)
+    except ValueError:
+        # Raster has no color table
+        return None
+
+    palette = numpy.zeros((256, 4), dtype=numpy.uint8)
+
+    for index, color in color_table.items():
+        if 0 <= index < 256:
+            palette[index] = color
+
+    return palette
+
+
 def convert_graphics_file_to_geotiff(
         graphics_pathname,
         geotiff_pathname,
@@ -39,19 +100,44 @@ def convert_graphics_file_to_geotiff(
     by OpenStreetmap and Google.
 
     An alpha band is added to the result to mark no-data values.
+
+    Indexed (palette) graphics files are stored as a single band of
+    indices with a color table, which is four times smaller than RGBA.
+    An index not used by the palette then marks no-data values. Indexed
+    graphics files using all 256 palette entries are expanded to RGBA.
     """
-    # The graphics file contains three or four bands: RGB or RGBA.
-    # The geotiff file will contain four bands: RGBA.
     with rasterio.open(graphics_pathname) as graphics_file:
-        if graphics_file.count == 3:
+
+        # The GeoTIFF file will contain the same bands.
+        profile = graphics_file.profile
+        palette = raster_palette(graphics_file)
+        color_table = None
+
+        if palette is not None:
+            indices = graphics_file.read(1)
+            nr_colors = len(graphics_file.colormap(1))
+
+        if palette is not None and nr_colors < 256:
+            # Keep the indices. Cells with a transparent color are
+            # marked as no-data, using the first unused index.
+            nodata = nr_colors
+            color_table = {index: tuple(int(value) for value in
+                palette[index]) for index in range(nr_colors)}
+            indices[palette[indices, 3] == 0] = nodata
+            bands = [indices]
+            profile.update(nodata=nodata)
+        elif palette is not None:
+            # Expand the indices to RGBA
+            bands = list(numpy.moveaxis(palette[indices], 2, 0))
+        elif graphics_file.count == 3:
+            # The graphics file contains three or four bands: RGB or RGBA.
+            # The geotiff file will contain four bands: RGBA.
             r, g, b = graphics_file.read()
             a = numpy.copy(r)
             a[...] = 255
+            bands = [r, g, b, a]
         else:
-            r, g, b, a = graphics_file.read()
-
-        # The GeoTIFF file will contain the same bands.
-        profile = graphics_file.profile
+            bands = list(graphics_file.read())
 
 
     # How to map raster cell indices to 'world' coordinates.
@@ -67,15 +153,28 @@ def convert_graphics_file_to_geotiff(
         west, north, cell_size, cell_size)
 
     profile.update(driver="GTiff")
-    profile.update(count=4)
+    profile.update(count=len(bands))
     profile.update(transform=transformation)
     profile.update(crs=crs)
 
     with rasterio.open(geotiff_pathname, "w", **profile) as geotiff_file:
-        geotiff_file.write(r, 1)
-        geotiff_file.write(g, 2)
-        geotiff_file.write(b, 3)
-        geotiff_file.write(a, 4)
+        for b, band in enumerate(bands, 1):
+            geotiff_file.write(band, b)
+
+        if color_table is not None:
+            geotiff_file.write_colormap(1, color_table)
+
+
+def raster_size(
+        pathname):
+    """
+    Return the number of cells in all bands of the raster pointed to by
+    *pathname*
+
+    Only the header of the raster is read.
+    """
+    with rasterio.open(pathname) as raster:
+        return raster.width * raster.height * raster.count
 
 
 def workspace_exists(
@@ -103,6 +202,34 @@ def delete_store(
     catalog.reload()
 
 
+def store_exists(
+        catalog,
+        workspace,
+        store_name):
+
+    return any([store_name == store.name for store in
+        catalog.get_stores(workspaces=workspace)])
+
+
+def recreate_store(
+        catalog,
+        workspace,
+        store_name,
+        pathname):
+    """
+    (Re)create the coverage store named *store_name*, for the GeoTIFF
+    pointed to by *pathname*
+
+    Any existing store with the same name is deleted first. This function
+    can safely be called again after it was interrupted.
+    """
+    if store_exists(catalog, workspace, store_name):
+        delete_store(catalog, workspace, store_name)
+
+    catalog.create_coveragestore_external_geotiff(store_name,
+        "file://{}".format(pathname), workspace)
+
+
 def delete_workspace(
         catalog,
         workspace_name):
@@ -161,13 +288,47 @@ def register_raster(
 
 
 def execute_command(
-        command):
+        command,
+        cancellation_token=None):
+    """
+    Execute *command*
+
+    The GDAL configuration options in effect are passed to the command
+    through its environment.
+
+    In case *cancellation_token* is passed, the command is killed once the
+    token is cancelled, after which Cancelled is raised.
+    """
     try:
 
         command = shlex.split(command)
 
-        subprocess.run(command, shell=False, check=True,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # GDAL tools pick up the configuration options in effect
+        environment = gdal_command_environment()
+
+        if cancellation_token is None:
+            subprocess.run(command, shell=False, check=True,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=environment)
+        else:
+            process = subprocess.Popen(command, shell=False,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=environment)
+
+            while True:
+                try:
+                    stdout, stderr = process.communicate(
+                        timeout=cancellation_token.check_interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    if cancellation_token.cancelled:
+                        process.kill()
+                        process.communicate()
+                        raise Cancelled()
+
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    process.returncode, command, stdout, stderr)
 
     except subprocess.CalledProcessError as exception:
 
@@ -185,48 +346,66 @@ def georeference_raster(
         geoserver_user,
         geoserver_password,
         workspace_name,
-        layer_name):
+        layer_name,
+        idempotency_key=None,
+        affine_tolerance=None,
+        cancellation_token=None,
+        warp_memory=None):
     """
     Georeference a raster
-    """
 
-    assert os.path.exists(pathname), pathname
+    In case *idempotency_key* is passed, the warped raster is marked as
+    such, and warping is skipped when georeferencing is requested again
+    using the same key (e.g. when a message is redelivered after a crash).
 
-    with rasterio.open(pathname) as raster_dataset:
-        top = raster_dataset.bounds.top
+    In case *affine_tolerance* is passed, an affine transformation is
+    fitted to the GCPs first. If none of the GCPs deviates more than the
+    tolerance (in target CRS units) from the fit, only the header of the
+    raster is updated, instead of warping all cells.
 
-        for point_pair in gcps:
-            point_pair[0][1] = top - point_pair[0][1]
+    In case *cancellation_token* is passed, georeferencing stops once the
+    token is cancelled, leaving the raster as it was, and Cancelled is
+    raised.
 
-    vrt_pathname = "{}.vrt".format(os.path.splitext(pathname)[0])
+    *warp_memory* is the amount of memory, in MB, the warper may use.
 
-    assert not os.path.exists(vrt_pathname), vrt_pathname
+    Returns the residuals of the affine fit, or None if no fit was
+    performed.
+    """
 
-    gcps = " ".join(["-gcp {} {} {} {}".format(
-        gcp[0][0], gcp[0][1], gcp[1][0], gcp[1][1]) for gcp in gcps])
-    command1 = \
-        "gdal_translate -of VRT -a_srs EPSG:3857 {gcps} {input} {output}".format(
-            gcps=gcps, input=pathname, output=vrt_pathname)
+    assert os.path.exists(pathname), pathname
+
+    residuals = None
+
+    if idempotency_key is None or \
+            not stage_completed(pathname, idempotency_key):
 
-    execute_command(command1)
+        if cancellation_token is not None:
+            cancellation_token.raise_if_cancelled()
 
-    result_pathname = "{}_georeferenced{}".format(
-        *os.path.splitext(pathname))
+        with rasterio.open(pathname) as raster_dataset:
+            top = raster_dataset.bounds.top
 
-    assert not os.path.exists(result_pathname), result_pathname
+            for point_pair in gcps:
+                point_pair[0][1] = top - point_pair[0][1]
 
-    command2 = \
-        "gdalwarp -s_srs EPSG:3857 -t_srs EPSG:3857 {input} {output}".format(
-            input=vrt_pathname, output=result_pathname)
+        if affine_tolerance is not None and len(gcps) >= 3:
+            transform, residuals = fit_affine_transform(gcps)
 
-    execute_command(command2)
+        if residuals is not None and residuals.max() <= affine_tolerance:
+            update_georeference(pathname, transform, crs="EPSG:3857",
+                idempotency_key=idempotency_key)
+        else:
+            if residuals is not None:
+                logger.info(
+                    "Affine fit exceeds tolerance, warping raster instead",
+                    extra={"fields": {"residuals": residuals.tolist()}})
 
-    shutil.move(result_pathname, pathname)
-    os.remove(vrt_pathname)
+            _warp_raster(pathname, gcps, idempotency_key,
+                cancellation_token=cancellation_token,
+                warp_memory=warp_memory)
 
     assert os.path.exists(pathname)
-    assert not os.path.exists(vrt_pathname)
-    assert not os.path.exists(result_pathname)
 
 
     # Recreate the coverage store to simulate refresh of the WMS layer.
@@ -234,84 +413,493 @@ def georeference_raster(
     workspace = catalog.get_workspace(workspace_name)
     coverage_name = os.path.splitext(os.path.basename(pathname))[0]
 
-    delete_store(catalog, workspace, coverage_name)
-    catalog.create_coveragestore_external_geotiff(coverage_name,
-        "file://{}".format(pathname), workspace)
+    recreate_store(catalog, workspace, coverage_name, pathname)
+
+    return None if residuals is None else residuals.tolist()
+
+
+def _warp_raster(
+        pathname,
+        gcps,
+        idempotency_key=None,
+        cancellation_token=None,
+        warp_memory=None):
+    """
+    Warp the raster pointed to by *pathname* in place, given GCPs in
+    pixel / line coordinates
+
+    *warp_memory* is the amount of memory, in MB, the warper may use for
+    caching. Warping is multi-threaded if GDAL_NUM_THREADS is set.
+    """
+    warp_options = "" if warp_memory is None else \
+        "-wm {} ".format(warp_memory)
+
+    if "GDAL_NUM_THREADS" in gdal_environment_options():
+        warp_options += "-multi -wo NUM_THREADS={} ".format(
+            gdal_environment_options()["GDAL_NUM_THREADS"])
+
+    gcps = " ".join(["-gcp {} {} {} {}".format(
+        gcp[0][0], gcp[0][1], gcp[1][0], gcp[1][1]) for gcp in gcps])
+
+    # The VRT is stored in a temporary directory which is removed
+    # afterwards, and the warped raster replaces the original raster
+    # in one go. A failing run leaves no files behind.
+    with tempfile.TemporaryDirectory() as directory_pathname, \
+            atomic_pathname(pathname) as result_pathname:
+
+        vrt_pathname = os.path.join(directory_pathname, "{}.vrt".format(
+            os.path.splitext(os.path.basename(pathname))[0]))
+
+        command1 = \
+            "gdal_translate -of VRT -a_srs EPSG:3857 {gcps} {input} " \
+            "{output}".format(
+                gcps=gcps, input=os.path.abspath(pathname),
+                output=vrt_pathname)
+
+        execute_command(command1, cancellation_token)
+
+        command2 = \
+            "gdalwarp {options}-s_srs EPSG:3857 -t_srs EPSG:3857 " \
+            "{input} {output}".format(
+                options=warp_options, input=vrt_pathname,
+                output=result_pathname)
+
+        execute_command(command2, cancellation_token)
+
+        if idempotency_key is not None:
+            mark_stage_completed(result_pathname, idempotency_key)
 
 
 def retrieve_colors(
-        pathname):
+        pathname,
+        window=None,
+        max_memory=None):
     """
     Return list of unique colors present in RGB raster pointed to by
     *pathname*
+
+    In case *window* is passed, only the colors present in that window
+    are returned.
+
+    In case *max_memory* is passed, the raster is processed window by
+    window if processing it at once does not fit in this number of bytes.
+    """
+
+    assert os.path.exists(pathname)
+
+    with rasterio.open(pathname) as raster:
+
+        if window is None:
+            window = ((0, raster.height), (0, raster.width))
+
+        palette = raster_palette(raster)
+
+        if palette is not None:
+            return _retrieve_palette_colors(raster, palette, window,
+                max_memory)
+
+        (row_offset, row_stop), (col_offset, col_stop) = window
+        plan = plan_execution("retrieve_colors",
+            (row_stop - row_offset, col_stop - col_offset),
+            retrieve_colors_bytes_per_cell, max_memory)
+        colors = numpy.empty(0, dtype=numpy.uint32)
+
+        for (row_start, row_stop), (col_start, col_stop) in plan.windows():
+
+            red_band, green_band, blue_band = raster.read([1, 2, 3],
+                window=(
+                    (row_start + row_offset, row_stop + row_offset),
+                    (col_start + col_offset, col_stop + col_offset)))
+
+            assert red_band.dtype == numpy.uint8
+            assert green_band.dtype == numpy.uint8
+            assert blue_band.dtype == numpy.uint8
+
+            colors = numpy.union1d(colors, numpy.unique(
+                pack_colors(red_band, green_band, blue_band)))
+
+    return [(int(r), int(g), int(b)) for r, g, b in
+        zip(*unpack_colors(colors))]
+
+
+def _retrieve_palette_colors(
+        raster,
+        palette,
+        window,
+        max_memory):
+    """
+    Return list of unique colors present in *window* of the palette
+    raster passed in
+
+    The indices used are counted, after which only the palette entries
+    used have to be looked at. Cells containing the no-data index are
+    skipped.
+    """
+    (row_offset, row_stop), (col_offset, col_stop) = window
+    plan = plan_execution("retrieve_colors",
+        (row_stop - row_offset, col_stop - col_offset),
+        palette_bytes_per_cell, max_memory)
+    counts = numpy.zeros(256, dtype=numpy.int64)
+
+    for (row_start, row_stop), (col_start, col_stop) in plan.windows():
+        indices = raster.read(1, window=(
+            (row_start + row_offset, row_stop + row_offset),
+            (col_start + col_offset, col_stop + col_offset)))
+        counts += numpy.bincount(indices.ravel(), minlength=256)
+
+    if raster.nodata is not None:
+        counts[int(raster.nodata)] = 0
+
+    colors = palette[counts > 0]
+    colors = numpy.unique(pack_colors(
+        colors[:, 0], colors[:, 1], colors[:, 2]))
+
+    return [(int(r), int(g), int(b)) for r, g, b in
+        zip(*unpack_colors(colors))]
+
+
+def _count_colors(
+        raster,
+        palette,
+        window,
+        out_shape=None):
     """
+    Return the unique packed colors of the cells in *window* which are not
+    masked out, and their number of occurrences
+
+    In case *out_shape* is passed, the window is read decimated to this
+    shape.
+    """
+    if palette is not None:
+        indices = raster.read(1, window=window, out=None if out_shape is None
+            else numpy.empty(out_shape, dtype=numpy.uint8))
+        counts = numpy.bincount(indices.ravel(), minlength=256)
+
+        if raster.nodata is not None:
+            counts[int(raster.nodata)] = 0
+
+        colors = pack_colors(palette[:, 0], palette[:, 1], palette[:, 2])
+        colors, inverse = numpy.unique(colors, return_inverse=True)
+        counts = numpy.bincount(inverse, weights=counts,
+            minlength=len(colors))
+    else:
+        nr_bands = 4 if raster.count == 4 else 3
+        bands = raster.read(list(range(1, nr_bands + 1)), window=window,
+            out=None if out_shape is None else
+                numpy.empty((nr_bands,) + out_shape, dtype=numpy.uint8))
+        colors = pack_colors(bands[0], bands[1], bands[2])
+
+        if nr_bands == 4:
+            # Skip transparent cells
+            colors = colors[bands[3] != 0]
+
+        colors, counts = numpy.unique(colors, return_counts=True)
+
+    return colors, counts
+
+
+def _merge_color_counts(
+        colors,
+        counts):
+    """
+    Merge collections of packed colors and their number of occurrences
+    """
+    colors, inverse = numpy.unique(
+        numpy.concatenate(colors), return_inverse=True)
+    counts = numpy.bincount(inverse, weights=numpy.concatenate(counts),
+        minlength=len(colors))
+
+    return colors, counts
+
 
+def retrieve_dominant_colors(
+        pathname,
+        nr_colors=10,
+        exact=False,
+        sample_size=1024 * 1024,
+        time_budget=None,
+        max_memory=None,
+        max_cells_per_read=dominant_colors_cells_per_read,
+        seed=0):
+    """
+    Return the *nr_colors* most frequent colors present in the RGB(A) or
+    palette raster pointed to by *pathname*, with their frequencies
+
+    Unless *exact* is True, the frequencies are estimated by reading the
+    raster decimated, so that about *sample_size* cells are read. GDAL
+    reads from overviews, if present. The decimated raster is read in
+    windows, in random order, each covering at most *max_cells_per_read*
+    cells of the raster. In case *time_budget* is passed, no more windows
+    are read once this number of seconds has passed, and the estimates
+    are based on the windows read until then.
+
+    In exact mode, all cells are read, window by window given
+    *max_memory*.
+
+    Transparent and no-data cells are not counted. Returns a dict with
+    lists of colors, frequencies and margins (half-widths of the 95%
+    confidence intervals of the frequencies), and the number of cells
+    counted.
+    """
     assert os.path.exists(pathname)
 
+    start = time.time()
+    color_counts = []
+
     with rasterio.open(pathname) as raster:
-        nr_rows = raster.height
-        nr_cols = raster.width
-        red_band, green_band, blue_band, _ = raster.read()
 
-    assert red_band.dtype == numpy.uint8
-    assert green_band.dtype == numpy.uint8
-    assert blue_band.dtype == numpy.uint8
+        palette = raster_palette(raster)
+
+        if exact:
+            plan = plan_execution("retrieve_dominant_colors", raster.shape,
+                retrieve_colors_bytes_per_cell, max_memory)
+
+            for window in plan.windows():
+                color_counts.append(
+                    _count_colors(raster, palette, window))
+        else:
+            factor = max(1, int(numpy.ceil(numpy.sqrt(
+                raster.height * raster.width / sample_size))))
+            nr_rows = (raster.height + factor - 1) // factor
+            nr_cols = (raster.width + factor - 1) // factor
+
+            # Windows of decimated cells, read in random order, so the
+            # cells read when running out of time form a sample of the
+            # whole raster. Windows span whole rows, unless they would
+            # cover too many cells of the raster.
+            nr_window_cells = max(1, min(65536,
+                max_cells_per_read // (factor * factor)))
+            window_nr_cols = min(nr_cols, nr_window_cells)
+            window_nr_rows = max(1, nr_window_cells // window_nr_cols)
+            windows = [(row, col) for row in
+                range(0, nr_rows, window_nr_rows) for col in
+                    range(0, nr_cols, window_nr_cols)]
+
+            for i in numpy.random.RandomState(seed).permutation(
+                    len(windows)):
+                row, col = windows[i]
+                row_stop = min(row + window_nr_rows, nr_rows)
+                col_stop = min(col + window_nr_cols, nr_cols)
+                window = (
+                    (row * factor, min(row_stop * factor, raster.height)),
+                    (col * factor, min(col_stop * factor, raster.width)))
+                color_counts.append(_count_colors(raster, palette, window,
+                    out_shape=(row_stop - row, col_stop - col)))
+
+                if time_budget is not None and \
+                        time.time() - start > time_budget:
+                    break
+
+    colors, counts = _merge_color_counts(*zip(*color_counts))
+    colors, counts = colors[counts > 0], counts[counts > 0]
+    nr_cells = int(counts.sum())
+    order = numpy.argsort(-counts, kind="mergesort")[:nr_colors]
+    colors = colors[order]
+    frequencies = counts[order] / max(nr_cells, 1)
+
+    if exact or nr_cells == 0:
+        margins = numpy.zeros(len(frequencies))
+    else:
+        margins = 1.96 * numpy.sqrt(
+            frequencies * (1 - frequencies) / nr_cells)
+
+    return {
+        "colors": [(int(r), int(g), int(b)) for r, g, b in
+            zip(*unpack_colors(colors))],
+        "frequencies": frequencies.tolist(),
+        "margins": margins.tolist(),
+        "nr_cells": nr_cells,
+        "exact": bool(exact),
+    }
+
+
+def color_counts_pathname(
+        pathname):
+    """
+    Return the pathname of the sidecar file caching the color counts of
+    the raster pointed to by *pathname*
+    """
+    return "{}.colors.npz".format(pathname)
+
+
+def count_colors(
+        pathname,
+        max_memory=None,
+        cache=True):
+    """
+    Return the unique packed colors present in the RGB(A) or palette
+    raster pointed to by *pathname*, sorted, and their number of
+    occurrences
+
+    Transparent and no-data cells are not counted. In case *cache* is
+    True, the counts are cached in a sidecar file (see
+    :func:`color_counts_pathname`), so requesting subsequent pages of the
+    colors does not read the raster again.
+    """
+    assert os.path.exists(pathname)
+
+    cache_pathname = color_counts_pathname(pathname)
+    mtime = os.path.getmtime(pathname)
+
+    if cache and os.path.exists(cache_pathname):
+        with numpy.load(cache_pathname) as arrays:
+            if float(arrays["mtime"]) == mtime:
+                return arrays["colors"], arrays["counts"]
+
+    color_counts = []
+
+    with rasterio.open(pathname) as raster:
 
-    colors = set()
+        palette = raster_palette(raster)
+        plan = plan_execution("retrieve_colors", raster.shape,
+            retrieve_colors_bytes_per_cell, max_memory)
 
-    for row in range(nr_rows):
-        for r, g, b in zip(red_band[row], green_band[row], blue_band[row]):
-            colors.add((int(r), int(g), int(b)))
+        for window in plan.windows():
+            color_counts.append(_count_colors(raster, palette, window))
 
-    return list(colors)
+    colors, counts = _merge_color_counts(*zip(*color_counts))
+    colors = colors[counts > 0]
+    counts = counts[counts > 0].astype(numpy.int64)
 
+    if cache:
+        # Write atomically, so concurrent readers never see a partial file
+        temporary_pathname = "{}.{}.tmp.npz".format(
+            os.path.splitext(cache_pathname)[0], os.getpid())
+        numpy.savez(temporary_pathname, colors=colors, counts=counts,
+            mtime=mtime)
+        os.replace(temporary_pathname, cache_pathname)
 
+    return colors, counts
 
 
 def _classify_raster(
         raster_pathname,
         lut,
-        classified_raster_pathname):
+        classified_raster_pathname,
+        color_table=False,
+        window=None,
+        cancellation_token=None,
+        max_memory=None,
+        max_color_distance=None):
+    """
+    Classify the RGBA or palette raster pointed to by *raster_pathname*
+    using *lut*
+
+    The result is stored using the smallest data type able to represent
+    all class ids in the LUT, and is written tiled and compressed. Pass
+    *color_table* as True to embed a color table derived from the LUT, or
+    as a dict mapping class ids to RGBA tuples to embed that table.
+
+    In case *window* is passed, only that part of the raster is
+    classified. The result then covers only the window.
+
+    In case *max_memory* is passed, the raster is processed window by
+    window if processing it at once does not fit in this number of bytes.
+
+    In case *max_color_distance* is passed, colors not present in the LUT
+    are assigned the class of the nearest color in the LUT, if that color
+    is within this (Euclidean RGB) distance. This handles anti-aliased and
+    compression-degraded colors.
+
+    In case *cancellation_token* is passed, it is checked between windows.
+    Cancelled is raised once it is cancelled.
+    """
+
+    lookup = lut if isinstance(lut, ColorLookup) else \
+        ColorLookup.from_lut(lut)
+
+    if max_color_distance is not None:
+        lookup = NearestColorLookup(
+            lookup.colors, lookup.classes, max_color_distance)
+        bytes_per_cell = nearest_color_bytes_per_cell
+    else:
+        bytes_per_cell = classify_raster_bytes_per_cell
+
+    dtype, nodata = classification_dtype(lookup.classes)
 
-    # The raster contains four bands: RGBA.
+    if color_table is True:
+        color_table = lookup.color_table()
+
+    if color_table and dtype not in [numpy.uint8, numpy.uint16]:
+        raise RuntimeError(
+            "Color tables require class ids in range [0, 65535)")
+
+    # The raster contains four bands (RGBA), or a single band of palette
+    # indices.
     with rasterio.open(raster_pathname) as raster_dataset:
 
         profile = raster_dataset.profile
-        assert profile["count"] == 4
+        palette = raster_palette(raster_dataset)
+        assert profile["count"] == 4 or palette is not None
 
-        r, g, b, _ = raster_dataset.read()
-        mask = raster_dataset.dataset_mask()
+        if palette is not None:
+            # Classify the palette entries once, instead of each cell
+            class_by_index = lookup.classify(
+                palette[:, 0], palette[:, 1], palette[:, 2], nodata, dtype)
 
-        dtype = numpy.int32
         profile.update(count=1)
         profile.update(dtype=dtype)
+        profile.update(nodata=nodata)
+        profile.update(
+            tiled=True,
+            blockxsize=classified_raster_block_size,
+            blockysize=classified_raster_block_size,
+            compress="deflate")
+        profile = sparse_profile(profile)
+
+        if window is None:
+            row_offset, col_offset = 0, 0
+        else:
+            (row_offset, row_stop), (col_offset, col_stop) = window
+            profile.update(
+                height=row_stop - row_offset,
+                width=col_stop - col_offset,
+                transform=raster_dataset.window_transform(window))
+
+        plan = plan_execution("classify_raster",
+            (profile["height"], profile["width"]),
+            bytes_per_cell if palette is None else
+                palette_bytes_per_cell, max_memory,
+            alignment=classified_raster_block_size)
+
+        with rasterio.open(classified_raster_pathname, "w", **profile) as \
+                classified_raster_dataset:
 
-        classes = numpy.asarray(r, dtype=dtype)
-        assert classes is not r  # Must be a copy
+            for block in plan.windows():
 
-        nr_rows = len(classes)
-        nr_cols = len(classes[0])
-        nodata = -999
+                if cancellation_token is not None:
+                    cancellation_token.raise_if_cancelled()
 
+                # Corresponding window in the raster being classified
+                (row_start, row_stop), (col_start, col_stop) = block
+                window = (
+                    (row_start + row_offset, row_stop + row_offset),
+                    (col_start + col_offset, col_stop + col_offset))
 
-        for row in range(nr_rows):
-            for col in range(nr_cols):
-                if mask[row][col] == 0:
-                    classes[row][col] = nodata
+                valid = raster_dataset.dataset_mask(window=window) != 0
+
+                # Colors without a class associated with them are masked
+                # out. The other bands of fully masked windows (e.g.
+                # transparent margins) are not read.
+                if not valid.any():
+                    classes = numpy.full(valid.shape, nodata, dtype=dtype)
+                elif palette is None:
+                    r, g, b = raster_dataset.read([1, 2, 3], window=window)
+                    classes = lookup.classify(r, g, b, nodata, dtype)
                 else:
-                    color = (r[row][col], g[row][col], b[row][col])
+                    classes = class_by_index[
+                        raster_dataset.read(1, window=window)]
 
-                    if color in lut:
-                        classes[row][col] = lut[color]
-                    else:
-                        # No class associated with this color. Mask it out.
-                        classes[row][col] = nodata
+                classes[~valid] = nodata
 
+                # Fully masked blocks are not written
+                write_valid_blocks(classified_raster_dataset,
+                    classes[numpy.newaxis], valid, block)
 
-        with rasterio.open(classified_raster_pathname, "w", **profile) as \
-                classified_raster_dataset:
-            classified_raster_dataset.nodata = nodata
-            classified_raster_dataset.write(classes, 1)
+            if color_table:
+                color_table = dict(color_table)
+                color_table[nodata] = (0, 0, 0, 0)
+                classified_raster_dataset.write_colormap(1, color_table)
 
 
 def classify_raster(
@@ -320,33 +908,85 @@ def classify_raster(
         geoserver_uri,
         geoserver_user,
         geoserver_password,
-        workspace_name):
+        workspace_name,
+        color_table=False,
+        idempotency_key=None,
+        cancellation_token=None,
+        max_memory=None,
+        max_color_distance=None):
         # layer_name):
     """
     Classify a raster
+
+    In case *idempotency_key* is passed, the classified raster is marked
+    as such, and classification is skipped when it is requested again
+    using the same key.
+
+    In case *cancellation_token* is passed, classification stops once the
+    token is cancelled, without leaving a partial result behind, and
+    Cancelled is raised.
+
+    *max_memory* is the memory budget of classifying the raster, in bytes.
+
+    In case *max_color_distance* is passed, colors are assigned the class
+    of the nearest color in the LUT within this distance.
     """
 
     assert os.path.exists(pathname), pathname
 
-    result_pathname = "{}_classified{}".format(
-        *os.path.splitext(pathname))
+    result_pathname = classified_raster_pathname(pathname)
 
-    _classify_raster(pathname, lut, result_pathname)
+    if idempotency_key is None or \
+            not stage_completed(result_pathname, idempotency_key):
+
+        with atomic_pathname(result_pathname) as temporary_pathname:
+            _classify_raster(pathname, lut, temporary_pathname,
+                color_table=color_table,
+                cancellation_token=cancellation_token,
+                max_memory=max_memory,
+                max_color_distance=max_color_distance)
+
+            if idempotency_key is not None:
+                mark_stage_completed(temporary_pathname, idempotency_key)
 
     assert os.path.exists(pathname)
     assert os.path.exists(result_pathname)
 
+    publish_classified_raster(
+        pathname,
+        result_pathname,
+        geoserver_uri=geoserver_uri,
+        geoserver_user=geoserver_user,
+        geoserver_password=geoserver_password,
+        workspace_name=workspace_name)
+
+    return result_pathname
+
+
+def classified_raster_pathname(
+        pathname):
+
+    return "{}_classified{}".format(*os.path.splitext(pathname))
+
+
+def publish_classified_raster(
+        pathname,
+        result_pathname,
+        geoserver_uri,
+        geoserver_user,
+        geoserver_password,
+        workspace_name):
+    """
+    Replace the raster pointed to by *pathname* by its classified version
+    in the WMS layer
+    """
 
     # Recreate the coverage store to simulate refresh of the WMS layer.
     catalog = Catalog(geoserver_uri, geoserver_user, geoserver_password)
     workspace = catalog.get_workspace(workspace_name)
     coverage_name = os.path.splitext(os.path.basename(pathname))[0]
 
-    delete_store(catalog, workspace, coverage_name)
-    catalog.create_coveragestore_external_geotiff(coverage_name,
-        "file://{}".format(result_pathname), workspace)
-
-    return result_pathname
+    recreate_store(catalog, workspace, coverage_name, result_pathname)
 
 
 
@@ -0,0 +1,61 @@
+import numpy
+import rasterio
+from affine import Affine
+from .stages import add_completed_stage
+
+
+def fit_affine_transform(
+        gcps):
+    """
+    Fit an affine transformation to ground control points, using least
+    squares
+
+    gcps: Collection of ((pixel, line), (x, y)) pairs
+
+    Returns the transformation, mapping pixel / line coordinates to world
+    coordinates, and the distances between the world coordinates of the
+    GCPs and the ones obtained by transforming their pixel / line
+    coordinates.
+    """
+    if len(gcps) < 3:
+        raise RuntimeError(
+            "At least 3 GCPs are needed to fit an affine transformation")
+
+    pixels = numpy.array([gcp[0] for gcp in gcps], dtype=numpy.float64)
+    world = numpy.array([gcp[1] for gcp in gcps], dtype=numpy.float64)
+
+    design = numpy.column_stack([pixels, numpy.ones(len(pixels))])
+    coefficients, _, rank, _ = numpy.linalg.lstsq(design, world, rcond=-1)
+
+    if rank < 3:
+        raise RuntimeError("GCPs must not be collinear")
+
+    (a, d), (b, e), (c, f) = coefficients
+    transform = Affine(a, b, c, d, e, f)
+
+    differences = design.dot(coefficients) - world
+    residuals = numpy.hypot(differences[:, 0], differences[:, 1])
+
+    return transform, residuals
+
+
+def update_georeference(
+        pathname,
+        transform,
+        crs,
+        idempotency_key=None):
+    """
+    Update the transformation and coordinate reference system of the
+    raster pointed to by *pathname*, in place
+
+    Only the header is updated. Cell values are not read or written. In
+    case *idempotency_key* is passed, the update is marked as completed
+    in the same session, so a crash never leaves an updated header
+    without the mark.
+    """
+    with rasterio.open(pathname, "r+") as raster:
+        raster.transform = transform
+        raster.crs = crs
+
+        if idempotency_key is not None:
+            add_completed_stage(raster, idempotency_key)
@@ -0,0 +1,119 @@
+import os
+import os.path
+import time
+import uuid
+
+
+class Cancelled(Exception):
+    """
+    Raised by operations which notice their job has been cancelled
+    """
+    pass
+
+
+class CancellationToken(object):
+    """
+    Token passed to long running operations, which check it between
+    steps (e.g. between blocks) and stop early once it is cancelled
+    """
+
+    # Seconds between checks of operations which wait for something else,
+    # like a subprocess
+    check_interval = 1.0
+
+
+    def __init__(self):
+        self._cancelled = False
+
+
+    def cancel(self):
+        self._cancelled = True
+
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise Cancelled()
+
+
+class SupersedingCancellationToken(CancellationToken):
+    """
+    Token of a job on a raster, which is cancelled when a newer job
+    performing the same stage on the same raster starts
+
+    Jobs register themselves in a file next to the raster, named after
+    the stage. Since the file is shared by all workers, a job started by
+    any worker supersedes the jobs started earlier. Jobs are ordered by
+    the *timestamp* passed in (e.g. the timestamp of the message which
+    triggered the job). A job older than the registered one is cancelled
+    right away.
+
+    Checking whether the token is cancelled involves reading the file. To
+    keep the overhead low, this is done at most once per
+    *check_interval* seconds.
+    """
+
+    def __init__(self,
+            pathname,
+            stage,
+            timestamp,
+            check_interval=1.0):
+
+        CancellationToken.__init__(self)
+        self.registry_pathname = "{}.{}.job".format(
+            os.path.splitext(pathname)[0], stage)
+        self.job_id = uuid.uuid4().hex
+        self.timestamp = timestamp
+        self.check_interval = check_interval
+        self.last_check = time.time()
+
+        registered = self._read_registry()
+
+        if registered is not None and registered[0] > timestamp:
+            # A newer job has already been started
+            self._cancelled = True
+        else:
+            temporary_pathname = "{}.{}".format(
+                self.registry_pathname, self.job_id)
+
+            with open(temporary_pathname, "w") as file:
+                file.write("{} {}".format(timestamp, self.job_id))
+
+            os.replace(temporary_pathname, self.registry_pathname)
+
+
+    def _read_registry(self):
+        try:
+            with open(self.registry_pathname) as file:
+                timestamp, job_id = file.read().split()
+        except (FileNotFoundError, ValueError):
+            return None
+
+        return float(timestamp), job_id
+
+
+    @property
+    def cancelled(self):
+
+        if not self._cancelled and \
+                time.time() - self.last_check >= self.check_interval:
+            self.last_check = time.time()
+            registered = self._read_registry()
+            self._cancelled = \
+                registered is not None and registered[1] != self.job_id
+
+        return self._cancelled
+
+
+    def release(self):
+        """
+        Unregister the job, if it is still the registered one
+        """
+        registered = self._read_registry()
+
+        if registered is not None and registered[1] == self.job_id:
+            os.remove(self.registry_pathname)
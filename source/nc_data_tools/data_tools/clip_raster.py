@@ -1,32 +1,196 @@
+import math
+import numpy
 import rasterio
 import rasterio.warp as warp
+from .driver import open_output_raster, output_profile
+from .memory_budget import plan_execution
+from .sparse import sparse_profile, write_valid_blocks
+
+
+# Number of cells added around source windows read for resampling, to
+# allow resampling methods to look at neighbouring cells
+clip_margin = 2
+
+
+def rasters_align(
+        large_raster,
+        small_raster):
+    """
+    Return whether the grid of the small raster is a subset of the grid
+    of the large raster: same CRS, same cell size, cell borders
+    coinciding, and contained in the large raster
+    """
+    large = large_raster.affine
+    small = small_raster.affine
+
+    if large_raster.crs != small_raster.crs or \
+            not numpy.allclose([large.a, large.e], [small.a, small.e]) or \
+            large.b != 0 or large.d != 0 or small.b != 0 or small.d != 0:
+        return False
+
+    col_offset = (small.c - large.c) / large.a
+    row_offset = (small.f - large.f) / large.e
+
+    return \
+        numpy.isclose(col_offset, round(col_offset)) and \
+        numpy.isclose(row_offset, round(row_offset)) and \
+        round(col_offset) >= 0 and round(row_offset) >= 0 and \
+        round(col_offset) + small_raster.width <= large_raster.width and \
+        round(row_offset) + small_raster.height <= large_raster.height
 
 
 def clip_raster(
         large_raster_pathname,
         small_raster_pathname,
-        clipped_raster_pathname):
+        clipped_raster_pathname,
+        max_memory=None,
+        resampling_method=warp.RESAMPLING.nearest):
+    """
+    Cookie-cut the large raster with the small raster
 
-    # Cookie-cut large raster with small raster
+    The clipped raster gets the grid (CRS, extent and cell size) of the
+    small raster. In case the grids of both rasters align, cells are
+    copied. Otherwise, for each window of the clipped raster, only the
+    window of the large raster covering it is read, and resampled onto
+    the clipped raster's grid using *resampling_method*.
+    """
     with rasterio.open(large_raster_pathname) as large_raster, \
             rasterio.open(small_raster_pathname) as small_raster:
 
-        # It is assumed here that the rasters align which each other
-        assert large_raster.crs == small_raster.crs
-
-        # Determine extent in cell indices of small raster in large raster
-        extent = small_raster.bounds
-        window = large_raster.window(*extent)
-
-        # Adjust the profile of the large raster wrt extent of the small
-        # raster
-        profile = large_raster.meta.copy()
-        profile.update({
-            "height": window[0][1] - window[0][0],
-            "width": window[1][1] - window[1][0],
-            "transform": small_raster.transform,
-        })
-
-        with rasterio.open(clipped_raster_pathname, "w", **profile) as \
-                clipped_raster:
-            clipped_raster.write(large_raster.read(window=window))
+        if rasters_align(large_raster, small_raster):
+            _copy_window(large_raster, small_raster,
+                clipped_raster_pathname, max_memory)
+        else:
+            _resample_window(large_raster, small_raster,
+                clipped_raster_pathname, max_memory, resampling_method)
+
+
+def _copy_window(
+        large_raster,
+        small_raster,
+        clipped_raster_pathname,
+        max_memory):
+
+    # Determine extent in cell indices of small raster in large raster
+    extent = small_raster.bounds
+    window = large_raster.window(*extent)
+
+    # Adjust the profile of the large raster wrt extent of the small
+    # raster
+    profile = sparse_profile(
+        output_profile(large_raster.meta, clipped_raster_pathname))
+    profile.update({
+        "height": window[0][1] - window[0][0],
+        "width": window[1][1] - window[1][0],
+        "transform": small_raster.transform,
+    })
+
+    plan = plan_execution("clip_raster",
+        (profile["height"], profile["width"]),
+        profile["count"] * numpy.dtype(profile["dtype"]).itemsize,
+        max_memory)
+    (row_offset, _), (col_offset, _) = window
+    nodata = profile["nodata"]
+
+    with open_output_raster(clipped_raster_pathname, profile) as \
+            clipped_raster:
+
+        for block in plan.windows():
+            (row_start, row_stop), (col_start, col_stop) = block
+            cells = large_raster.read(window=(
+                (row_start + row_offset, row_stop + row_offset),
+                (col_start + col_offset, col_stop + col_offset)))
+            valid = None if nodata is None else \
+                numpy.any(cells != nodata, axis=0)
+            write_valid_blocks(clipped_raster, cells, valid, block)
+
+
+def _source_window(
+        large_raster,
+        crs,
+        bounds):
+    """
+    Return the window of the large raster covering *bounds*, in *crs*,
+    extended by a margin and limited to the raster, or None if the
+    bounds do not overlap the raster
+    """
+    left, bottom, right, top = warp.transform_bounds(
+        crs, large_raster.crs, *bounds)
+    inverse = ~large_raster.affine
+    cols, rows = zip(*[inverse * (x, y) for x, y in
+        [(left, bottom), (left, top), (right, bottom), (right, top)]])
+
+    row_start = max(0, int(math.floor(min(rows))) - clip_margin)
+    row_stop = min(large_raster.height,
+        int(math.ceil(max(rows))) + clip_margin)
+    col_start = max(0, int(math.floor(min(cols))) - clip_margin)
+    col_stop = min(large_raster.width,
+        int(math.ceil(max(cols))) + clip_margin)
+
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+
+    return (row_start, row_stop), (col_start, col_stop)
+
+
+def _resample_window(
+        large_raster,
+        small_raster,
+        clipped_raster_pathname,
+        max_memory,
+        resampling_method):
+
+    profile = sparse_profile(
+        output_profile(large_raster.meta, clipped_raster_pathname))
+    profile.update({
+        "crs": small_raster.crs,
+        "transform": small_raster.transform,
+        "height": small_raster.height,
+        "width": small_raster.width,
+    })
+    nodata = profile["nodata"]
+    dtype = numpy.dtype(profile["dtype"])
+
+    # Memory use per clipped cell includes the source cells read to
+    # resample it
+    window = _source_window(large_raster, small_raster.crs,
+        small_raster.bounds)
+    nr_source_cells = 0 if window is None else \
+        (window[0][1] - window[0][0]) * (window[1][1] - window[1][0])
+    nr_source_cells_per_cell = max(1.0, nr_source_cells / (
+        small_raster.height * small_raster.width))
+    plan = plan_execution("clip_raster",
+        (profile["height"], profile["width"]),
+        profile["count"] * dtype.itemsize * (1 + nr_source_cells_per_cell),
+        max_memory)
+
+    with open_output_raster(clipped_raster_pathname, profile) as \
+            clipped_raster:
+
+        for block in plan.windows():
+            (row_start, row_stop), (col_start, col_stop) = block
+            destination = numpy.full(
+                (profile["count"], row_stop - row_start, col_stop - col_start),
+                nodata if nodata is not None else 0, dtype=dtype)
+            window = _source_window(large_raster, small_raster.crs,
+                clipped_raster.window_bounds(block))
+
+            if window is not None:
+                source = large_raster.read(window=window)
+
+                for b in range(profile["count"]):
+                    warp.reproject(
+                        source=source[b],
+                        destination=destination[b],
+                        src_transform=large_raster.window_transform(window),
+                        src_crs=large_raster.crs,
+                        src_nodata=nodata,
+                        dst_transform=clipped_raster.window_transform(block),
+                        dst_crs=small_raster.crs,
+                        dst_nodata=nodata,
+                        resampling=resampling_method)
+
+            # Blocks not overlapping the large raster are not written
+            valid = None if nodata is None else \
+                numpy.any(destination != nodata, axis=0)
+            write_valid_blocks(clipped_raster, destination, valid, block)
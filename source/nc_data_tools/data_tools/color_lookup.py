@@ -0,0 +1,424 @@
+import ast
+import base64
+import itertools
+import numpy
+
+
+def pack_colors(
+        red,
+        green,
+        blue):
+    """
+    Pack 8-bit red, green and blue components into one uint32 per color
+    """
+    return \
+        (numpy.asarray(red, dtype=numpy.uint32) << 16) | \
+        (numpy.asarray(green, dtype=numpy.uint32) << 8) | \
+        numpy.asarray(blue, dtype=numpy.uint32)
+
+
+def unpack_colors(
+        colors):
+    """
+    Unpack uint32 colors into their red, green and blue components
+    """
+    colors = numpy.asarray(colors, dtype=numpy.uint32)
+
+    return \
+        ((colors >> 16) & 0xFF).astype(numpy.uint8), \
+        ((colors >> 8) & 0xFF).astype(numpy.uint8), \
+        (colors & 0xFF).astype(numpy.uint8)
+
+
+def parse_lut(
+        lut):
+    """
+    Return the LUT passed in, as received in messages, with its keys
+    converted from strings to (r, g, b) tuples
+
+    E.g.: {"(0, 127, 0)": 2, "(0, 0, 0)": 3}
+    """
+    return {ast.literal_eval(key): value for key, value in lut.items()}
+
+
+def encode_lut(
+        lut):
+    """
+    Return the compact encoding of the LUT passed in (a dict mapping
+    (r, g, b) tuples to class ids), for use in messages
+
+    Colors are packed into one uint32 per color, and class ids stored as
+    int32. Both arrays are stored little-endian and base64-encoded.
+    """
+    lookup = ColorLookup.from_lut(lut)
+
+    return {
+        "encoding": "base64",
+        "colors": base64.b64encode(
+            lookup.colors.astype("<u4").tobytes()).decode("ascii"),
+        "classes": base64.b64encode(
+            lookup.classes.astype("<i4").tobytes()).decode("ascii"),
+    }
+
+
+def decode_lut(
+        lut):
+    """
+    Return a ColorLookup for the LUT passed in, as received in messages
+
+    The LUT can be encoded in one of these ways:
+
+    - A dict mapping stringified (r, g, b) tuples to class ids. E.g.:
+      {"(0, 127, 0)": 2, "(0, 0, 0)": 3}
+    - Parallel arrays of colors and class ids. Colors are packed (see
+      :func:`pack_colors`) or (r, g, b) triples. E.g.:
+      {"colors": [32512, 0], "classes": [2, 3]}
+    - Base64-encoded little-endian arrays of packed uint32 colors and
+      int32 class ids (see :func:`encode_lut`). E.g.:
+      {"encoding": "base64", "colors": "AH8AAAAAAAA=", "classes":
+      "AgAAAAMAAAA="}
+
+    The compact encodings are converted to the lookup's arrays directly,
+    without creating a dict.
+    """
+    if "colors" not in lut:
+        return ColorLookup.from_lut(parse_lut(lut))
+
+    encoding = lut.get("encoding")
+
+    if encoding == "base64":
+        colors = numpy.frombuffer(
+            base64.b64decode(lut["colors"]), dtype="<u4")
+        classes = numpy.frombuffer(
+            base64.b64decode(lut["classes"]), dtype="<i4")
+    else:
+        assert encoding is None, encoding
+        colors = numpy.asarray(lut["colors"], dtype=numpy.uint32)
+        classes = lut["classes"]
+
+        if colors.ndim == 2:
+            colors = pack_colors(colors[:, 0], colors[:, 1], colors[:, 2])
+
+    return ColorLookup(colors.reshape(-1), classes)
+
+
+def parse_color_table(
+        color_table):
+    """
+    Return the color table passed in, as received in messages, with its
+    keys converted from strings to class ids
+
+    Boolean values, indicating whether or not to derive a color table
+    from the LUT, are returned as-is.
+    """
+    if isinstance(color_table, dict):
+        color_table = {int(key): tuple(value) for key, value in
+            color_table.items()}
+
+    return color_table
+
+
+def classification_dtype(
+        classes):
+    """
+    Return the smallest dtype able to store the class ids in *classes*,
+    together with a no-data value which does not collide with any of them
+    """
+    classes = numpy.asarray(classes)
+
+    if len(classes) == 0:
+        return numpy.uint8, 255
+
+    min_class = classes.min()
+    max_class = classes.max()
+
+    if min_class >= 0 and max_class < 255:
+        return numpy.uint8, 255
+    elif min_class >= 0 and max_class < 65535:
+        return numpy.uint16, 65535
+    else:
+        return numpy.int32, -999
+
+
+class ColorLookup(object):
+    """
+    Vectorized lookup of class ids by RGB color
+
+    Colors are stored packed and sorted, which allows all cells of a block
+    to be classified with a single binary search.
+    """
+
+    def __init__(self,
+            colors,
+            classes):
+
+        colors = numpy.asarray(colors, dtype=numpy.uint32)
+        classes = numpy.asarray(classes, dtype=numpy.int64)
+        assert colors.shape == classes.shape, (colors.shape, classes.shape)
+
+        order = numpy.argsort(colors, kind="mergesort")
+        self.colors = colors[order]
+        self.classes = classes[order]
+
+
+    @classmethod
+    def from_lut(cls,
+            lut):
+        """
+        Create a lookup from a dict mapping (r, g, b) tuples to class ids
+        """
+        if len(lut) == 0:
+            return cls([], [])
+
+        red, green, blue = zip(*lut.keys())
+
+        return cls(pack_colors(red, green, blue), list(lut.values()))
+
+
+    def __len__(self):
+        return len(self.colors)
+
+
+    def classify(self,
+            red,
+            green,
+            blue,
+            nodata,
+            dtype):
+        """
+        Return the class ids of the colors passed in
+
+        Colors not present in the lookup are assigned *nodata*.
+        """
+        colors = pack_colors(red, green, blue)
+        classes = numpy.full(colors.shape, nodata, dtype=dtype)
+
+        if len(self.colors) > 0:
+            index = numpy.searchsorted(self.colors, colors)
+            index[index == len(self.colors)] = 0
+            found = self.colors[index] == colors
+            classes[found] = self.classes[index[found]]
+
+        return classes
+
+
+    def color_table(self):
+        """
+        Return a color table mapping each class id to the first color,
+        in packed order, associated with it
+
+        The color table can be embedded in a classified raster, allowing
+        clients to render the classes without additional styling.
+        """
+        red, green, blue = unpack_colors(self.colors)
+        table = {}
+
+        for class_, r, g, b in zip(self.classes, red, green, blue):
+            table.setdefault(int(class_), (int(r), int(g), int(b), 255))
+
+        return table
+
+
+class NearestColorLookup(ColorLookup):
+    """
+    Vectorized lookup of class ids by RGB color, assigning each color to
+    the class of the nearest color in the lookup, if that color is within
+    *max_distance* (Euclidean distance in RGB space)
+
+    Only the unique colors of a block are looked up. Colors are first
+    matched exactly. The colors in the lookup are bucketed in a color
+    cube, with buckets at least *max_distance* wide. The remaining colors
+    are compared with the colors in their own and the neighbouring
+    buckets only. Colors resolved this way are cached, so colors
+    recurring in subsequent blocks are matched exactly. Once the cache
+    holds *max_resolved_colors* colors, it is cleared.
+    """
+
+    # Minimum width of the buckets of the color cube, limiting the number
+    # of buckets for small distances
+    min_bucket_width = 8
+
+    # Maximum number of colors resolved before which are cached, including
+    # the colors in the lookup
+    max_resolved_colors = 1024 * 1024
+
+
+    def __init__(self,
+            colors,
+            classes,
+            max_distance):
+
+        ColorLookup.__init__(self, colors, classes)
+        self.max_distance = max_distance
+
+        # Colors resolved before, sorted, with the class of their nearest
+        # color, or -1 if no color is near enough
+        self.resolved_colors = self.colors
+        self.resolved_classes = self.classes
+        self.resolved_found = numpy.ones(len(self.colors), dtype=bool)
+
+        red, green, blue = unpack_colors(self.colors)
+        self.components = numpy.stack([red, green, blue], axis=1).astype(
+            numpy.int32)
+
+        # Color cube. Colors within max_distance of each other are in the
+        # same or in neighbouring buckets. The indices of the colors in
+        # each bucket are stored contiguously, in bucket order.
+        self.bucket_width = max(
+            self.min_bucket_width, int(numpy.ceil(max_distance)))
+        self.nr_buckets = 255 // self.bucket_width + 1
+        buckets = self._bucket(self.components // self.bucket_width)
+        self.bucket_colors = numpy.argsort(buckets, kind="mergesort")
+        counts = numpy.bincount(buckets, minlength=self.nr_buckets ** 3)
+        self.bucket_starts = numpy.concatenate([[0], numpy.cumsum(counts)])
+
+
+    @classmethod
+    def from_lut(cls,
+            lut,
+            max_distance):
+        """
+        Create a lookup from a dict mapping (r, g, b) tuples to class ids
+        """
+        if len(lut) == 0:
+            return cls([], [], max_distance)
+
+        red, green, blue = zip(*lut.keys())
+
+        return cls(pack_colors(red, green, blue), list(lut.values()),
+            max_distance)
+
+
+    def _bucket(self,
+            cells):
+        """
+        Return the ids of the buckets of the color cube at (r, g, b)
+        *cells*
+        """
+        return (cells[:, 0] * self.nr_buckets + cells[:, 1]) * \
+            self.nr_buckets + cells[:, 2]
+
+
+    def _nearest(self,
+            colors):
+        """
+        Return the classes of the colors in the lookup nearest to the
+        packed *colors*, and whether they are near enough
+        """
+        classes = numpy.zeros(len(colors), dtype=numpy.int64)
+        found = numpy.zeros(len(colors), dtype=bool)
+
+        if len(self.colors) == 0:
+            return classes, found
+
+        red, green, blue = unpack_colors(colors)
+        components = numpy.stack([red, green, blue], axis=1).astype(
+            numpy.int32)
+        cells = components // self.bucket_width
+
+        # Index in the lookup of the nearest color found, and its squared
+        # distance
+        nearest = numpy.zeros(len(colors), dtype=numpy.int64)
+        nearest_distances = numpy.full(
+            len(colors), numpy.iinfo(numpy.int32).max, dtype=numpy.int64)
+
+        for offset in itertools.product([-1, 0, 1], repeat=3):
+            neighbours = cells + offset
+            valid = numpy.all(
+                (neighbours >= 0) & (neighbours < self.nr_buckets), axis=1)
+            neighbours = self._bucket(neighbours[valid])
+            starts = self.bucket_starts[neighbours]
+            counts = self.bucket_starts[neighbours + 1] - starts
+            candidates = numpy.flatnonzero(valid)
+
+            # Compare with the k-th color of each bucket, for all colors
+            # at once
+            for k in range(counts.max() if len(counts) > 0 else 0):
+                in_bucket = counts > k
+                index = self.bucket_colors[starts[in_bucket] + k]
+                color_index = candidates[in_bucket]
+                differences = components[color_index] - \
+                    self.components[index]
+                distances = numpy.einsum(
+                    "ij,ij->i", differences, differences)
+
+                # Prefer the first color in the lookup in case of ties,
+                # like a search over all colors would
+                nearer = (distances < nearest_distances[color_index]) | (
+                    (distances == nearest_distances[color_index]) &
+                    (index < nearest[color_index]))
+                nearest[color_index[nearer]] = index[nearer]
+                nearest_distances[color_index[nearer]] = distances[nearer]
+
+        classes[:] = self.classes[nearest]
+        found[:] = nearest_distances <= self.max_distance ** 2
+
+        return classes, found
+
+
+    def _resolve(self,
+            colors):
+        """
+        Return the classes of the sorted, unique, packed *colors*, and
+        whether a color near enough was found
+        """
+        if len(self.resolved_colors) > 0:
+            index = numpy.searchsorted(self.resolved_colors, colors)
+            index[index == len(self.resolved_colors)] = 0
+            cached = self.resolved_colors[index] == colors
+        else:
+            index = numpy.zeros(len(colors), dtype=numpy.int64)
+            cached = numpy.zeros(len(colors), dtype=bool)
+
+        classes = numpy.zeros(len(colors), dtype=numpy.int64)
+        found = numpy.zeros(len(colors), dtype=bool)
+        classes[cached] = self.resolved_classes[index[cached]]
+        found[cached] = self.resolved_found[index[cached]]
+
+        new_colors = colors[~cached]
+
+        if len(new_colors) > 0:
+            new_classes, new_found = self._nearest(new_colors)
+            classes[~cached] = new_classes
+            found[~cached] = new_found
+
+            if len(self.resolved_colors) + len(new_colors) > \
+                    self.max_resolved_colors:
+                self.resolved_colors = self.colors
+                self.resolved_classes = self.classes
+                self.resolved_found = numpy.ones(len(self.colors), dtype=bool)
+
+            # Merge the new colors into the cache. Both are sorted, and
+            # the new colors are not in the cache, so inserting them keeps
+            # the cache sorted.
+            index = numpy.searchsorted(self.resolved_colors, new_colors)
+            self.resolved_colors = numpy.insert(
+                self.resolved_colors, index, new_colors)
+            self.resolved_classes = numpy.insert(
+                self.resolved_classes, index, new_classes)
+            self.resolved_found = numpy.insert(
+                self.resolved_found, index, new_found)
+
+        return classes, found
+
+
+    def classify(self,
+            red,
+            green,
+            blue,
+            nodata,
+            dtype):
+        """
+        Return the class ids of the colors passed in
+
+        Colors without a color in the lookup near enough are assigned
+        *nodata*.
+        """
+        colors = pack_colors(red, green, blue)
+        unique_colors, inverse = numpy.unique(colors, return_inverse=True)
+        unique_classes, found = self._resolve(unique_colors)
+
+        classes = numpy.full(len(unique_colors), nodata, dtype=dtype)
+        classes[found] = unique_classes[found]
+
+        return classes[inverse].reshape(colors.shape)
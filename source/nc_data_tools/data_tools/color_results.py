@@ -0,0 +1,118 @@
+import base64
+import json
+import numpy
+from .color_lookup import unpack_colors
+
+
+# Formats in which colors can be sent to clients
+color_formats = ["list", "uint32", "hex", "base64"]
+
+
+def encode_colors(
+        colors,
+        color_format):
+    """
+    Encode the packed colors passed in
+
+    - list: List of [r, g, b] lists
+    - uint32: List of packed colors (0xRRGGBB)
+    - hex: String of concatenated RRGGBB hexadecimal colors
+    - base64: Base64-encoded little-endian uint32 packed colors
+    """
+    colors = numpy.asarray(colors, dtype=numpy.uint32)
+
+    if color_format == "list":
+        return numpy.stack(unpack_colors(colors), axis=1).tolist()
+    elif color_format == "uint32":
+        return colors.tolist()
+    elif color_format == "hex":
+        return base64.b16encode(numpy.stack(unpack_colors(colors),
+            axis=1).tobytes()).decode("ascii").lower()
+    elif color_format == "base64":
+        return base64.b64encode(colors.astype("<u4").tobytes()).decode(
+            "ascii")
+
+    raise ValueError("Unsupported color format: {}".format(color_format))
+
+
+def encode_counts(
+        counts,
+        color_format):
+    """
+    Encode the color counts passed in: as base64-encoded little-endian
+    uint64 counts when *color_format* is base64, as a list otherwise
+    """
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+
+    if color_format == "base64":
+        return base64.b64encode(counts.astype("<u8").tobytes()).decode(
+            "ascii")
+
+    return counts.tolist()
+
+
+def encode_continuation(
+        options):
+    """
+    Return an opaque token, to be passed back by clients to request the
+    next page of colors
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(options, sort_keys=True).encode("utf-8")).decode("ascii")
+
+
+def decode_continuation(
+        token):
+    """
+    Return the options encoded in a continuation token
+    """
+    return json.loads(base64.urlsafe_b64decode(
+        token.encode("ascii")).decode("utf-8"))
+
+
+def color_page(
+        colors,
+        counts,
+        color_format="list",
+        sort="color",
+        offset=0,
+        page_size=None):
+    """
+    Return a page of the colors passed in, with their counts, as a dict to
+    send to clients
+
+    The colors passed in are sorted by packed value, as returned by
+    :func:`count_colors`. In case *sort* is frequency, they are sorted by
+    decreasing count instead. In case *page_size* is passed, at most
+    this number of colors, starting at *offset*, are returned. If more
+    colors follow, the result contains a continuation token for
+    requesting the next page.
+    """
+    assert sort in ["color", "frequency"], sort
+
+    colors = numpy.asarray(colors, dtype=numpy.uint32)
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+
+    if sort == "frequency":
+        order = numpy.lexsort((colors, -counts))
+        colors, counts = colors[order], counts[order]
+
+    stop = len(colors) if page_size is None else \
+        min(offset + page_size, len(colors))
+    result = {
+        "colors": encode_colors(colors[offset:stop], color_format),
+        "counts": encode_counts(counts[offset:stop], color_format),
+        "color_format": color_format,
+        "nr_colors": len(colors),
+        "offset": offset,
+    }
+
+    if stop < len(colors):
+        result["continuation"] = encode_continuation({
+            "color_format": color_format,
+            "sort": sort,
+            "offset": stop,
+            "page_size": page_size,
+        })
+
+    return result
@@ -1,13 +1,112 @@
+import contextlib
+import os
 import os.path
+import subprocess
+import tempfile
+import rasterio
+from .gdal_environment import gdal_command_environment
+from .sparse import sparse_profile
 
 
 driver_by_extension = {
     ".asc": "AAIGrid",
     ".map": "PCRaster",
+    ".nc": "netCDF",
     ".tif": "GTiff",
 }
 
 
+# Drivers rasterio cannot create rasters with. Rasters in these formats
+# are written as a GeoTIFF first, which is converted by gdal_translate
+# (GDAL's CreateCopy).
+copy_drivers = {"netCDF"}
+
+
+# Creation options of rasters written by the data tools, per driver
+#
+# NetCDF rasters are written as NetCDF-4 (classic model), compressed
+# using deflate and chunked.
+creation_options_by_driver = {
+    "netCDF": {
+        "format": "NC4C",
+        "compress": "DEFLATE",
+        "zlevel": 4,
+        "chunking": True,
+    },
+}
+
+
 def driver_by_pathname(
         pathname):
     return driver_by_extension[os.path.splitext(pathname)[1]]
+
+
+def output_profile(
+        profile,
+        pathname):
+    """
+    Return a copy of *profile*, updated for writing the raster pointed to
+    by *pathname*
+
+    The driver is selected by the extension of the pathname, if known.
+    Otherwise the driver in the profile is kept. Creation options of the
+    driver are added.
+    """
+    profile = dict(profile)
+    extension = os.path.splitext(pathname)[1]
+
+    if extension in driver_by_extension:
+        profile["driver"] = driver_by_extension[extension]
+
+    profile.update(creation_options_by_driver.get(profile["driver"], {}))
+
+    return profile
+
+
+@contextlib.contextmanager
+def open_output_raster(
+        pathname,
+        profile):
+    """
+    Open the raster pointed to by *pathname* for writing, given *profile*
+    (see :func:`output_profile`)
+
+    Rasters in formats rasterio cannot create are written to a temporary
+    GeoTIFF next to *pathname*, which is converted to the target format
+    once it is closed. Blocks of the GeoTIFF left unwritten read as
+    no-data.
+    """
+    driver = profile["driver"]
+
+    if driver not in copy_drivers:
+        with rasterio.open(pathname, "w", **profile) as raster:
+            yield raster
+    else:
+        creation_options = creation_options_by_driver.get(driver, {})
+        geotiff_profile = {key: value for key, value in profile.items()
+            if key not in creation_options}
+        geotiff_profile["driver"] = "GTiff"
+        geotiff_profile = sparse_profile(geotiff_profile)
+
+        file, geotiff_pathname = tempfile.mkstemp(suffix=".tif",
+            dir=os.path.dirname(os.path.abspath(pathname)))
+        os.close(file)
+
+        try:
+            with rasterio.open(geotiff_pathname, "w", **geotiff_profile) \
+                    as raster:
+                yield raster
+
+            command = ["gdal_translate", "-q", "-of", driver]
+
+            for name, value in creation_options.items():
+                if isinstance(value, bool):
+                    value = "YES" if value else "NO"
+
+                command += ["-co", "{}={}".format(name.upper(), value)]
+
+            subprocess.run(command + [geotiff_pathname, pathname],
+                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=gdal_command_environment())
+        finally:
+            os.remove(geotiff_pathname)
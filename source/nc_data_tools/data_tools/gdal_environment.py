@@ -0,0 +1,53 @@
+import contextlib
+import os
+import threading
+import rasterio
+
+
+_local = threading.local()
+
+
+def gdal_environment_options():
+    """
+    Return the GDAL configuration options in effect in the current thread
+    """
+    return dict(getattr(_local, "options", {}))
+
+
+@contextlib.contextmanager
+def gdal_environment(
+        **options):
+    """
+    Context manager configuring GDAL using the configuration options
+    passed in
+
+    Contexts can be nested. The options of an inner context are merged
+    with, and override, those of the outer contexts. Options whose value
+    is None are ignored. The merged options are yielded.
+    """
+    previous_options = gdal_environment_options()
+    options = dict(previous_options, **{name: value for name, value in
+        options.items() if value is not None})
+    _local.options = options
+
+    try:
+        with rasterio.Env(**options):
+            yield dict(options)
+    finally:
+        _local.options = previous_options
+
+
+def gdal_command_environment():
+    """
+    Return the environment to run GDAL command line tools in, including
+    the GDAL configuration options in effect in the current thread
+    """
+    environment = dict(os.environ)
+
+    for name, value in gdal_environment_options().items():
+        if isinstance(value, bool):
+            value = "YES" if value else "NO"
+
+        environment[name] = str(value)
+
+    return environment
@@ -0,0 +1,106 @@
+import logging
+import math
+from .tiles import tile_windows
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionPlan(object):
+    """
+    Plan of how to process a raster: at once, or window by window
+
+    Windows are full-width strips when at least one row fits in the
+    budget, and square tiles otherwise. The windows of the windowed path
+    cover the raster. The whole-array path uses a single window covering
+    the whole raster.
+    """
+
+    def __init__(self,
+            operation,
+            shape,
+            window_shape,
+            bytes_per_cell):
+
+        self.operation = operation
+        self.shape = tuple(shape)
+        self.window_shape = tuple(window_shape)
+        self.bytes_per_cell = bytes_per_cell
+
+
+    @property
+    def whole_array(self):
+        return self.window_shape == self.shape
+
+
+    @property
+    def estimated_memory(self):
+        """
+        Estimated peak memory usage, in bytes, of processing one window
+        """
+        return self.window_shape[0] * self.window_shape[1] * \
+            self.bytes_per_cell
+
+
+    def windows(self):
+        return tile_windows(self.shape[0], self.shape[1], self.window_shape)
+
+
+    def __repr__(self):
+        return "ExecutionPlan({}, {}, {}, {})".format(
+            self.operation, self.shape, self.window_shape,
+            self.bytes_per_cell)
+
+
+def plan_execution(
+        operation,
+        shape,
+        bytes_per_cell,
+        max_memory=None,
+        alignment=1):
+    """
+    Return a plan for performing *operation* on a raster with *shape*
+    (nr_rows, nr_cols), given its peak memory usage per cell
+
+    In case the whole raster can be processed within *max_memory* bytes,
+    or when no budget is passed, the plan is to process it at once.
+    Otherwise, the window size is derived from the budget. When possible,
+    window sizes are rounded down to a multiple of *alignment* (e.g. the
+    block size of the raster written), to prevent blocks from being
+    written more than once.
+    """
+    nr_rows, nr_cols = shape
+    assert nr_rows > 0 and nr_cols > 0, shape
+    nr_cells = max(1, int(max_memory // bytes_per_cell)) \
+        if max_memory is not None else None
+
+    def align(
+            size,
+            max_size):
+
+        if size >= alignment:
+            size -= size % alignment
+
+        return max(1, min(size, max_size))
+
+    if nr_cells is None or nr_rows * nr_cols <= nr_cells:
+        window_shape = (nr_rows, nr_cols)
+    elif nr_cells >= nr_cols:
+        window_shape = (align(nr_cells // nr_cols, nr_rows), nr_cols)
+    else:
+        size = int(math.sqrt(nr_cells))
+        window_shape = (align(size, nr_rows), align(size, nr_cols))
+
+    plan = ExecutionPlan(operation, shape, window_shape, bytes_per_cell)
+
+    logger.info("Planned execution of %s", operation, extra={"fields": {
+        "operation": operation,
+        "shape": list(plan.shape),
+        "path": "whole-array" if plan.whole_array else "windowed",
+        "window_shape": list(plan.window_shape),
+        "nr_windows": len(plan.windows()),
+        "estimated_memory": plan.estimated_memory,
+        "max_memory": max_memory,
+    }})
+
+    return plan
@@ -0,0 +1,243 @@
+import os.path
+import tempfile
+import threading
+import numpy
+import rasterio
+import rasterio.crs
+import rasterio.warp as warp
+from .clip_raster import clip_raster
+from .gdal_environment import gdal_environment
+from .reformat_raster import reformat_raster
+from .reproject_raster import reproject_raster_given_template
+from .subtract_raster import subtract_raster
+
+
+def _resampling_method(
+        name):
+
+    return getattr(warp.RESAMPLING, name)
+
+
+def _crs(
+        crs):
+
+    return None if crs is None else rasterio.crs.CRS.from_string(crs)
+
+
+def _reformat(
+        source_pathname,
+        target_pathname,
+        step,
+        max_memory,
+        source_in_memory):
+
+    reformat_raster(source_pathname, target_pathname,
+        override_crs=_crs(step.get("crs")), max_memory=max_memory)
+
+
+def _reproject(
+        source_pathname,
+        target_pathname,
+        step,
+        max_memory,
+        source_in_memory):
+
+    source_options = {}
+    template_options = {}
+
+    if "source_crs" in step:
+        source_options["crs"] = _crs(step["source_crs"])
+
+    if "template_crs" in step:
+        template_options["crs"] = _crs(step["template_crs"])
+
+    # Temporary overviews are built by GDAL command line tools, which
+    # cannot read in-memory datasets
+    source_options["overviews"] = step.get("overviews",
+        False if source_in_memory else None)
+
+    reproject_raster_given_template(source_pathname, step["template"],
+        target_pathname,
+        resampling_method=_resampling_method(
+            step.get("resampling", "nearest")),
+        source_options=source_options,
+        template_options=template_options,
+        max_memory=max_memory)
+
+
+def _clip(
+        source_pathname,
+        target_pathname,
+        step,
+        max_memory,
+        source_in_memory):
+
+    clip_raster(source_pathname, step["clip"], target_pathname,
+        max_memory=max_memory,
+        resampling_method=_resampling_method(
+            step.get("resampling", "nearest")))
+
+
+def _subtract(
+        source_pathname,
+        target_pathname,
+        step,
+        max_memory,
+        source_in_memory):
+
+    subtract_raster(source_pathname, step["rhs"], target_pathname,
+        max_memory=max_memory)
+
+
+pipeline_operations = {
+    "reformat": _reformat,
+    "reproject": _reproject,
+    "clip": _clip,
+    "subtract": _subtract,
+}
+
+
+class Pipeline(object):
+    """
+    Chain of data_tools operations, applied to a source raster, resulting
+    in a target raster
+
+    Each step is a dict with an "operation" and its arguments:
+
+    - reformat: crs (optional, overrides the CRS)
+    - reproject: template, resampling (nearest, average, ...),
+      source_crs, template_crs, overviews (all optional, except template)
+    - clip: clip (raster to clip by), resampling (optional)
+    - subtract: rhs (raster to subtract)
+
+    Only the target raster is written where requested. Intermediate
+    rasters are kept in memory (/vsimem), or in a temporary directory.
+    """
+
+    def __init__(self,
+            source_pathname,
+            steps,
+            target_pathname):
+
+        assert len(steps) > 0
+        assert all([step["operation"] in pipeline_operations for
+            step in steps]), steps
+
+        self.source_pathname = source_pathname
+        self.steps = steps
+        self.target_pathname = target_pathname
+
+
+    @classmethod
+    def from_spec(cls,
+            spec):
+        """
+        Create a pipeline from a dict with source, steps and target
+        """
+        return cls(spec["source"], spec["steps"], spec["target"])
+
+
+    def fused_steps(self):
+        """
+        Return the steps to perform
+
+        Reformat steps which do not override the CRS only change the
+        format of the raster. Except for the last step, which determines
+        the format of the target raster, they are skipped.
+        """
+        return [step for i, step in enumerate(self.steps) if
+            i == len(self.steps) - 1 or
+            step["operation"] != "reformat" or "crs" in step]
+
+
+    def run(self,
+            in_memory=True,
+            max_memory=None):
+        """
+        Run the pipeline
+
+        Intermediate rasters are stored in GDAL's in-memory file system,
+        so no step writes its result to disk and reads it back, except
+        for the last one. This keeps two 1x1 files allocated per thread,
+        see :class:`_IntermediateStore`. In case *in_memory* is False,
+        intermediate rasters are stored in a temporary directory on disk
+        instead, which is removed afterwards.
+        """
+        steps = self.fused_steps()
+
+        with _IntermediateStore(in_memory) as store:
+            source_pathname = self.source_pathname
+
+            for i, step in enumerate(steps):
+                target_pathname = self.target_pathname \
+                    if i == len(steps) - 1 else store.pathname(i)
+                pipeline_operations[step["operation"]](
+                    source_pathname, target_pathname, step, max_memory,
+                    source_in_memory=in_memory and i > 0)
+                source_pathname = target_pathname
+
+
+class _IntermediateStore(object):
+    """
+    Store for intermediate rasters
+
+    At most two intermediate rasters exist at the same time: the input
+    and the output of the current step. Their pathnames alternate between
+    two slots. Overwriting an in-memory file releases its memory. Since
+    rasterio cannot remove in-memory files, the slots are truncated
+    afterwards, leaving two 1x1 rasters per thread. Their names are
+    reused by subsequent runs in the same thread. PAM (.aux.xml) files
+    are not written for in-memory rasters.
+    """
+
+    def __init__(self,
+            in_memory):
+
+        self.in_memory = in_memory
+
+
+    def __enter__(self):
+        if self.in_memory:
+            self.directory_pathname = "/vsimem/nc_pipeline_{}_{}".format(
+                os.getpid(), threading.get_ident())
+            self.environment = gdal_environment(GDAL_PAM_ENABLED=False)
+            self.environment.__enter__()
+        else:
+            self.directory = tempfile.TemporaryDirectory()
+            self.directory_pathname = self.directory.name
+
+        self.pathnames = set()
+
+        return self
+
+
+    def pathname(self,
+            i):
+
+        pathname = os.path.join(
+            self.directory_pathname, "intermediate-{}.tif".format(i % 2))
+        self.pathnames.add(pathname)
+
+        return pathname
+
+
+    def __exit__(self,
+            *exception):
+
+        if self.in_memory:
+            profile = {
+                "driver": "GTiff",
+                "width": 1,
+                "height": 1,
+                "count": 1,
+                "dtype": numpy.uint8,
+            }
+
+            try:
+                for pathname in self.pathnames:
+                    with rasterio.open(pathname, "w", **profile):
+                        pass
+            finally:
+                self.environment.__exit__(*exception)
+        else:
+            self.directory.cleanup()
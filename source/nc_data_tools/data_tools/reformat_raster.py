@@ -1,23 +1,30 @@
+import numpy
 import rasterio
-from .driver import driver_by_pathname
+from .driver import open_output_raster, output_profile
+from .memory_budget import plan_execution
 
 
 def reformat_raster(
         source_raster_pathname,
         target_raster_pathname,
-        override_crs=None):
-
-    target_driver = driver_by_pathname(target_raster_pathname)
+        override_crs=None,
+        max_memory=None):
 
     with rasterio.open(source_raster_pathname) as source_raster:
 
-        profile = source_raster.profile
-        profile["driver"] = target_driver
+        profile = output_profile(
+            source_raster.profile, target_raster_pathname)
 
         if override_crs is not None:
             profile["crs"] = override_crs
 
-        with rasterio.open(target_raster_pathname, "w", **profile) as \
+        plan = plan_execution("reformat_raster", source_raster.shape,
+            source_raster.count * numpy.dtype(profile["dtype"]).itemsize,
+            max_memory)
+
+        with open_output_raster(target_raster_pathname, profile) as \
                 target_raster:
 
-            target_raster.write(source_raster.read())
+            for window in plan.windows():
+                target_raster.write(
+                    source_raster.read(window=window), window=window)
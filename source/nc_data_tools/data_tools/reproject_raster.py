@@ -1,10 +1,229 @@
+import contextlib
+import math
 import os.path
 import shutil
+import subprocess
 import tempfile
+from affine import Affine
 import numpy
 import rasterio
 import rasterio.warp as warp
-from .driver import driver_by_pathname
+from .driver import driver_by_pathname, open_output_raster, \
+    output_profile
+from .gdal_environment import gdal_command_environment
+from .memory_budget import plan_execution
+from .sparse import is_sparse, sparse_profile
+from .stages import atomic_pathname
+
+
+# When downsampling, overviews are read whose resolution is at least this
+# many times finer than the target resolution. Higher values improve the
+# accuracy of the result, at the cost of reading more data.
+overview_oversampling = 2
+
+
+# Names of the tags of decimated rasters, storing the modification time
+# of the raster they were decimated from, and the resampling method used
+source_mtime_tag_name = "NC_SOURCE_MTIME"
+resampling_tag_name = "NC_RESAMPLING"
+
+
+def downsampling_ratio(
+        source_raster,
+        source_crs,
+        target_crs,
+        target_transform):
+    """
+    Return the ratio between the cell size of the target raster and the
+    cell size of the source raster, once reprojected to the target CRS
+    """
+    transform, _, _ = warp.calculate_default_transform(
+        source_crs, target_crs, source_raster.width, source_raster.height,
+        *source_raster.bounds)
+    transform = Affine.from_gdal(*transform) \
+        if not isinstance(transform, Affine) else transform
+    target_transform = Affine.from_gdal(*target_transform) \
+        if not isinstance(target_transform, Affine) else target_transform
+
+    return min(
+        abs(target_transform.a / transform.a),
+        abs(target_transform.e / transform.e))
+
+
+def overview_factor(
+        ratio,
+        oversampling=overview_oversampling):
+    """
+    Return the decimation factor of the overview to read when downsampling
+    by *ratio*, or 1 if the full resolution raster must be read
+
+    The factor is the largest power of two whose resolution is at least
+    *oversampling* times finer than the target resolution.
+    """
+    factor = 1
+
+    while factor * 2 * oversampling <= ratio:
+        factor *= 2
+
+    return factor
+
+
+@contextlib.contextmanager
+def _overview_source(
+        source_raster,
+        factor,
+        resampling_method):
+    """
+    Context manager yielding a dataset with overviews for the source
+    raster, including one decimated by *factor*, together with the
+    factor of the overview to read
+
+    Existing (internal or external) overviews are used if one of them is
+    close enough to *factor*. Otherwise, temporary overviews are built,
+    without modifying the source raster.
+    """
+    factors = [factor_ for factor_ in source_raster.overviews(1)
+        if factor_ <= factor]
+
+    if len(factors) > 0 and max(factors) * 2 > factor:
+        yield source_raster, max(factors)
+    else:
+        with tempfile.TemporaryDirectory() as directory_pathname:
+            vrt_pathname = os.path.join(directory_pathname, "source.vrt")
+            factors = [str(2 ** i) for i in
+                range(1, int(math.log2(factor)) + 1)]
+            environment = gdal_command_environment()
+
+            subprocess.run(["gdal_translate", "-of", "VRT",
+                    os.path.abspath(source_raster.name), vrt_pathname],
+                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=environment)
+            # -ro: store the overviews externally, next to the VRT
+            subprocess.run(["gdaladdo", "-ro", "-r",
+                    resampling_method.name, vrt_pathname] + factors,
+                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=environment)
+
+            with rasterio.open(vrt_pathname) as vrt:
+                yield vrt, factor
+
+
+def decimated_raster_pathname(
+        pathname,
+        factor,
+        resampling_method):
+    """
+    Return the pathname of the raster in which the raster pointed to by
+    *pathname*, decimated by *factor* using *resampling_method*, is cached
+
+    The raster is stored next to the source raster, as
+    <base>.overview-<factor>-<resampling>.tif.
+    """
+    return "{}.overview-{}-{}.tif".format(
+        os.path.splitext(pathname)[0], factor, resampling_method.name)
+
+
+@contextlib.contextmanager
+def decimated_raster(
+        source_raster,
+        factor,
+        resampling_method,
+        max_memory=None,
+        cache=True):
+    """
+    Context manager yielding the pathname of a raster containing all
+    bands of the source raster, decimated by *factor*
+
+    In case *cache* is True, the decimated raster is cached next to the
+    source raster (see :func:`decimated_raster_pathname`), and reused as
+    long as the source raster is not modified. This adds a file per
+    factor and resampling method to the directory of the source raster,
+    which must be writable. The cached raster is replaced when stale, but
+    never removed. Otherwise, the decimated raster is written to a
+    temporary directory, which is removed afterwards.
+
+    Overviews are only built when the cached raster is missing or stale.
+    The decimated raster is written window by window, within *max_memory*
+    bytes.
+    """
+    if not cache:
+        with tempfile.TemporaryDirectory() as directory_pathname:
+            pathname = os.path.join(directory_pathname, "overview.tif")
+            _decimate_raster(source_raster, factor, resampling_method,
+                pathname, {}, max_memory)
+
+            yield pathname
+    else:
+        pathname = decimated_raster_pathname(
+            source_raster.name, factor, resampling_method)
+        tags = {
+            source_mtime_tag_name:
+                repr(os.path.getmtime(source_raster.name)),
+            resampling_tag_name: resampling_method.name,
+        }
+        cached = False
+
+        if os.path.exists(pathname):
+            with rasterio.open(pathname) as raster:
+                raster_tags = raster.tags()
+                cached = all([raster_tags.get(name) == value for
+                    name, value in tags.items()])
+
+        if not cached:
+            with atomic_pathname(pathname) as temporary_pathname:
+                _decimate_raster(source_raster, factor, resampling_method,
+                    temporary_pathname, tags, max_memory)
+
+        yield pathname
+
+
+def _decimate_raster(
+        source_raster,
+        factor,
+        resampling_method,
+        pathname,
+        tags,
+        max_memory):
+
+    with _overview_source(source_raster, factor, resampling_method) as \
+            (dataset, factor):
+
+        nr_rows = (dataset.height + factor - 1) // factor
+        nr_cols = (dataset.width + factor - 1) // factor
+        dtype = dataset.dtypes[0]
+        profile = {
+            "driver": "GTiff",
+            "width": nr_cols,
+            "height": nr_rows,
+            "count": dataset.count,
+            "dtype": dtype,
+            "crs": source_raster.crs,
+            "transform": source_raster.affine * Affine.scale(
+                source_raster.width / nr_cols,
+                source_raster.height / nr_rows),
+            "nodata": source_raster.nodata,
+        }
+        plan = plan_execution("read_overview", (nr_rows, nr_cols),
+            dataset.count * numpy.dtype(dtype).itemsize, max_memory)
+
+        with rasterio.open(pathname, "w", **profile) as raster:
+            raster.update_tags(**tags)
+
+            for window in plan.windows():
+                (row_start, row_stop), (col_start, col_stop) = window
+                source_window = (
+                    (row_start * factor,
+                        min(row_stop * factor, dataset.height)),
+                    (col_start * factor,
+                        min(col_stop * factor, dataset.width)))
+
+                # GDAL reads from the overview matching the decimated
+                # buffer
+                raster.write(dataset.read(window=source_window,
+                    out=numpy.empty((dataset.count, row_stop - row_start,
+                        col_stop - col_start), dtype=dtype)),
+                    window=window)
+
 
 def reproject_raster(
         source_raster_pathname,
@@ -19,7 +238,8 @@ def reproject_raster(
             source_raster.width, source_raster.height,
             *source_raster.bounds)
 
-        profile = source_raster.meta.copy()
+        profile = sparse_profile(
+            output_profile(source_raster.meta, target_raster_pathname))
         profile.update({
             "crs": target_crs,
             "transform": affine,
@@ -27,7 +247,7 @@ def reproject_raster(
             "height": height
         })
 
-        with rasterio.open(target_raster_pathname, "w", **profile) as \
+        with open_output_raster(target_raster_pathname, profile) as \
                 target_raster:
 
             for b in range(1, source_raster.count + 1):
@@ -38,7 +258,9 @@ def reproject_raster(
                     src_crs=source_raster.crs,
                     dst_transform=affine,
                     dst_crs=target_crs,
-                    resampling=resampling_method)
+                    resampling=resampling_method,
+                    # Don't write chunks not overlapping the source
+                    skip_nosource=is_sparse(target_raster))
 
 
 def reproject_raster_given_template(
@@ -48,9 +270,35 @@ def reproject_raster_given_template(
         resampling_method=warp.RESAMPLING.nearest,
         source_options={},
         template_options={},
-        target_options={}):
+        target_options={},
+        max_memory=None):
+    """
+    Reproject the source raster, given the projection properties of the
+    template raster
+
+    Source options:
+    - crs: CRS of the source raster
+    - overviews: Whether to read from overviews when the target raster is
+      much coarser than the source raster. Defaults to True for average
+      resampling. Missing overviews are built temporarily. The decimated
+      source raster is cached (see :func:`decimated_raster`).
+    - cache_overviews: Whether to cache the decimated source raster next
+      to the source raster. Defaults to True.
+    - overview_oversampling: Minimum ratio between the target resolution
+      and the resolution of the overview read
+
+    Template options:
+    - crs: CRS of the template raster
+
+    Target options:
+    - clip: Whether to clip the result to the extent of the source raster
+
+    *max_memory* is the memory budget, in bytes, of decimating the source
+    raster. The warper's memory use is bounded by its own limit.
+    """
 
-    with rasterio.open(source_raster_pathname) as source_raster, \
+    with contextlib.ExitStack() as stack, \
+            rasterio.open(source_raster_pathname) as source_raster, \
             rasterio.open(template_raster_pathname) as template_raster:
 
         source_profile = source_raster.profile
@@ -62,6 +310,8 @@ def reproject_raster_given_template(
         # properties based on the source profile and the options passed in.
         target_profile = template_raster.meta.copy()
         target_profile["driver"] = driver_by_pathname(target_raster_pathname)
+        target_profile = sparse_profile(
+            output_profile(target_profile, target_raster_pathname))
         target_profile["count"] = source_profile["count"]
         target_profile["dtype"] = source_profile["dtype"]
         target_profile["nodata"] = source_profile["nodata"]
@@ -69,18 +319,48 @@ def reproject_raster_given_template(
         if "crs" in template_options:
             target_profile["crs"] = template_options["crs"]
 
-        with rasterio.open(target_raster_pathname, "w",
-                **target_profile) as target_raster:
+        # When downsampling a lot, read from overviews instead of from
+        # the full resolution raster
+        source_bands = [rasterio.band(source_raster, b) for b in
+            range(1, source_raster.count + 1)]
+        source_transform = source_profile["transform"]
+        use_overviews = source_options.get("overviews")
 
-            for b in range(1, source_raster.count + 1):
+        if use_overviews is None:
+            use_overviews = resampling_method == warp.RESAMPLING.average
+
+        if use_overviews:
+            factor = overview_factor(
+                downsampling_ratio(source_raster, source_profile["crs"],
+                    target_profile["crs"], target_profile["transform"]),
+                source_options.get(
+                    "overview_oversampling", overview_oversampling))
+
+            if factor > 1:
+                overview_pathname = stack.enter_context(decimated_raster(
+                    source_raster, factor, resampling_method,
+                    max_memory=max_memory,
+                    cache=source_options.get("cache_overviews", True)))
+                overview_raster = stack.enter_context(
+                    rasterio.open(overview_pathname))
+                source_bands = [rasterio.band(overview_raster, b) for b in
+                    range(1, overview_raster.count + 1)]
+                source_transform = overview_raster.affine
+
+        with open_output_raster(target_raster_pathname,
+                target_profile) as target_raster:
+
+            for b, source_band in enumerate(source_bands, 1):
                 warp.reproject(
-                    source=rasterio.band(source_raster, b),
+                    source=source_band,
                     destination=rasterio.band(target_raster, b),
-                    src_transform=source_profile["transform"],
+                    src_transform=source_transform,
                     src_crs=source_profile["crs"],
+                    src_nodata=source_profile["nodata"],
                     dst_transform=target_profile["transform"],
                     dst_crs=target_profile["crs"],
-                    resampling=resampling_method)
+                    resampling=resampling_method,
+                    skip_nosource=is_sparse(target_raster))
                     # num_threads=2)
 
 
@@ -105,15 +385,16 @@ def reproject_raster_given_template(
                 with rasterio.open(temp_target_raster_pathname) as \
                         target_raster:
 
-                    profile = target_raster.meta.copy()
+                    profile = output_profile(
+                        target_raster.meta, target_raster_pathname)
                     profile.update({
                         "height": window[0][1] - window[0][0],
                         "width": window[1][1] - window[1][0],
                         "transform": target_raster.window_transform(window)
                     })
 
-                    with rasterio.open(
-                            target_raster_pathname, "w", **profile) as \
+                    with open_output_raster(
+                            target_raster_pathname, profile) as \
                                 clipped_target_raster:
                         clipped_target_raster.write(
                             target_raster.read(window=window))
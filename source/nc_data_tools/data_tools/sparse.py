@@ -0,0 +1,89 @@
+import numpy
+import rasterio
+
+
+# Leaving blocks of GeoTIFFs unwritten (SPARSE_OK creation option) and
+# skipping chunks without source cells while warping (SKIP_NOSOURCE warp
+# option) need GDAL 2. Older versions fill unwritten GeoTIFF blocks with
+# zeros when the raster is closed.
+sparse_supported = int(rasterio.__gdal_version__.split(".")[0]) >= 2
+
+
+def sparse_profile(
+        profile):
+    """
+    Return a copy of *profile*, allowing blocks of a GeoTIFF to be left
+    unwritten
+
+    Unwritten blocks are not stored in the file. They read as no-data.
+    """
+    profile = dict(profile)
+
+    if profile["driver"] == "GTiff" and sparse_supported:
+        profile["sparse_ok"] = True
+
+    return profile
+
+
+def is_sparse(
+        dataset):
+    """
+    Return whether unwritten blocks of *dataset* read as no-data
+    """
+    return sparse_supported and dataset.driver == "GTiff" and \
+        dataset.nodata is not None
+
+
+def block_windows(
+        dataset,
+        window):
+    """
+    Return the windows of the parts of the blocks of *dataset* overlapping
+    *window*
+    """
+    block_nr_rows, block_nr_cols = dataset.block_shapes[0]
+    (row_start, row_stop), (col_start, col_stop) = window
+    row_starts = [row_start] + list(range(
+        (row_start // block_nr_rows + 1) * block_nr_rows, row_stop,
+        block_nr_rows))
+    col_starts = [col_start] + list(range(
+        (col_start // block_nr_cols + 1) * block_nr_cols, col_stop,
+        block_nr_cols))
+
+    return [
+        ((row, min(row - row % block_nr_rows + block_nr_rows, row_stop)),
+            (col, min(col - col % block_nr_cols + block_nr_cols, col_stop)))
+        for row in row_starts for col in col_starts]
+
+
+def write_valid_blocks(
+        dataset,
+        cells,
+        valid,
+        window):
+    """
+    Write the bands x rows x cols *cells* to *window* of *dataset*
+
+    In case the dataset is sparse, only the blocks containing cells for
+    which *valid* (rows x cols, None if all cells are valid) is True are
+    written. Other blocks are left unwritten. Returns the number of blocks
+    skipped.
+    """
+    if not is_sparse(dataset) or valid is None or valid.all():
+        dataset.write(cells, window=window)
+        return 0
+
+    (row_offset, _), (col_offset, _) = window
+    nr_blocks_skipped = 0
+
+    for block in block_windows(dataset, window):
+        (row_start, row_stop), (col_start, col_stop) = block
+        rows = slice(row_start - row_offset, row_stop - row_offset)
+        cols = slice(col_start - col_offset, col_stop - col_offset)
+
+        if numpy.any(valid[rows, cols]):
+            dataset.write(cells[:, rows, cols], window=block)
+        else:
+            nr_blocks_skipped += 1
+
+    return nr_blocks_skipped
@@ -0,0 +1,102 @@
+import contextlib
+import hashlib
+import json
+import os
+import os.path
+import uuid
+import rasterio
+
+
+# Name of the raster tag in which the keys of completed stages are stored
+stage_tag_name = "NC_COMPLETED_STAGES"
+
+
+def stage_key(
+        *components):
+    """
+    Return an idempotency key for a processing stage
+
+    The components passed in (e.g. plan URI, stage name and the
+    parameters of the stage) must be JSON serializable. Equal components
+    result in equal keys.
+    """
+    text = json.dumps(components, sort_keys=True)
+
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def completed_stages(
+        pathname):
+    """
+    Return the keys of the stages completed for the raster pointed to
+    by *pathname*
+    """
+    if not os.path.exists(pathname):
+        return []
+
+    with rasterio.open(pathname) as raster:
+        return raster.tags().get(stage_tag_name, "").split()
+
+
+def stage_completed(
+        pathname,
+        key):
+
+    return key in completed_stages(pathname)
+
+
+def mark_stage_completed(
+        pathname,
+        key):
+    """
+    Record that the stage identified by *key* has been completed for
+    the raster pointed to by *pathname*
+
+    The key is stored in the raster itself. When done on a temporary
+    raster written by :func:`atomic_pathname`, the raster and the record
+    are committed together.
+    """
+    if key not in completed_stages(pathname):
+        with rasterio.open(pathname, "r+") as raster:
+            add_completed_stage(raster, key)
+
+
+def add_completed_stage(
+        raster,
+        key):
+    """
+    Record that the stage identified by *key* has been completed, in the
+    tags of *raster*, opened for updating
+
+    This allows recording the stage in the same session as the update of
+    the raster it concerns.
+    """
+    stages = raster.tags().get(stage_tag_name, "").split()
+
+    if key not in stages:
+        stages.append(key)
+        raster.update_tags(**{stage_tag_name: " ".join(stages)})
+
+
+@contextlib.contextmanager
+def atomic_pathname(
+        pathname):
+    """
+    Context manager yielding a unique temporary pathname to write to
+    instead of *pathname*
+
+    The temporary file is located next to *pathname* and is renamed to
+    it when the block exits normally. Otherwise it is removed. Readers
+    never observe a partially written file, and crashed runs do not
+    leave files behind which block subsequent runs.
+    """
+    base, extension = os.path.splitext(pathname)
+    temporary_pathname = "{}.tmp-{}{}".format(
+        base, uuid.uuid4().hex, extension)
+
+    try:
+        yield temporary_pathname
+        os.replace(temporary_pathname, pathname)
+    finally:
+        if os.path.exists(temporary_pathname):
+            os.remove(temporary_pathname)
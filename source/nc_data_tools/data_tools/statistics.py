@@ -0,0 +1,470 @@
+import json
+import math
+import os
+import os.path
+import numpy
+import rasterio
+
+
+# Statistics are cached per square block of this number of cells along
+# both dimensions
+statistics_block_size = 1024
+
+# Default maximum number of bins of histograms
+statistics_nr_bins = 256
+
+
+def statistics_pathname(
+        pathname):
+    """
+    Return the pathname of the sidecar file caching the statistics of
+    the blocks of the raster pointed to by *pathname*
+    """
+    return "{}.stats.npz".format(pathname)
+
+
+def _bin_exponent(
+        min_,
+        max_,
+        nr_bins,
+        integral):
+    """
+    Return the exponent of the smallest power of two bin width for which
+    the range passed fits in *nr_bins* bins
+
+    Bins are aligned at multiples of their width, so histograms with
+    different bin widths can be merged exactly, by merging the bins of
+    the finer one.
+    """
+    # Keep bin indices within the range of exactly representable integers
+    exponent = math.frexp(max(abs(min_), abs(max_)))[1] - 52
+
+    if integral:
+        exponent = max(exponent, 0)
+
+    if max_ > min_:
+        exponent = max(exponent,
+            int(math.ceil(math.log2((max_ - min_) / nr_bins))))
+
+    while math.floor(math.ldexp(max_, -exponent)) - \
+            math.floor(math.ldexp(min_, -exponent)) + 1 > nr_bins:
+        exponent += 1
+
+    return exponent
+
+
+def _coarsen_histogram(
+        exponent,
+        offset,
+        counts,
+        new_exponent):
+    """
+    Merge the bins of a histogram into bins whose width is 2^*new_exponent*
+
+    Returns the new offset (index of the first bin) and counts.
+    """
+    if new_exponent == exponent:
+        return offset, counts
+
+    indices = numpy.floor(numpy.ldexp(
+        numpy.arange(offset, offset + len(counts), dtype=numpy.float64),
+        exponent - new_exponent)).astype(numpy.int64)
+    new_offset = indices[0]
+
+    return new_offset, numpy.bincount(indices - new_offset, weights=counts,
+        minlength=indices[-1] - new_offset + 1).astype(numpy.int64)
+
+
+class BandSummary(object):
+    """
+    Summary of the valid cells of (part of) a band: their number, mean, sum
+    of squared differences from the mean (M2), minimum, maximum, and
+    histogram
+
+    Summaries of disjoint parts of a band can be merged. Means and M2s are
+    merged using Chan et al.'s parallel algorithm, which, unlike sums of
+    squares, does not lose precision for cells with a large mean and a
+    small spread.
+    """
+
+    def __init__(self,
+            count=0,
+            mean=0.0,
+            m2=0.0,
+            min_=math.inf,
+            max_=-math.inf,
+            exponent=0,
+            offset=0,
+            histogram=None):
+
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = min_
+        self.max = max_
+        self.exponent = exponent
+        self.offset = offset
+        self.histogram = numpy.zeros(0, dtype=numpy.int64) \
+            if histogram is None else histogram
+
+
+    @classmethod
+    def from_cells(cls,
+            cells,
+            nr_bins):
+        """
+        Summarise the (valid) cells passed in
+        """
+        if len(cells) == 0:
+            return cls()
+
+        integral = numpy.issubdtype(cells.dtype, numpy.integer)
+        cells = cells.astype(numpy.float64)
+        min_ = float(cells.min())
+        max_ = float(cells.max())
+        exponent = _bin_exponent(min_, max_, nr_bins, integral)
+        indices = numpy.floor(numpy.ldexp(cells, -exponent)).astype(
+            numpy.int64)
+        offset = int(math.floor(math.ldexp(min_, -exponent)))
+        mean = float(cells.mean())
+        deviations = cells - mean
+
+        return cls(
+            count=len(cells),
+            mean=mean,
+            m2=float(numpy.dot(deviations, deviations)),
+            min_=min_,
+            max_=max_,
+            exponent=exponent,
+            offset=offset,
+            histogram=numpy.bincount(indices - offset).astype(numpy.int64))
+
+
+    @classmethod
+    def merge(cls,
+            summaries,
+            nr_bins):
+        """
+        Merge summaries of disjoint parts of a band into a summary of the
+        whole, whose histogram has at most *nr_bins* bins
+        """
+        summaries = [summary for summary in summaries if summary.count > 0]
+
+        if len(summaries) == 0:
+            return cls()
+
+        min_ = min([summary.min for summary in summaries])
+        max_ = max([summary.max for summary in summaries])
+        exponent = max([summary.exponent for summary in summaries])
+
+        while math.floor(math.ldexp(max_, -exponent)) - \
+                math.floor(math.ldexp(min_, -exponent)) + 1 > nr_bins:
+            exponent += 1
+
+        offset = int(math.floor(math.ldexp(min_, -exponent)))
+        histogram = numpy.zeros(
+            int(math.floor(math.ldexp(max_, -exponent))) - offset + 1,
+            dtype=numpy.int64)
+
+        for summary in summaries:
+            summary_offset, counts = _coarsen_histogram(summary.exponent,
+                summary.offset, summary.histogram, exponent)
+            start = summary_offset - offset
+            histogram[start:start + len(counts)] += counts
+
+        count, mean, m2 = 0, 0.0, 0.0
+
+        for summary in summaries:
+            delta = summary.mean - mean
+            count += summary.count
+            mean += delta * summary.count / count
+            m2 += summary.m2 + \
+                delta * delta * (count - summary.count) * summary.count / \
+                    count
+
+        return cls(
+            count=count,
+            mean=mean,
+            m2=m2,
+            min_=min_,
+            max_=max_,
+            exponent=exponent,
+            offset=offset,
+            histogram=histogram)
+
+
+    def statistics(self):
+        """
+        Return a dict with the statistics of the summarised cells
+
+        The histogram contains the counts of cells per bin, and the edges
+        of the bins.
+        """
+        if self.count == 0:
+            return {
+                "count": 0,
+                "min": None,
+                "max": None,
+                "mean": None,
+                "std": None,
+                "histogram": {"counts": [], "edges": []},
+            }
+
+        width = math.ldexp(1.0, self.exponent)
+
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "std": math.sqrt(self.m2 / self.count),
+            "histogram": {
+                "counts": self.histogram.tolist(),
+                "edges": [(self.offset + i) * width for i in
+                    range(len(self.histogram) + 1)],
+            },
+        }
+
+
+class _BlockCache(object):
+    """
+    Summaries of the bands of the blocks of a raster, stored in a sidecar
+    file
+
+    The cache is valid as long as the raster's modification time equals
+    the one recorded. Rewriting part of a raster without invalidating
+    the blocks written invalidates the whole cache.
+    """
+
+    def __init__(self,
+            pathname,
+            header):
+
+        self.pathname = statistics_pathname(pathname)
+        self.header = header
+        self.summaries = {}
+        self.modified = False
+
+
+    @classmethod
+    def open(cls,
+            pathname,
+            raster,
+            nr_bins):
+        """
+        Return the cache of the raster, containing the summaries stored
+        in the sidecar file, if still valid
+        """
+        block_cache = cls(pathname, {
+            "shape": list(raster.shape),
+            "count": raster.count,
+            "block_size": statistics_block_size,
+            "nr_bins": nr_bins,
+            "mtime": os.path.getmtime(pathname),
+        })
+
+        if os.path.exists(block_cache.pathname):
+            header, summaries = _load(block_cache.pathname)
+
+            if header == block_cache.header:
+                block_cache.summaries = summaries
+
+        return block_cache
+
+
+    def save(self):
+        if not self.modified:
+            return
+
+        arrays = _dump_summaries(self.summaries)
+        arrays["header"] = numpy.array(json.dumps(self.header))
+
+        # Write atomically, so concurrent readers never see a partial file
+        temporary_pathname = "{}.{}.tmp.npz".format(
+            os.path.splitext(self.pathname)[0], os.getpid())
+        numpy.savez(temporary_pathname, **arrays)
+        os.replace(temporary_pathname, self.pathname)
+
+
+def _dump_summaries(
+        summaries):
+
+    indices = sorted(summaries)
+    arrays = {"indices": numpy.array(indices, dtype=numpy.int64).reshape(
+        len(indices), 2)}
+    band_summaries = [summary for index in indices for
+        summary in summaries[index]]
+
+    for name in ["count", "mean", "m2", "min", "max", "exponent",
+            "offset"]:
+        arrays[name] = numpy.array(
+            [getattr(summary, name) for summary in band_summaries])
+
+    arrays["histogram_sizes"] = numpy.array(
+        [len(summary.histogram) for summary in band_summaries],
+        dtype=numpy.int64)
+    arrays["histograms"] = numpy.concatenate(
+        [numpy.zeros(0, dtype=numpy.int64)] +
+        [summary.histogram for summary in band_summaries])
+
+    return arrays
+
+
+def _load(
+        pathname):
+    """
+    Return the header and the summaries stored in the sidecar file
+    """
+    with numpy.load(pathname) as arrays:
+        return json.loads(str(arrays["header"])), _load_summaries(arrays)
+
+
+def _load_summaries(
+        arrays):
+
+    indices = [tuple(index) for index in arrays["indices"].tolist()]
+    ends = numpy.cumsum(arrays["histogram_sizes"])
+    histograms = numpy.split(arrays["histograms"], ends[:-1]) \
+        if len(ends) > 0 else []
+    band_summaries = [BandSummary(
+            count=int(arrays["count"][i]),
+            mean=float(arrays["mean"][i]),
+            m2=float(arrays["m2"][i]),
+            min_=float(arrays["min"][i]),
+            max_=float(arrays["max"][i]),
+            exponent=int(arrays["exponent"][i]),
+            offset=int(arrays["offset"][i]),
+            histogram=histograms[i])
+        for i in range(len(histograms))]
+    nr_bands = len(band_summaries) // len(indices) if indices else 0
+
+    return {index: band_summaries[i * nr_bands:(i + 1) * nr_bands] for
+        i, index in enumerate(indices)}
+
+
+def _statistics_windows(
+        shape,
+        window):
+    """
+    Return (index, window) tuples of the parts of the statistics blocks
+    overlapping *window*
+
+    The index is None for blocks only partly overlapping the window.
+    """
+    (row_start, row_stop), (col_start, col_stop) = window
+    nr_rows, nr_cols = shape
+    size = statistics_block_size
+    windows = []
+
+    for block_row in range(row_start // size, (row_stop - 1) // size + 1):
+        for block_col in range(col_start // size, (col_stop - 1) // size + 1):
+            block = (
+                (block_row * size, min((block_row + 1) * size, nr_rows)),
+                (block_col * size, min((block_col + 1) * size, nr_cols)))
+            part = (
+                (max(block[0][0], row_start), min(block[0][1], row_stop)),
+                (max(block[1][0], col_start), min(block[1][1], col_stop)))
+            windows.append(
+                ((block_row, block_col) if part == block else None, part))
+
+    return windows
+
+
+def _summarise_window(
+        raster,
+        window,
+        nr_bins):
+
+    summaries = []
+
+    for b in range(1, raster.count + 1):
+        cells = raster.read(b, window=window).ravel()
+        nodata = raster.nodata
+
+        if nodata is not None:
+            cells = cells[cells != nodata]
+
+        if numpy.issubdtype(cells.dtype, numpy.floating):
+            cells = cells[numpy.isfinite(cells)]
+
+        summaries.append(BandSummary.from_cells(cells, nr_bins))
+
+    return summaries
+
+
+def raster_statistics(
+        pathname,
+        window=None,
+        nr_bins=statistics_nr_bins,
+        cache=True):
+    """
+    Return the statistics of the bands of the raster pointed to by
+    *pathname*: the number of valid cells, their minimum, maximum, mean,
+    standard deviation and histogram
+
+    The raster is read in a single pass, block by block. In case *cache*
+    is True, the summaries of the blocks are cached in a sidecar file
+    (see :func:`statistics_pathname`). Subsequent requests, also for
+    other windows, only read the blocks not cached, and the parts of
+    blocks at the borders of the window.
+
+    Histograms have at most *nr_bins* bins, whose width is a power of
+    two. For integral rasters, bins are at least one wide.
+    """
+    with rasterio.open(pathname) as raster:
+
+        if window is None:
+            window = ((0, raster.height), (0, raster.width))
+
+        block_cache = _BlockCache.open(pathname, raster, nr_bins) if cache \
+            else None
+        summaries = []
+
+        for index, part in _statistics_windows(raster.shape, window):
+
+            if index is not None and block_cache is not None and \
+                    index in block_cache.summaries:
+                part_summaries = block_cache.summaries[index]
+            else:
+                part_summaries = _summarise_window(raster, part, nr_bins)
+
+                if index is not None and block_cache is not None:
+                    block_cache.summaries[index] = part_summaries
+                    block_cache.modified = True
+
+            summaries.append(part_summaries)
+
+    if block_cache is not None:
+        block_cache.save()
+
+    return [BandSummary.merge(band_summaries, nr_bins).statistics() for
+        band_summaries in zip(*summaries)]
+
+
+def invalidate_statistics(
+        pathname,
+        window):
+    """
+    Forget the cached statistics of the blocks of the raster pointed to
+    by *pathname* overlapping *window*, after it has been (re)written
+
+    Only those blocks are read again the next time statistics are
+    requested.
+    """
+    if not os.path.exists(statistics_pathname(pathname)):
+        return
+
+    header, summaries = _load(statistics_pathname(pathname))
+    size = header["block_size"]
+    (row_start, row_stop), (col_start, col_stop) = window
+
+    for block_row in range(row_start // size, (row_stop - 1) // size + 1):
+        for block_col in range(col_start // size, (col_stop - 1) // size + 1):
+            summaries.pop((block_row, block_col), None)
+
+    # The other blocks remain valid for the raster as it is now
+    block_cache = _BlockCache(pathname,
+        dict(header, mtime=os.path.getmtime(pathname)))
+    block_cache.summaries = summaries
+    block_cache.modified = True
+    block_cache.save()
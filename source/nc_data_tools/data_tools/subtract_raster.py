@@ -1,11 +1,16 @@
+import contextlib
 import numpy
 import rasterio
+from .driver import open_output_raster, output_profile
+from .memory_budget import plan_execution
+from .sparse import sparse_profile, write_valid_blocks
 
 
 def subtract_raster(
         lhs_raster_pathname,
         rhs_raster_pathname,
-        target_raster_pathname):
+        target_raster_pathname,
+        max_memory=None):
 
     with rasterio.open(lhs_raster_pathname) as lhs_raster, \
             rasterio.open(rhs_raster_pathname) as rhs_raster:
@@ -16,21 +21,200 @@ def subtract_raster(
         lhs_nodata_value = lhs_profile["nodata"]
         rhs_nodata_value = rhs_profile["nodata"]
 
-        profile = lhs_raster.meta.copy()
+        profile = sparse_profile(
+            output_profile(lhs_raster.meta, target_raster_pathname))
         nodata_value = profile["nodata"]
 
-        with rasterio.open(target_raster_pathname, "w", **profile) as \
+        assert lhs_raster.shape == rhs_raster.shape
+        assert lhs_raster.count == rhs_raster.count
+
+        # Both operands, the result and the masks of no-data cells
+        bytes_per_cell = lhs_raster.count * (
+            numpy.dtype(lhs_raster.dtypes[0]).itemsize +
+            numpy.dtype(rhs_raster.dtypes[0]).itemsize +
+            numpy.dtype(profile["dtype"]).itemsize + 3)
+        plan = plan_execution("subtract_raster", lhs_raster.shape,
+            bytes_per_cell, max_memory)
+
+        with open_output_raster(target_raster_pathname, profile) as \
                 target_raster:
 
-            lhs = lhs_raster.read()
-            rhs = rhs_raster.read()
+            for window in plan.windows():
+
+                lhs = lhs_raster.read(window=window)
+
+                # The rhs raster is not read where the lhs raster contains
+                # only no-data
+                if numpy.all(lhs == lhs_nodata_value):
+                    result = numpy.full_like(lhs, nodata_value)
+                else:
+                    rhs = rhs_raster.read(window=window)
+
+                    assert lhs.shape == rhs.shape
+
+                    result = lhs - rhs
+                    result[
+                        numpy.logical_or(
+                            lhs == lhs_nodata_value,
+                            rhs == rhs_nodata_value)] = nodata_value
+
+                _write_valid_blocks(
+                    target_raster, result, nodata_value, window)
+
+
+# Aggregates of the differences of a raster stack
+stack_aggregates = ["cumulative", "max"]
+
+
+def subtract_raster_stack(
+        raster_pathnames,
+        target_raster_pathname,
+        baseline=False,
+        aggregate_raster_pathnames=None,
+        max_memory=None):
+    """
+    Subtract the successive rasters of a time series of aligned rasters
+
+    Difference i is raster i + 1 minus raster i, or, in case *baseline*
+    is True, raster i + 1 minus the first raster. Cells which are
+    no-data in either operand are no-data in the difference, like in
+    :func:`subtract_raster`.
+
+    In case *target_raster_pathname* is a single pathname, the
+    differences are written as the bands of a single raster (bands of
+    difference 0 first). Otherwise it must be a list with a pathname per
+    difference.
+
+    *aggregate_raster_pathnames* maps aggregates of the differences to
+    the pathnames of the rasters to write them to:
+
+    - cumulative: Sum of the (valid) differences
+    - max: Difference with the largest absolute value
+
+    Each input raster is read only once, window by window.
+    """
+    nr_differences = len(raster_pathnames) - 1
+    assert nr_differences > 0, raster_pathnames
+    aggregate_raster_pathnames = aggregate_raster_pathnames or {}
+    assert all([aggregate in stack_aggregates for aggregate in
+        aggregate_raster_pathnames]), aggregate_raster_pathnames
+
+    with contextlib.ExitStack() as stack:
+
+        rasters = [stack.enter_context(rasterio.open(pathname)) for
+            pathname in raster_pathnames]
+        nodata_values = [raster.nodata for raster in rasters]
+        count = rasters[0].count
+
+        assert all([raster.shape == rasters[0].shape for raster in rasters])
+        assert all([raster.count == count for raster in rasters])
+
+        meta = rasters[0].meta
+        nodata_value = meta["nodata"]
+        dtype = numpy.dtype(meta["dtype"])
+
+        def create(
+                pathname,
+                **kwargs):
+
+            profile = sparse_profile(output_profile(meta, pathname))
+            profile.update(kwargs)
+
+            return stack.enter_context(
+                open_output_raster(pathname, profile))
+
+        if isinstance(target_raster_pathname, str):
+            target_rasters = [create(target_raster_pathname,
+                count=nr_differences * count)]
+        else:
+            assert len(target_raster_pathname) == nr_differences
+            target_rasters = [create(pathname) for pathname in
+                target_raster_pathname]
+
+        aggregate_rasters = {aggregate: create(pathname) for
+            aggregate, pathname in aggregate_raster_pathnames.items()}
+
+        # All operands, the differences, their masks and the aggregates
+        bytes_per_cell = count * (
+            sum([numpy.dtype(raster.dtypes[0]).itemsize for
+                raster in rasters]) +
+            nr_differences * (dtype.itemsize + 1) +
+            len(aggregate_rasters) * (dtype.itemsize + 1))
+        plan = plan_execution("subtract_raster", rasters[0].shape,
+            bytes_per_cell, max_memory)
+
+        for window in plan.windows():
+
+            cells = [raster.read(window=window) for raster in rasters]
+            invalid = [numpy.zeros(layer.shape, dtype=numpy.bool_)
+                if nodata is None else layer == nodata for layer, nodata in
+                    zip(cells, nodata_values)]
+            differences = []
+            invalid_differences = []
+
+            for i in range(nr_differences):
+                lhs, rhs = i + 1, 0 if baseline else i
+                difference = cells[lhs] - cells[rhs]
+                invalid_difference = numpy.logical_or(
+                    invalid[lhs], invalid[rhs])
+
+                if nodata_value is not None:
+                    difference[invalid_difference] = nodata_value
+
+                differences.append(difference)
+                invalid_differences.append(invalid_difference)
+
+            if len(target_rasters) == 1:
+                _write_valid_blocks(target_rasters[0],
+                    numpy.concatenate(differences), nodata_value, window)
+            else:
+                for target_raster, difference in \
+                        zip(target_rasters, differences):
+                    _write_valid_blocks(target_raster, difference,
+                        nodata_value, window)
+
+            for aggregate, aggregate_raster in aggregate_rasters.items():
+                _write_valid_blocks(aggregate_raster,
+                    _aggregate(aggregate, differences, invalid_differences,
+                        nodata_value),
+                    nodata_value, window)
+
+
+def _aggregate(
+        aggregate,
+        differences,
+        invalid_differences,
+        nodata_value):
+
+    # Validity is not derived from the differences, since valid
+    # differences can equal the no-data value
+    differences = numpy.stack(differences)
+    valid = ~numpy.stack(invalid_differences)
+    zero = numpy.zeros_like(differences)
+
+    if aggregate == "cumulative":
+        result = numpy.where(valid, differences, zero).sum(
+            axis=0, dtype=differences.dtype)
+    elif aggregate == "max":
+        magnitude = numpy.where(valid,
+            numpy.abs(differences.astype(numpy.float64)), -1.0)
+        index = numpy.argmax(magnitude, axis=0)
+        result = differences[(index,) + numpy.ix_(
+            *[numpy.arange(extent) for extent in index.shape])]
+
+    if nodata_value is not None:
+        result[~numpy.any(valid, axis=0)] = nodata_value
+
+    return result
 
-            assert lhs.shape == rhs.shape
 
-            result = lhs - rhs
-            result[
-                numpy.logical_or(
-                    lhs == lhs_nodata_value, rhs == rhs_nodata_value)] = \
-                nodata_value
+def _write_valid_blocks(
+        target_raster,
+        result,
+        nodata_value,
+        window):
 
-            target_raster.write(result)
+    # Blocks containing only no-data are not written
+    valid = None if nodata_value is None else \
+        numpy.any(result != nodata_value, axis=0)
+    write_valid_blocks(target_raster, result, valid, window)
@@ -0,0 +1,64 @@
+import rasterio
+
+
+def tile_windows(
+        nr_rows,
+        nr_cols,
+        tile_size):
+    """
+    Return the windows of square tiles of *tile_size* cells covering a
+    raster with the shape passed in
+
+    Pass *tile_size* as a (nr_rows, nr_cols) tuple for rectangular tiles.
+    Tiles at the bottom and right borders may be smaller.
+    """
+    nr_tile_rows, nr_tile_cols = tile_size \
+        if isinstance(tile_size, tuple) else (tile_size, tile_size)
+
+    return [
+        ((row, min(row + nr_tile_rows, nr_rows)),
+            (col, min(col + nr_tile_cols, nr_cols)))
+        for row in range(0, nr_rows, nr_tile_rows)
+        for col in range(0, nr_cols, nr_tile_cols)]
+
+
+def merge_raster_tiles(
+        template_raster_pathname,
+        tiles,
+        target_raster_pathname):
+    """
+    Merge rasters containing tiles of a larger raster into a single raster
+
+    *tiles* is a collection of (pathname, window) tuples. Each window
+    positions its tile within the template raster, whose extent the
+    target raster gets. The other properties of the target raster, like
+    its data type and color table, are taken from the first tile.
+    """
+    tiles = list(tiles)
+    assert len(tiles) > 0
+
+    with rasterio.open(template_raster_pathname) as template_raster, \
+            rasterio.open(tiles[0][0]) as tile_raster:
+
+        profile = tile_raster.profile
+        profile.update({
+            "height": template_raster.height,
+            "width": template_raster.width,
+            "transform": template_raster.transform,
+        })
+
+        try:
+            color_table = tile_raster.colormap(1)
+        except ValueError:
+            # Tile has no color table
+            color_table = None
+
+    with rasterio.open(target_raster_pathname, "w", **profile) as \
+            target_raster:
+
+        for tile_raster_pathname, window in tiles:
+            with rasterio.open(tile_raster_pathname) as tile_raster:
+                target_raster.write(tile_raster.read(), window=window)
+
+        if color_table is not None:
+            target_raster.write_colormap(1, color_table)
@@ -0,0 +1,681 @@
+#!/usr/bin/env python
+"""
+Load-test harness for the DataTools message handlers
+
+RabbitMQ, Geoserver and the plan / notifier services are replaced by
+in-process fakes, following the AMQP and REST interactions of the
+handlers. Synthetic plans are generated, and a mix of messages is
+replayed at a target rate. Throughput, latency percentiles, failures and
+queue depths over time are reported.
+"""
+import collections
+import contextlib
+import http.server
+import json
+import logging
+import os.path
+import random
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import numpy
+import rasterio
+from . import create_app, data_tools, dead_letter_queue_name, \
+    retry_queue_name
+from .local_broker import LocalBroker, Properties
+
+
+doc_string = """\
+Load-test the data tools
+
+usage:
+    {command} [--workers=<count>] [--rate=<rate>] [--duration=<seconds>]
+        [--size=<cells>] [--mix=<mix>] [--geoserver-latency=<seconds>]
+        [--retry-delay=<seconds>] [--directory=<directory>]
+    {command} (-h | --help)
+
+options:
+    -h --help                   Show this screen
+    --workers=<count>           Number of worker threads [default: 2]
+    --rate=<rate>               Messages published per second [default: 10]
+    --duration=<seconds>        Seconds to publish messages [default: 10]
+    --size=<cells>              Number of rows and columns of synthetic
+                                plans [default: 512]
+    --mix=<mix>                 Relative frequencies of messages per queue
+                                [default: register_raster=1,georeference_raster=1,retrieve_colors_of_raster=1,classify_raster=1]
+    --geoserver-latency=<seconds>  Latency of each Geoserver call
+                                [default: 0]
+    --retry-delay=<seconds>     Delay before the first retry of a failed
+                                message [default: 1]
+    --directory=<directory>     Directory to store synthetic plans in.
+                                Defaults to a temporary directory.
+
+The report is written to standard output, as JSON.
+"""
+
+
+# Colors of the cells in synthetic plans
+palette = numpy.array([
+        [255, 0, 0],
+        [0, 255, 0],
+        [0, 0, 255],
+        [0, 127, 0],
+        [127, 0, 0],
+        [0, 0, 0],
+    ], dtype=numpy.uint8)
+
+
+queue_names = [
+    "register_raster",
+    "georeference_raster",
+    "retrieve_colors_of_raster",
+    "classify_raster",
+]
+
+
+class _Resource(object):
+
+    def __init__(self,
+            kind,
+            name,
+            workspace=None):
+
+        self.kind = kind
+        self.name = name
+        self.workspace = workspace
+
+
+class FakeGeoserver(object):
+    """
+    In-process stand-in for Geoserver, keeping track of workspaces and
+    coverage stores
+
+    Each call made by a catalog takes *latency* seconds.
+    """
+
+    def __init__(self,
+            latency=0.0):
+
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.workspaces = set()
+        self.stores = {}
+
+
+    def catalog(self,
+            service_url,
+            username=None,
+            password=None):
+        """
+        Return a catalog connected to this Geoserver. Has the same
+        signature as the constructor of geoserver.catalog.Catalog.
+        """
+        return FakeCatalog(self)
+
+
+    @contextlib.contextmanager
+    def installed(self):
+        """
+        Context manager within which the data tools talk to this Geoserver
+        """
+        catalog = data_tools.Catalog
+        data_tools.Catalog = self.catalog
+
+        try:
+            yield self
+        finally:
+            data_tools.Catalog = catalog
+
+
+class FakeCatalog(object):
+    """
+    Stand-in for the subset of geoserver.catalog.Catalog used by the
+    data tools
+    """
+
+    def __init__(self,
+            geoserver):
+
+        self.geoserver = geoserver
+
+
+    def _call(self):
+        time.sleep(self.geoserver.latency)
+
+        return self.geoserver.lock
+
+
+    def get_workspaces(self):
+        with self._call():
+            return [_Resource("workspace", name) for name in
+                self.geoserver.workspaces]
+
+
+    def get_workspace(self,
+            name):
+        with self._call():
+            return _Resource("workspace", name) \
+                if name in self.geoserver.workspaces else None
+
+
+    def create_workspace(self,
+            name,
+            uri=None):
+        with self._call():
+            self.geoserver.workspaces.add(name)
+
+
+    def get_stores(self,
+            names=None,
+            workspaces=None):
+        with self._call():
+            return [_Resource("store", name, workspace) for
+                (workspace, name) in self.geoserver.stores
+                if workspaces is None or workspace == workspaces.name]
+
+
+    def get_store(self,
+            name,
+            workspace=None):
+        with self._call():
+            if (workspace.name, name) not in self.geoserver.stores:
+                raise RuntimeError("No store found named: {}".format(name))
+
+            return _Resource("store", name, workspace.name)
+
+
+    def create_coveragestore_external_geotiff(self,
+            name,
+            data,
+            workspace=None,
+            overwrite=False):
+        with self._call():
+            self.geoserver.stores[(workspace.name, name)] = data
+
+
+    def delete(self,
+            config_object,
+            purge=False,
+            recurse=False):
+        with self._call():
+            if config_object.kind == "store":
+                del self.geoserver.stores[
+                    (config_object.workspace, config_object.name)]
+            else:
+                self.geoserver.workspaces.discard(config_object.name)
+                self.geoserver.stores = {key: value for key, value in
+                    self.geoserver.stores.items()
+                    if key[0] != config_object.name}
+
+
+    def reload(self):
+        with self._call():
+            pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+        http.server.HTTPServer):
+
+    daemon_threads = True
+
+
+class FakePlanService(object):
+    """
+    In-process HTTP stand-in for the plan service and the client
+    notifier
+
+    Plans are served at /plans/<id> (GET, PATCH). Notifications are
+    accepted at /notifications (POST).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.plans = {}
+        self.notifications = []
+
+        service = self
+
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def _send(self,
+                    status,
+                    document):
+                body = json.dumps(document).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+
+            def _read(self):
+                length = int(self.headers.get("Content-Length", 0))
+
+                return json.loads(self.rfile.read(length).decode("utf-8"))
+
+
+            def do_GET(self):
+                with service.lock:
+                    plan = service.plans.get(self.path)
+
+                    if plan is None:
+                        self._send(404, {"message": "not found"})
+                    else:
+                        self._send(200, {"plan": dict(plan)})
+
+
+            def do_PATCH(self):
+                payload = self._read()
+
+                with service.lock:
+                    plan = service.plans.get(self.path)
+
+                    if plan is None:
+                        self._send(404, {"message": "not found"})
+                    else:
+                        plan.update(payload)
+                        self._send(200, {"plan": dict(plan)})
+
+
+            def do_POST(self):
+                payload = self._read()
+
+                with service.lock:
+                    service.notifications.append((time.time(), payload))
+
+                self._send(201, {})
+
+
+            def log_message(self,
+                    format,
+                    *args):
+                pass
+
+
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.uri = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def add_plan(self,
+            plan_id,
+            plan):
+        """
+        Add *plan* and return its URI
+        """
+        path = "/plans/{}".format(plan_id)
+
+        with self.lock:
+            self.plans[path] = plan
+
+        return "{}{}".format(self.uri, path)
+
+
+def create_synthetic_plan(
+        pathname,
+        nr_rows,
+        nr_cols,
+        seed=0):
+    """
+    Create an RGBA GeoTIFF with cells colored using the palette, as
+    created by registering an uploaded plan
+    """
+    random_state = numpy.random.RandomState(seed)
+    colors = palette[random_state.randint(
+        len(palette), size=(nr_rows, nr_cols))]
+
+    profile = {
+        "driver": "GTiff",
+        "width": nr_cols,
+        "height": nr_rows,
+        "dtype": numpy.uint8,
+        "count": 4,
+        "crs": "EPSG:3857",
+        "transform": rasterio.transform.from_origin(
+            0.0, float(nr_rows), 1.0, 1.0),
+        "photometric": "RGB",
+        "alpha": "YES",
+    }
+
+    with rasterio.open(pathname, "w", **profile) as raster:
+        for b in range(3):
+            raster.write(colors[:, :, b], b + 1)
+        raster.write(numpy.full((nr_rows, nr_cols), 255, numpy.uint8), 4)
+
+
+def percentiles(
+        values,
+        ranks=(50, 90, 99)):
+
+    if len(values) == 0:
+        return {}
+
+    return {"p{}".format(rank): float(numpy.percentile(values, rank)) for
+        rank in ranks}
+
+
+class LoadTest(object):
+    """
+    Replay a mix of messages at a target rate against DataTools handlers
+    running in worker threads
+
+    message_mix: Dict mapping queue names to relative frequencies
+
+    Messages whose handling failed, and which are retried later, are
+    reported as failures instead of as handled. The test ends once all
+    queues consumed, and their retry queues, are empty.
+    """
+
+    def __init__(self,
+            directory_pathname,
+            nr_workers=2,
+            rate=10.0,
+            duration=10.0,
+            nr_rows=512,
+            nr_cols=512,
+            message_mix=None,
+            geoserver_latency=0.0,
+            retry_delay=1.0,
+            sample_interval=0.25,
+            seed=0):
+
+        self.directory_pathname = directory_pathname
+        self.nr_workers = nr_workers
+        self.rate = rate
+        self.duration = duration
+        self.nr_rows = nr_rows
+        self.nr_cols = nr_cols
+        self.message_mix = message_mix or \
+            {queue_name: 1 for queue_name in queue_names}
+        self.geoserver_latency = geoserver_latency
+        self.retry_delay = retry_delay
+        self.sample_interval = sample_interval
+        self.random = random.Random(seed)
+
+        assert all([queue_name in queue_names for queue_name in
+            self.message_mix]), self.message_mix
+
+
+    def _message(self,
+            plan_service,
+            template_pathname,
+            queue_name,
+            index):
+        """
+        Create a plan in the state required by messages for *queue_name*,
+        and return the message body
+        """
+        pathname = os.path.join(
+            self.directory_pathname, "plan-{}.tif".format(index))
+        shutil.copy(template_pathname, pathname)
+        workspace_name = "user"
+
+        status = {
+            "register_raster": "uploaded",
+            "georeference_raster": "registered",
+            "retrieve_colors_of_raster": "georeferenced",
+            "classify_raster": "georeferenced",
+        }[queue_name]
+
+        plan_uri = plan_service.add_plan(index, {
+            "pathname": pathname,
+            "status": status,
+            "user": workspace_name,
+            "layer_name": "{}:plan-{}".format(workspace_name, index),
+        })
+
+        message = {"uri": plan_uri}
+
+        if queue_name == "register_raster":
+            message["workspace"] = workspace_name
+        elif queue_name == "georeference_raster":
+            # Corners of the raster, in pixel / line coordinates, mapped
+            # to world coordinates
+            x, y, cell_size = 600000.0, 6800000.0, 10.0
+            message["gcps"] = [
+                [[0, 0], [x, y]],
+                [[self.nr_cols, 0], [x + cell_size * self.nr_cols, y]],
+                [[0, self.nr_rows], [x, y - cell_size * self.nr_rows]],
+                [[self.nr_cols, self.nr_rows], [
+                    x + cell_size * self.nr_cols,
+                    y - cell_size * self.nr_rows]],
+            ]
+        elif queue_name == "retrieve_colors_of_raster":
+            message["client_id"] = "client-{}".format(index)
+        elif queue_name == "classify_raster":
+            message["lut"] = {str(tuple(int(value) for value in color)):
+                class_ for class_, color in enumerate(palette)}
+
+        return json.dumps(message)
+
+
+    def run(self):
+        """
+        Run the load test and return the report
+        """
+        geoserver = FakeGeoserver(latency=self.geoserver_latency)
+        geoserver.workspaces.add("user")
+        plan_service = FakePlanService()
+        plan_service.start()
+        broker = LocalBroker()
+
+        try:
+            with geoserver.installed():
+                return self._run(broker, plan_service)
+        finally:
+            plan_service.stop()
+
+
+    def _run(self,
+            broker,
+            plan_service):
+
+        app = create_app("test")
+        app.config.update({
+            "NC_GEOSERVER_URI": "http://geoserver",
+            "NC_CLIENT_NOTIFIER_URI": "{}/notifications".format(
+                plan_service.uri),
+            "NC_WORKER_CLASS": "all",
+            "NC_RETRY_DELAY": self.retry_delay,
+        })
+        app.channel = broker.channel()
+        app.setup_consumers()
+
+        # Keep track of the messages which were not handled, but retried
+        # later, or republished to a heavy queue
+        failures = []
+        republications = []
+        retry_later = app.retry_later
+        republish_to_heavy_queue = app.republish_to_heavy_queue
+
+        def record_failure(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            failures.append((method_frame.routing_key,
+                method_frame.delivery_tag))
+            retry_later(channel, method_frame, header_frame, body)
+
+
+        def record_republication(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            republications.append(method_frame.delivery_tag)
+            republish_to_heavy_queue(
+                channel, method_frame, header_frame, body)
+
+        app.retry_later = record_failure
+        app.republish_to_heavy_queue = record_republication
+
+        backlog_queue_names = []
+
+        for queue_name in app.consumed_queue_names():
+            backlog_queue_names.append(queue_name)
+            backlog_queue_names += [retry_queue_name(queue_name, delay) for
+                delay in app.retry_delays()]
+
+
+        # Generate the plans and messages up front, so generating them
+        # does not influence the measurements
+        template_pathname = os.path.join(
+            self.directory_pathname, "template.tif")
+        create_synthetic_plan(template_pathname, self.nr_rows, self.nr_cols)
+
+        nr_messages = max(1, int(round(self.rate * self.duration)))
+        population = sorted(self.message_mix)
+        weights = [self.message_mix[name] for name in population]
+        messages = []
+
+        for index in range(nr_messages):
+            queue_name = self.random.choices(population, weights)[0]
+            messages.append((queue_name, self._message(
+                plan_service, template_pathname, queue_name, index)))
+
+
+        stop = threading.Event()
+        depths = []
+
+
+        def work():
+            while not stop.is_set():
+                if not broker.deliver_one():
+                    time.sleep(0.001)
+
+
+        def sample():
+            while not stop.is_set():
+                depths.append((time.time() - start, broker.queue_depths()))
+                time.sleep(self.sample_interval)
+
+
+        start = time.time()
+        threads = [threading.Thread(target=work) for _ in
+            range(self.nr_workers)]
+        threads.append(threading.Thread(target=sample))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            for index, (queue_name, body) in enumerate(messages):
+                delay = start + index / self.rate - time.time()
+
+                if delay > 0:
+                    time.sleep(delay)
+
+                broker.publish(queue_name, body,
+                    Properties(timestamp=int(time.time())))
+
+            # Wait for the backlog to be handled, including retries
+            while any(broker.queue_depths()[name] > 0 for name in
+                    backlog_queue_names) or len(broker.unacked) > 0:
+                time.sleep(0.01)
+        finally:
+            stop.set()
+
+            for thread in threads:
+                thread.join()
+
+        end = time.time()
+
+        dead_letter_queue_names = [dead_letter_queue_name(queue_name) for
+            queue_name in app.consumed_queue_names()]
+
+        return self._report(broker, nr_messages, failures, republications,
+            dead_letter_queue_names, start, end, depths)
+
+
+    def _report(self,
+            broker,
+            nr_messages,
+            failures,
+            republications,
+            dead_letter_queue_names,
+            start,
+            end,
+            depths):
+
+        unhandled_delivery_tags = set(republications) | \
+            set([delivery_tag for _, delivery_tag in failures])
+        latencies = collections.defaultdict(list)
+
+        for queue_name, published_at, acknowledged_at, delivery_tag in \
+                broker.acknowledgements:
+            if delivery_tag not in unhandled_delivery_tags:
+                latencies[queue_name].append(acknowledged_at - published_at)
+
+        all_latencies = sum(latencies.values(), [])
+        failures_by_queue = collections.Counter(
+            [queue_name for queue_name, _ in failures])
+        queue_depths = broker.queue_depths()
+
+        return {
+            "nr_workers": self.nr_workers,
+            "target_rate": self.rate,
+            "raster_shape": [self.nr_rows, self.nr_cols],
+            "duration": end - start,
+            "nr_messages": nr_messages,
+            "nr_handled": len(all_latencies),
+            "nr_failures": len(failures),
+            "failures_by_queue": dict(failures_by_queue),
+            "nr_dead_lettered": sum([queue_depths[name] for name in
+                dead_letter_queue_names]),
+            "messages_per_second": len(all_latencies) / (end - start),
+            "latency": percentiles(all_latencies),
+            "latency_by_queue": {queue_name: percentiles(values) for
+                queue_name, values in latencies.items()},
+            "queue_depths": [{
+                    "time": time_,
+                    "depths": {name: depth for name, depth in
+                        depths_.items() if depth > 0}
+                } for time_, depths_ in depths],
+        }
+
+
+def parse_message_mix(
+        text):
+
+    return {name: float(weight) for name, weight in
+        [item.split("=") for item in text.split(",")]}
+
+
+if __name__ == "__main__":
+    import docopt
+
+    arguments = docopt.docopt(doc_string)
+    logging.getLogger("nc_data_tools").setLevel(logging.WARNING)
+
+    with contextlib.ExitStack() as stack:
+        directory_pathname = arguments["--directory"] or \
+            stack.enter_context(tempfile.TemporaryDirectory())
+
+        load_test = LoadTest(
+            directory_pathname,
+            nr_workers=int(arguments["--workers"]),
+            rate=float(arguments["--rate"]),
+            duration=float(arguments["--duration"]),
+            nr_rows=int(arguments["--size"]),
+            nr_cols=int(arguments["--size"]),
+            message_mix=parse_message_mix(arguments["--mix"]),
+            geoserver_latency=float(arguments["--geoserver-latency"]),
+            retry_delay=float(arguments["--retry-delay"]))
+
+        print(json.dumps(load_test.run(), indent=4))
@@ -0,0 +1,294 @@
+import collections
+import itertools
+import threading
+import time
+
+
+class Properties(object):
+    """
+    Stand-in for pika.BasicProperties
+    """
+
+    def __init__(self,
+            content_type=None,
+            correlation_id=None,
+            delivery_mode=None,
+            headers=None,
+            expiration=None,
+            timestamp=None):
+
+        self.content_type = content_type
+        self.correlation_id = correlation_id
+        self.delivery_mode = delivery_mode
+        self.headers = headers
+        self.expiration = expiration
+        self.timestamp = timestamp
+
+
+class MethodFrame(object):
+    """
+    Stand-in for pika.spec.Basic.Deliver
+    """
+
+    def __init__(self,
+            routing_key,
+            delivery_tag,
+            redelivered=False):
+
+        self.routing_key = routing_key
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+
+
+class _Message(object):
+
+    def __init__(self,
+            body,
+            properties):
+
+        self.body = body
+        self.properties = properties
+        self.published_at = time.time()
+
+
+class _DeclareResult(object):
+
+    class Method(object):
+
+        def __init__(self,
+                queue,
+                message_count,
+                consumer_count):
+
+            self.queue = queue
+            self.message_count = message_count
+            self.consumer_count = consumer_count
+
+
+    def __init__(self,
+            queue,
+            message_count,
+            consumer_count):
+
+        self.method = _DeclareResult.Method(
+            queue, message_count, consumer_count)
+
+
+class LocalBroker(object):
+    """
+    In-process stand-in for a RabbitMQ broker
+
+    Only the default exchange is supported: messages are published
+    directly to the queue named by their routing key. Queues declared
+    with the x-dead-letter-routing-key argument move messages whose
+    expiration (per message, or the queue's x-message-ttl) has passed to
+    the dead-letter queue. This is sufficient to
+    exercise the AMQP interactions of the DataTools handlers without a
+    live broker.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.queues = collections.OrderedDict()
+        self.arguments = {}
+        self.consumers = collections.OrderedDict()
+        self.unacked = {}
+        self.delivery_tags = itertools.count(1)
+
+        # (queue name, published at, acknowledged at, delivery tag) per
+        # message acknowledged
+        self.acknowledgements = []
+
+
+    def channel(self):
+        return LocalChannel(self)
+
+
+    def queue_declare(self,
+            queue,
+            passive=False,
+            arguments=None):
+
+        with self.lock:
+            if queue not in self.queues:
+                if passive:
+                    raise KeyError("queue {} does not exist".format(queue))
+
+                self.queues[queue] = collections.deque()
+                self.arguments[queue] = dict(arguments or {})
+
+            return _DeclareResult(queue, len(self.queues[queue]),
+                len(self.consumers.get(queue, [])))
+
+
+    def publish(self,
+            routing_key,
+            body,
+            properties=None):
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        with self.lock:
+            self.queues[routing_key].append(
+                _Message(body, properties or Properties()))
+
+
+    def queue_depths(self):
+        """
+        Return a dict mapping queue names to the number of messages in them
+        """
+        with self.lock:
+            return {name: len(messages) for name, messages in
+                self.queues.items()}
+
+
+    def _expire_messages(self):
+        now = time.time()
+
+        for name, messages in self.queues.items():
+            routing_key = self.arguments[name].get("x-dead-letter-routing-key")
+            ttl = self.arguments[name].get("x-message-ttl")
+
+            while routing_key is not None and len(messages) > 0:
+                expiration = messages[0].properties.expiration
+
+                if expiration is None:
+                    expiration = ttl
+
+                if expiration is None or messages[0].published_at + \
+                        float(expiration) / 1000 > now:
+                    break
+
+                message = messages.popleft()
+                message.published_at = now
+                self.queues[routing_key].append(message)
+
+
+    def deliver_one(self):
+        """
+        Deliver a single message to a consumer of its queue
+
+        Returns whether a message was delivered.
+        """
+        with self.lock:
+            self._expire_messages()
+
+            for name, messages in self.queues.items():
+                if len(messages) > 0 and self.consumers.get(name):
+                    message = messages.popleft()
+                    channel, callback = self.consumers[name][0]
+                    # Round-robin over the consumers of the queue
+                    self.consumers[name].rotate(-1)
+                    delivery_tag = next(self.delivery_tags)
+                    self.unacked[delivery_tag] = (name, message)
+                    break
+            else:
+                return False
+
+        callback(channel, MethodFrame(name, delivery_tag),
+            message.properties, message.body)
+
+        return True
+
+
+    def deliver_all(self,
+            timeout=None):
+        """
+        Deliver messages until no messages can be delivered anymore
+
+        Messages waiting for their expiration are waited for, until
+        *timeout* seconds have passed.
+        """
+        start = time.time()
+
+        while True:
+            if not self.deliver_one():
+                with self.lock:
+                    waiting = any([len(messages) > 0 and
+                        self.arguments[name].get("x-dead-letter-routing-key")
+                        for name, messages in self.queues.items()])
+
+                if not waiting or timeout is None or \
+                        time.time() - start > timeout:
+                    break
+
+                time.sleep(0.01)
+
+
+    def ack(self,
+            delivery_tag):
+
+        with self.lock:
+            name, message = self.unacked.pop(delivery_tag)
+            self.acknowledgements.append(
+                (name, message.published_at, time.time(), delivery_tag))
+
+
+    def nack(self,
+            delivery_tag,
+            requeue=True):
+
+        with self.lock:
+            name, message = self.unacked.pop(delivery_tag)
+
+            if requeue:
+                self.queues[name].appendleft(message)
+
+
+class LocalChannel(object):
+    """
+    Stand-in for pika.channel.Channel, connected to a LocalBroker
+    """
+
+    def __init__(self,
+            broker):
+
+        self.broker = broker
+
+
+    def basic_qos(self,
+            prefetch_count=0):
+        pass
+
+
+    def queue_declare(self,
+            queue,
+            durable=False,
+            passive=False,
+            arguments=None):
+
+        return self.broker.queue_declare(
+            queue, passive=passive, arguments=arguments)
+
+
+    def basic_consume(self,
+            consumer_callback,
+            queue):
+
+        with self.broker.lock:
+            self.broker.consumers.setdefault(
+                queue, collections.deque()).append((self, consumer_callback))
+
+
+    def basic_publish(self,
+            exchange,
+            routing_key,
+            body,
+            properties=None):
+
+        assert exchange == "", "only the default exchange is supported"
+        self.broker.publish(routing_key, body, properties)
+
+
+    def basic_ack(self,
+            delivery_tag):
+
+        self.broker.ack(delivery_tag)
+
+
+    def basic_nack(self,
+            delivery_tag,
+            requeue=True):
+
+        self.broker.nack(delivery_tag, requeue=requeue)
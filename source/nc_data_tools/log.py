@@ -0,0 +1,153 @@
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import uuid
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Format log records as single-line JSON documents
+
+    Additional fields passed in a record's *fields* attribute (e.g. a
+    correlation id) are added to the document.
+    """
+
+    def format(self,
+            record):
+
+        document = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        document.update(getattr(record, "fields", {}))
+
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            document["exception"] = record.exc_text
+
+        return json.dumps(document, default=str)
+
+
+class MessageLogger(logging.LoggerAdapter):
+    """
+    Logger adapter adding the fields passed in on construction (e.g. a
+    correlation id) to each record logged
+
+    Fields for individual records can be passed using the *fields*
+    keyword argument.
+    """
+
+    def process(self,
+            msg,
+            kwargs):
+
+        fields = dict(self.extra)
+        fields.update(kwargs.pop("fields", {}))
+        kwargs["extra"] = {"fields": fields}
+
+        return msg, kwargs
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self,
+            record):
+        # Only merge the arguments into the message in the calling thread.
+        # Formatting the record is left to the listener's thread.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+def configure_logging(
+        level="INFO"):
+    """
+    Configure logging of the nc_data_tools loggers
+
+    Records are put in a queue by the thread logging them, and formatted
+    and written to standard output by a separate thread. Logging a record
+    does not block on I/O.
+    """
+    logger = logging.getLogger("nc_data_tools")
+    logger.setLevel(level)
+
+    if not any([isinstance(handler, _QueueHandler) for handler in
+            logger.handlers]):
+
+        records = queue.Queue(-1)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(StructuredFormatter())
+        listener = logging.handlers.QueueListener(records, stream_handler)
+
+        logger.addHandler(_QueueHandler(records))
+        logger.propagate = False
+        listener.start()
+        atexit.register(listener.stop)
+
+    return logger
+
+
+def correlation_id(
+        header_frame):
+    """
+    Return the correlation id of the message whose properties are passed
+    in
+
+    Messages without a correlation id are assigned a new one. It is
+    stored in the message properties, so it is passed on when the message
+    is republished.
+    """
+    if header_frame.correlation_id is None:
+        header_frame.correlation_id = uuid.uuid4().hex
+
+    return header_frame.correlation_id
+
+
+def summarise(
+        value,
+        max_size=20):
+    """
+    Return a summary of *value*, fit for logging
+
+    Collections with more than *max_size* elements are replaced by their
+    first elements and their total size, and long strings are truncated.
+    Only the part of *value* ending up in the summary is visited.
+    """
+    if isinstance(value, (bytes, str)):
+        limit = 10 * max_size
+
+        if len(value) > limit:
+            value = "{}... ({} characters)".format(value[:limit], len(value))
+
+        return value
+    elif isinstance(value, dict):
+        items = itertools.islice(value.items(), max_size)
+        summary = {key: summarise(item, max_size) for key, item in items}
+
+        if len(value) > max_size:
+            summary["..."] = "{} items".format(len(value))
+
+        return summary
+    elif isinstance(value, (list, tuple)):
+        summary = [summarise(item, max_size) for item in value[:max_size]]
+
+        if len(value) > max_size:
+            summary.append("... ({} items)".format(len(value)))
+
+        return summary
+    else:
+        return value
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Opt-in profiling of message handlers
+
+Each profiled message results in two files in the profile directory: a
+cProfile dump (.prof), loadable with pstats, and a JSON document (.json)
+with the plan URI, the duration, the peak memory usage and the source
+lines allocating most memory.
+"""
+import cProfile
+import contextlib
+import glob
+import json
+import os
+import os.path
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+
+
+doc_string = """\
+Summarise the hottest functions across profile dumps
+
+usage:
+    {command} [--sort=<key>] [--count=<count>] [--queue=<name>]
+        <directory>
+    {command} (-h | --help)
+
+arguments:
+    directory   Directory containing the profile dumps
+
+options:
+    -h --help           Show this screen
+    --sort=<key>        Key to sort functions by: cumulative, tottime or
+                        ncalls [default: cumulative]
+    --count=<count>     Number of functions to print [default: 25]
+    --queue=<name>      Only summarise dumps of messages from this queue
+
+Statistics of all dumps selected are added. The peak memory usage of the
+messages is summarised as well.
+"""
+
+
+# Number of allocation sites stored per profiled message
+nr_allocation_sites = 10
+
+
+# tracemalloc traces all threads. Only one message is profiled at a time,
+# so the memory statistics can be attributed to it.
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def profile(
+        directory_pathname,
+        name,
+        fields=None):
+    """
+    Profile the CPU and memory usage of the code executed in the context
+
+    The dumps are named after *name*. The JSON serializable *fields*
+    (e.g. the plan URI) are stored in the JSON document. In case another
+    thread is already profiling, the code is executed without profiling.
+    """
+    if not _lock.acquire(blocking=False):
+        yield
+        return
+
+    try:
+        was_tracing = tracemalloc.is_tracing()
+
+        if not was_tracing:
+            tracemalloc.start()
+
+        tracemalloc.clear_traces()
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration = time.time() - start
+            _, peak_memory = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+
+            if not was_tracing:
+                tracemalloc.stop()
+
+            base_pathname = os.path.join(directory_pathname, "{}-{}-{}".format(
+                name, time.strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:8]))
+            profiler.dump_stats("{}.prof".format(base_pathname))
+
+            document = {
+                "name": name,
+                "fields": fields or {},
+                "duration": duration,
+                "peak_memory": peak_memory,
+                "allocations": [{
+                        "location": str(statistic.traceback),
+                        "size": statistic.size,
+                        "count": statistic.count,
+                    } for statistic in
+                        snapshot.statistics("lineno")[:nr_allocation_sites]],
+            }
+
+            with open("{}.json".format(base_pathname), "w") as file:
+                json.dump(document, file, indent=4)
+    finally:
+        _lock.release()
+
+
+class MessageProfiler(object):
+    """
+    Profile a sampled fraction of the messages handled for selected queues
+
+    queue_names: Names of the queues whose messages to profile. Messages
+        from the corresponding heavy queues are profiled as well. Pass
+        None to profile messages from all queues.
+    sample_rate: Fraction of the messages to profile
+    """
+
+    def __init__(self,
+            directory_pathname,
+            queue_names=None,
+            sample_rate=1.0):
+
+        self.directory_pathname = directory_pathname
+        self.queue_names = queue_names
+        self.sample_rate = sample_rate
+
+        os.makedirs(directory_pathname, exist_ok=True)
+
+
+    def should_profile(self,
+            queue_name):
+
+        return (self.queue_names is None or
+                queue_name in self.queue_names or
+                queue_name.rsplit("_heavy", 1)[0] in self.queue_names) and \
+            random.random() < self.sample_rate
+
+
+    def wrap(self,
+            handler):
+        """
+        Return a message handler which profiles *handler*
+        """
+
+        def profiled_handler(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            queue_name = method_frame.routing_key
+
+            if not self.should_profile(queue_name):
+                return handler(channel, method_frame, header_frame, body)
+
+            try:
+                uri = json.loads(body.decode("utf-8")).get("uri")
+            except Exception:
+                uri = None
+
+            fields = {
+                "queue": queue_name,
+                "uri": uri,
+                "correlation_id": getattr(
+                    header_frame, "correlation_id", None),
+            }
+
+            with profile(self.directory_pathname, queue_name, fields):
+                return handler(channel, method_frame, header_frame, body)
+
+
+        return profiled_handler
+
+
+def summarise_profiles(
+        directory_pathname,
+        sort_key="cumulative",
+        nr_functions=25,
+        queue_name=None):
+    """
+    Return the hottest functions across the profile dumps in
+    *directory_pathname*, together with summary statistics of the
+    profiled messages
+
+    Functions are returned as dicts, ordered by *sort_key*.
+    """
+    assert sort_key in ["cumulative", "tottime", "ncalls"], sort_key
+
+    documents = []
+    stats = None
+
+    for document_pathname in sorted(glob.glob(
+            os.path.join(directory_pathname, "*.json"))):
+        with open(document_pathname) as file:
+            document = json.load(file)
+
+        if queue_name is not None and document["name"] != queue_name:
+            continue
+
+        profile_pathname = "{}.prof".format(
+            os.path.splitext(document_pathname)[0])
+
+        if not os.path.exists(profile_pathname):
+            continue
+
+        documents.append(document)
+
+        if stats is None:
+            stats = pstats.Stats(profile_pathname)
+        else:
+            stats.add(profile_pathname)
+
+    functions = []
+
+    if stats is not None:
+        index = {"ncalls": 1, "tottime": 2, "cumulative": 3}[sort_key]
+        rows = sorted(stats.stats.items(),
+            key=lambda item: item[1][index], reverse=True)
+
+        for (filename, line, function), (_, ncalls, tottime, cumtime, _) \
+                in rows[:nr_functions]:
+            functions.append({
+                "function": "{}:{}({})".format(filename, line, function),
+                "ncalls": ncalls,
+                "tottime": tottime,
+                "cumtime": cumtime,
+            })
+
+    return {
+        "nr_messages": len(documents),
+        "duration": sum([document["duration"] for document in documents]),
+        "max_peak_memory": max([document["peak_memory"] for document in
+            documents], default=0),
+        "functions": functions,
+    }
+
+
+if __name__ == "__main__":
+    import docopt
+
+    arguments = docopt.docopt(doc_string)
+    summary = summarise_profiles(
+        arguments["<directory>"],
+        sort_key=arguments["--sort"],
+        nr_functions=int(arguments["--count"]),
+        queue_name=arguments["--queue"])
+
+    print("{} messages, {:.3f} s in total, max peak memory {} bytes".format(
+        summary["nr_messages"], summary["duration"],
+        summary["max_peak_memory"]))
+    print()
+    print("{:>10} {:>10} {:>10}  {}".format(
+        "ncalls", "tottime", "cumtime", "function"))
+
+    for function in summary["functions"]:
+        print("{ncalls:>10} {tottime:>10.3f} {cumtime:>10.3f}  {function}"
+            .format(**function))
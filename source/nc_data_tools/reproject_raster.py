@@ -4,7 +4,8 @@ import sys
 import docopt
 import rasterio
 import rasterio.warp as warp
-from data_tools import reproject_raster_given_template
+from configuration import Configuration
+from data_tools import gdal_environment, reproject_raster_given_template
 
 
 doc_string = """\
@@ -30,6 +31,10 @@ options:
 A new raster will be created with the same projection properties as the
 template raster. The cell values will be read from the source raster.
 
+GDAL is configured using the same environment variables as the data
+tools (NC_GDAL_ENVIRONMENT, NC_GDAL_OPERATION_ENVIRONMENT, using
+operation reproject_raster).
+
 Only pass coordinate reference systems in case these cannot be obtained
 from the source and template rasters themselves.
 """
@@ -61,8 +66,14 @@ if __name__ == "__main__":
     elif arguments["average"]:
         method = warp.RESAMPLING.average
 
-    reproject_raster_given_template(
-        source_raster_pathname, template_raster_pathname,
-        target_raster_pathname, resampling_method=method,
-        source_options=source_options, template_options=template_options,
-        target_options=target_options)
+    gdal_options = dict(Configuration.NC_GDAL_ENVIRONMENT)
+    gdal_options.update(Configuration.NC_GDAL_OPERATION_ENVIRONMENT.get(
+        "reproject_raster", {}))
+
+    with gdal_environment(**gdal_options):
+        reproject_raster_given_template(
+            source_raster_pathname, template_raster_pathname,
+            target_raster_pathname, resampling_method=method,
+            source_options=source_options,
+            template_options=template_options,
+            target_options=target_options)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import json
+import docopt
+from configuration import Configuration
+from data_tools import gdal_environment, Pipeline
+
+
+doc_string = """\
+Run a chain of data tools operations
+
+usage:
+    {command} [--on-disk] [--max-memory=<bytes>] <pipeline>
+    {command} (-h | --help)
+
+arguments:
+    pipeline    Name of JSON file describing the pipeline
+
+options:
+    -h --help               Show this screen
+    --on-disk               Store intermediate rasters in a temporary
+                            directory, instead of in memory
+    --max-memory=<bytes>    Maximum amount of memory to use per operation
+
+The pipeline file contains an object with the source raster, the steps
+to perform, and the target raster. For example:
+
+{
+    "source": "dem.asc",
+    "steps": [
+        {"operation": "reformat", "crs": "EPSG:28992"},
+        {"operation": "reproject", "template": "grid.tif",
+            "resampling": "average"},
+        {"operation": "clip", "clip": "area.tif"},
+        {"operation": "subtract", "rhs": "reference.tif"}
+    ],
+    "target": "difference.tif"
+}
+
+Intermediate rasters are removed afterwards.
+
+GDAL is configured using the same environment variable as the data
+tools (NC_GDAL_ENVIRONMENT).
+"""
+
+
+if __name__ == "__main__":
+    arguments = docopt.docopt(doc_string)
+
+    with open(arguments["<pipeline>"]) as file:
+        pipeline = Pipeline.from_spec(json.load(file))
+
+    max_memory = arguments["--max-memory"]
+
+    with gdal_environment(**Configuration.NC_GDAL_ENVIRONMENT):
+        pipeline.run(
+            in_memory=not arguments["--on-disk"],
+            max_memory=None if max_memory is None else int(max_memory))
@@ -0,0 +1,231 @@
+import contextlib
+import glob
+import json
+import os
+import os.path
+import shutil
+import uuid
+import pika
+from .data_tools import *
+from .data_tools import _classify_raster
+
+
+# Name of the queue in which tile sub-tasks are published
+tile_queue_name = "process_raster_tile"
+
+
+def _manifest_pathname(
+        job_directory_pathname):
+
+    return os.path.join(job_directory_pathname, "job.json")
+
+
+def _tile_pathname(
+        job_directory_pathname,
+        tile_index,
+        extension):
+
+    return os.path.join(job_directory_pathname,
+        "tile-{}{}".format(tile_index, extension))
+
+
+def _gather_pathname(
+        job_directory_pathname):
+
+    return os.path.join(job_directory_pathname, "gather")
+
+
+def _window(
+        window):
+    # Windows are stored as nested lists in the manifest
+    return tuple(tuple(extent) for extent in window)
+
+
+def read_manifest(
+        job_directory_pathname):
+
+    with open(_manifest_pathname(job_directory_pathname)) as file:
+        return json.load(file)
+
+
+def scatter(
+        channel,
+        operation,
+        pathname,
+        arguments,
+        continuation,
+        tile_size,
+        properties=None):
+    """
+    Split the job of performing *operation* on the raster pointed to by
+    *pathname* into tile sub-tasks, and publish those to the tile queue
+
+    operation: "classify_raster" or "retrieve_colors"
+    arguments: JSON serializable arguments of the operation
+    continuation: JSON serializable information needed to finish the job
+        once all tiles have been processed
+
+    A job directory is created next to the raster, containing a manifest
+    describing the job. Results of tile sub-tasks are stored in this
+    directory as well. Returns the pathname of the job directory.
+    """
+    assert operation in ["classify_raster", "retrieve_colors"], operation
+
+    with rasterio.open(pathname) as raster:
+        windows = tile_windows(raster.height, raster.width, tile_size)
+
+    job_directory_pathname = "{}_tiles-{}".format(
+        os.path.splitext(pathname)[0], uuid.uuid4().hex)
+    os.mkdir(job_directory_pathname)
+
+    manifest = {
+        "operation": operation,
+        "pathname": pathname,
+        "arguments": arguments,
+        "continuation": continuation,
+        "windows": windows,
+    }
+
+    with open(_manifest_pathname(job_directory_pathname), "w") as file:
+        json.dump(manifest, file)
+
+    for tile_index in range(len(windows)):
+        channel.basic_publish(
+            exchange="",
+            routing_key=tile_queue_name,
+            body=json.dumps({
+                "job": job_directory_pathname,
+                "tile": tile_index
+            }),
+            properties=properties or pika.BasicProperties(delivery_mode=2))
+
+    return job_directory_pathname
+
+
+def process_tile(
+        job_directory_pathname,
+        tile_index,
+        max_memory=None):
+    """
+    Perform the sub-task of processing a single tile of a job
+
+    Returns whether the caller must gather the results of the job. This
+    is the case for exactly one of the callers, once all tiles of the job
+    have been processed.
+
+    *max_memory* is the memory budget of processing the tile, in bytes.
+    """
+    if not os.path.exists(_manifest_pathname(job_directory_pathname)):
+        # Redelivered message of a job which has already been gathered
+        return False
+
+    manifest = read_manifest(job_directory_pathname)
+    operation = manifest["operation"]
+    pathname = manifest["pathname"]
+    arguments = manifest["arguments"]
+    window = _window(manifest["windows"][tile_index])
+
+    if operation == "classify_raster":
+        with atomic_pathname(_tile_pathname(
+                job_directory_pathname, tile_index, ".tif")) as \
+                    tile_pathname:
+            _classify_raster(pathname, decode_lut(arguments["lut"]),
+                tile_pathname,
+                color_table=parse_color_table(arguments["color_table"]),
+                max_color_distance=arguments.get("max_color_distance"),
+                window=window,
+                max_memory=max_memory)
+    elif operation == "retrieve_colors":
+        colors = retrieve_colors(pathname, window=window,
+            max_memory=max_memory)
+
+        with atomic_pathname(_tile_pathname(
+                job_directory_pathname, tile_index, ".json")) as \
+                    tile_pathname:
+            with open(tile_pathname, "w") as file:
+                json.dump(colors, file)
+
+    # Mark tile as done. Multiple workers can finish the last tiles at the
+    # same time, but only one of them can create the gather marker.
+    open(_tile_pathname(job_directory_pathname, tile_index, ".done"),
+        "w").close()
+
+    nr_tiles_done = len(glob.glob(
+        os.path.join(job_directory_pathname, "tile-*.done")))
+
+    if nr_tiles_done < len(manifest["windows"]):
+        return False
+
+    try:
+        os.close(os.open(_gather_pathname(job_directory_pathname),
+            os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return False
+
+    return True
+
+
+def gather(
+        job_directory_pathname,
+        result_pathname=None):
+    """
+    Combine the results of all tiles of a job
+
+    For classify_raster, the classified tiles are merged into a single
+    raster, stored at *result_pathname*. For retrieve_colors, the union
+    of the colors found in the tiles is returned.
+
+    Call this within :func:`gathering`, which removes the job directory
+    afterwards.
+    """
+    manifest = read_manifest(job_directory_pathname)
+    operation = manifest["operation"]
+    windows = [_window(window) for window in manifest["windows"]]
+
+    if operation == "classify_raster":
+        assert result_pathname is not None
+
+        with atomic_pathname(result_pathname) as temporary_pathname:
+            tiles = [(_tile_pathname(
+                    job_directory_pathname, tile_index, ".tif"), window)
+                for tile_index, window in enumerate(windows)]
+            merge_raster_tiles(manifest["pathname"], tiles, temporary_pathname)
+
+            continuation = manifest["continuation"] or {}
+            idempotency_key = continuation.get("idempotency_key")
+
+            if idempotency_key is not None:
+                mark_stage_completed(temporary_pathname, idempotency_key)
+
+        result = result_pathname
+    elif operation == "retrieve_colors":
+        colors = set()
+
+        for tile_index in range(len(windows)):
+            with open(_tile_pathname(
+                    job_directory_pathname, tile_index, ".json")) as file:
+                colors.update([tuple(color) for color in json.load(file)])
+
+        result = sorted(colors)
+
+    return result
+
+
+@contextlib.contextmanager
+def gathering(
+        job_directory_pathname):
+    """
+    Context manager for finishing a job, once :func:`process_tile` has
+    returned True
+
+    The job directory is removed when the block exits normally. Otherwise,
+    the gather marker is removed, so the job is gathered again when a
+    message of one of its tiles is redelivered.
+    """
+    try:
+        yield
+    except BaseException:
+        os.remove(_gather_pathname(job_directory_pathname))
+        raise
+
+    shutil.rmtree(job_directory_pathname)
@@ -0,0 +1,259 @@
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import pika
+from . import create_app
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScalingPolicy(object):
+    """
+    Policy for determining the number of worker processes, given the
+    backlog of messages and the CPU load
+
+    Each worker is assumed to be able to keep up with *backlog_per_worker*
+    messages waiting. Workers are only added while the load average per
+    CPU is below *max_load*. Workers are removed one at a time, so a
+    short lull does not stop all of them.
+    """
+
+    def __init__(self,
+            min_workers,
+            max_workers,
+            backlog_per_worker,
+            max_load):
+
+        assert 0 <= min_workers <= max_workers, (min_workers, max_workers)
+        assert backlog_per_worker > 0, backlog_per_worker
+
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.backlog_per_worker = backlog_per_worker
+        self.max_load = max_load
+
+
+    def nr_workers(self,
+            nr_workers,
+            backlog,
+            load):
+        """
+        Return the number of workers to use, given the current number of
+        workers, the number of messages waiting, and the load average per
+        CPU
+        """
+        nr_workers_required = int(math.ceil(
+            backlog / self.backlog_per_worker))
+
+        if nr_workers_required > nr_workers:
+            if load < self.max_load:
+                nr_workers = nr_workers_required
+        elif nr_workers_required < nr_workers:
+            nr_workers -= 1
+
+        return max(self.min_workers, min(nr_workers, self.max_workers))
+
+
+def _run_worker(
+        target,
+        args):
+
+    # Move the worker to its own process group, so an interrupt from a
+    # terminal only reaches the supervisor, which forwards it once
+    os.setpgid(0, 0)
+
+    try:
+        target(*args)
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor(object):
+    """
+    Run worker processes consuming messages, scaling their number
+    according to a policy
+
+    The number of messages waiting in the queues is obtained by declaring
+    them passively. Workers are stopped by interrupting them. They finish
+    the job they are running before they exit.
+    """
+
+    def __init__(self,
+            channel,
+            queue_names,
+            policy,
+            worker_target,
+            worker_args=()):
+
+        self.channel = channel
+        self.queue_names = queue_names
+        self.policy = policy
+        self.worker_target = worker_target
+        self.worker_args = worker_args
+        self.context = multiprocessing.get_context("spawn")
+
+        # Running workers, newest last
+        self.workers = []
+
+        # Workers that have been interrupted, and are finishing their job
+        self.draining_workers = []
+
+
+    def backlog(self):
+        """
+        Return the number of messages waiting in the queues
+        """
+        return sum([self.channel.queue_declare(
+            queue=queue_name, durable=True, passive=True).method.message_count
+                for queue_name in self.queue_names])
+
+
+    def load(self):
+        """
+        Return the load average (last minute) per CPU
+        """
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+
+
+    def start_worker(self):
+
+        worker = self.context.Process(target=_run_worker,
+            args=(self.worker_target, self.worker_args))
+        worker.start()
+        self.workers.append(worker)
+
+        logger.info("Started worker", extra={"fields": {"pid": worker.pid}})
+
+
+    def stop_worker(self):
+
+        worker = self.workers.pop()
+        os.kill(worker.pid, signal.SIGINT)
+        self.draining_workers.append(worker)
+
+        logger.info("Stopping worker", extra={"fields": {"pid": worker.pid}})
+
+
+    def reap(self):
+        """
+        Forget about workers that have exited
+        """
+        for worker in self.workers:
+            if not worker.is_alive():
+                logger.warning("Worker exited", extra={"fields": {
+                    "pid": worker.pid, "exitcode": worker.exitcode}})
+
+        for worker in self.draining_workers:
+            if not worker.is_alive():
+                logger.info("Worker stopped", extra={"fields": {
+                    "pid": worker.pid}})
+
+        self.workers = [worker for worker in self.workers if
+            worker.is_alive()]
+        self.draining_workers = [worker for worker in self.draining_workers
+            if worker.is_alive()]
+
+
+    def scale(self,
+            nr_workers):
+
+        while len(self.workers) < nr_workers:
+            self.start_worker()
+
+        while len(self.workers) > nr_workers:
+            self.stop_worker()
+
+
+    def check(self):
+        """
+        Scale the number of workers according to the current backlog and
+        load
+        """
+        self.reap()
+
+        backlog = self.backlog()
+        load = self.load()
+        nr_workers = self.policy.nr_workers(len(self.workers), backlog, load)
+
+        if nr_workers != len(self.workers):
+            logger.info("Scale workers", extra={"fields": {
+                "backlog": backlog,
+                "load": load,
+                "nr_workers": len(self.workers),
+                "new_nr_workers": nr_workers,
+            }})
+
+        self.scale(nr_workers)
+
+
+    def shutdown(self):
+        """
+        Stop all workers, and wait for them to finish their jobs
+        """
+        while self.workers:
+            self.stop_worker()
+
+        for worker in self.draining_workers:
+            worker.join()
+
+        self.draining_workers = []
+
+
+def _interrupt(
+        signal_number,
+        frame):
+
+    raise KeyboardInterrupt()
+
+
+def run_worker(
+        configuration_name):
+
+    # Stop gracefully when terminated as well
+    signal.signal(signal.SIGTERM, _interrupt)
+    create_app(configuration_name).run(host="0.0.0.0")
+
+
+def supervise(
+        configuration_name):
+    """
+    Run and scale worker processes, until interrupted or terminated
+    """
+    app = create_app(configuration_name)
+    connection = pika.BlockingConnection(app.connection_parameters())
+    app.channel = connection.channel()
+
+    # Declare the queues up front, so they can be declared passively
+    # before the first worker has started
+    queue_names = app.consumed_queue_names()
+
+    for queue_name in queue_names:
+        app.declare_queue(queue_name)
+
+    policy = ScalingPolicy(
+        min_workers=app.config["NC_MIN_WORKERS"],
+        max_workers=app.config["NC_MAX_WORKERS"],
+        backlog_per_worker=app.config["NC_SCALE_BACKLOG_PER_WORKER"],
+        max_load=app.config["NC_SCALE_MAX_LOAD"])
+    supervisor = Supervisor(app.channel, queue_names, policy,
+        worker_target=run_worker, worker_args=(configuration_name,))
+
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    try:
+        while True:
+            supervisor.check()
+
+            # Sleep while servicing heartbeats
+            connection.sleep(app.config["NC_SCALE_INTERVAL"])
+    except KeyboardInterrupt:
+        pass
+
+    logger.info("Stop workers...")
+    supervisor.shutdown()
+
+    logger.info("Close connection...")
+    connection.close()
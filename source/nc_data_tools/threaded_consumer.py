@@ -0,0 +1,135 @@
+import concurrent.futures
+import functools
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadSafeChannel(object):
+    """
+    Proxy of a pika channel, which can be used from threads other than
+    the connection's thread
+
+    Calls of channel methods (e.g. basic_ack, basic_publish) are not
+    performed directly, but scheduled on the connection's thread. They are
+    performed in the order in which they are made.
+    """
+
+    def __init__(self,
+            connection,
+            channel):
+
+        self._connection = connection
+        self._channel = channel
+
+        # Whether the message handled has been acknowledged or rejected
+        self.settled = False
+
+
+    def __getattr__(self,
+            name):
+
+        method = getattr(self._channel, name)
+
+        def schedule(
+                *args,
+                **kwargs):
+
+            if name in ["basic_ack", "basic_nack", "basic_reject"]:
+                self.settled = True
+
+            self._connection.add_callback_threadsafe(
+                functools.partial(method, *args, **kwargs))
+
+        return schedule
+
+
+class ThreadedConsumer(object):
+    """
+    Run message handlers on a worker thread, keeping the connection's
+    thread free to service heartbeats
+
+    Handlers receive a ThreadSafeChannel, so acknowledging and publishing
+    messages is done by the connection's thread once the job is done.
+    Since the channel's prefetch count is 1, a single worker thread
+    suffices.
+
+    In case a handler raises an exception before it has acknowledged its
+    message, the message is passed to *retry_later* and acknowledged.
+    Without *retry_later*, or in case it fails as well, the message is
+    rejected without requeueing it. Otherwise the worker would stop
+    receiving messages, or receive a message failing deterministically
+    over and over again.
+    """
+
+    def __init__(self,
+            connection,
+            nr_threads=1,
+            retry_later=None):
+
+        self.connection = connection
+        self.retry_later = retry_later
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=nr_threads)
+
+
+    def wrap(self,
+            handler):
+        """
+        Return a message handler which submits *handler* to the worker
+        thread and returns immediately
+        """
+
+        def submit(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            thread_safe_channel = ThreadSafeChannel(self.connection, channel)
+            future = self.executor.submit(handler, thread_safe_channel,
+                method_frame, header_frame, body)
+            future.add_done_callback(functools.partial(
+                self._handle_failure, thread_safe_channel, method_frame,
+                header_frame, body))
+
+
+        return submit
+
+
+    def _handle_failure(self,
+            channel,
+            method_frame,
+            header_frame,
+            body,
+            future):
+
+        exception = future.exception()
+
+        if exception is not None:
+            logger.error("Handler raised an exception",
+                exc_info=(type(exception), exception,
+                    exception.__traceback__))
+
+            if not channel.settled and self.retry_later is not None:
+                try:
+                    self.retry_later(
+                        channel, method_frame, header_frame, body)
+                    channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+                except Exception:
+                    logger.exception("Retrying message later failed")
+
+            if not channel.settled:
+                logger.warning("Rejecting message")
+                channel.basic_nack(delivery_tag=method_frame.delivery_tag,
+                    requeue=False)
+
+
+    def shutdown(self):
+        """
+        Wait for the running job to finish, and perform the channel calls
+        it scheduled
+        """
+        self.executor.shutdown(wait=True)
+        self.connection.process_data_events(time_limit=0)
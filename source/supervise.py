@@ -0,0 +1,9 @@
+import os
+from nc_data_tools.supervisor import supervise
+
+
+# Worker processes are spawned, and import this module as well
+if __name__ == "__main__":
+    os.environ["NC_CONFIGURATION"] = \
+        os.environ.get("NC_CONFIGURATION") or "production"
+    supervise(os.getenv("NC_CONFIGURATION"))
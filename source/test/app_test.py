@@ -1,5 +1,12 @@
+import json
+import os.path
+import tempfile
 import unittest
-from nc_data_tools import create_app
+import numpy
+import rasterio
+from nc_data_tools import create_app, dead_letter_queue_name, \
+    heavy_queue_name, is_heavy_queue_name, light_queue_name, retry_queue_name
+from nc_data_tools.local_broker import LocalBroker, MethodFrame, Properties
 
 
 class AppTest(unittest.TestCase):
@@ -13,5 +20,135 @@ class AppTest(unittest.TestCase):
         pass
 
 
+    def test_heavy_queue_name(self):
+        self.assertEqual(
+            heavy_queue_name("classify_raster"), "classify_raster_heavy")
+        self.assertTrue(is_heavy_queue_name("classify_raster_heavy"))
+        self.assertFalse(is_heavy_queue_name("classify_raster"))
+        self.assertEqual(
+            light_queue_name("classify_raster_heavy"), "classify_raster")
+        self.assertEqual(
+            light_queue_name("classify_raster"), "classify_raster")
+
+
+    def test_heavy_job_routing(self):
+
+        # By default, workers handle both light and heavy jobs
+        self.assertEqual(self.app.config["NC_WORKER_CLASS"], "all")
+        self.assertIn("compute_raster_statistics_heavy",
+            self.app.consumed_queue_names())
+
+        self.app.config["NC_HEAVY_RASTER_SIZE"] = 100
+        notifications = []
+        self.app.notify_statistics = \
+            lambda client_id, pathname, statistics: \
+                notifications.append(client_id)
+
+        with tempfile.TemporaryDirectory() as directory_pathname:
+
+            pathnames = {}
+
+            for name, nr_cells in [("small", 10), ("large", 101)]:
+                pathnames[name] = os.path.join(
+                    directory_pathname, "{}.tif".format(name))
+                profile = {
+                    "driver": "GTiff",
+                    "width": nr_cells,
+                    "height": 1,
+                    "count": 1,
+                    "dtype": numpy.int32,
+                    "crs": "EPSG:3857",
+                    "transform": rasterio.transform.from_origin(0, 1, 1, 1),
+                }
+
+                with rasterio.open(pathnames[name], "w", **profile) as raster:
+                    raster.write(numpy.zeros((1, 1, nr_cells),
+                        dtype=numpy.int32))
+
+            queue_name = "compute_raster_statistics"
+            self.assertFalse(self.app.is_heavy_job(
+                MethodFrame(queue_name, 1), pathnames["small"]))
+            self.assertTrue(self.app.is_heavy_job(
+                MethodFrame(queue_name, 1), pathnames["large"]))
+            self.assertFalse(self.app.is_heavy_job(
+                MethodFrame(heavy_queue_name(queue_name), 1),
+                pathnames["large"]))
+
+            # Large jobs are republished to the heavy queue, and handled
+            # from there
+            broker = LocalBroker()
+            self.app.channel = broker.channel()
+
+            for name in [queue_name, heavy_queue_name(queue_name)]:
+                self.app.declare_queue(name)
+                broker.channel().basic_consume(
+                    self.app.on_compute_raster_statistics, queue=name)
+
+            for name, pathname in sorted(pathnames.items()):
+                broker.publish(queue_name, json.dumps(
+                    {"pathname": pathname, "client_id": name}), Properties())
+
+            broker.deliver_all()
+
+        self.assertEqual(notifications, ["small", "large"])
+        self.assertEqual([acknowledgement[0] for acknowledgement in
+                broker.acknowledgements],
+            [queue_name, queue_name, heavy_queue_name(queue_name)])
+
+
+    def test_retry_later(self):
+
+        self.app.config["NC_RETRY_DELAY"] = 0.05
+        self.app.config["NC_MAX_RETRIES"] = 2
+        self.assertEqual(self.app.retry_delays(), [0.05, 0.1])
+
+        broker = LocalBroker()
+        self.app.channel = broker.channel()
+        queue_name = "classify_raster"
+        self.app.declare_queue(queue_name)
+        self.assertIn(retry_queue_name(queue_name, 0.1), broker.queues)
+
+        # A message with a short delay is retried before one with a longer
+        # delay, queued earlier
+        for body, nr_retries in [(b"second", 1), (b"first", 0)]:
+            self.app.retry_later(self.app.channel,
+                MethodFrame(queue_name, 1),
+                Properties(headers={"x-nr-retries": nr_retries}), body)
+
+        bodies = []
+
+        def handler(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            bodies.append(body)
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+
+        broker.channel().basic_consume(handler, queue=queue_name)
+        broker.deliver_all(timeout=5)
+        self.assertEqual(bodies, [b"first", b"second"])
+
+        # Once all retries failed, messages are dead-lettered
+        self.app.retry_later(self.app.channel, MethodFrame(queue_name, 1),
+            Properties(headers={"x-nr-retries": 2}), b"dead")
+        self.assertEqual(
+            broker.queue_depths()[dead_letter_queue_name(queue_name)], 1)
+
+
+    def test_gdal_options(self):
+        self.app.config["NC_GDAL_OPERATION_ENVIRONMENT"] = {
+            "georeference_raster": {"GDAL_NUM_THREADS": 2}}
+
+        options = self.app.gdal_options("georeference_raster_heavy")
+        self.assertEqual(options["GDAL_NUM_THREADS"], 2)
+        self.assertEqual(options["GDAL_CACHEMAX"],
+            self.app.config["NC_GDAL_ENVIRONMENT"]["GDAL_CACHEMAX"])
+
+        options = self.app.gdal_options("classify_raster")
+        self.assertEqual(options, self.app.config["NC_GDAL_ENVIRONMENT"])
+
+
 if __name__ == "__main__":
     unittest.main()
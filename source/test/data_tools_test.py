@@ -1,14 +1,53 @@
+import base64
+import json
+import multiprocessing
 import os
 import unittest
 import numpy
 from numpy.testing import assert_array_equal
 import png
 import rasterio
+import rasterio.warp as warp
 import tempfile
 from nc_data_tools.data_tools import *
+from nc_data_tools.data_tools import _classify_raster
+from nc_data_tools.data_tools.driver import output_profile
 import test_case
 
 
+def _process_status(
+        name):
+
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith(name + ":"):
+                return int(line.split()[1]) * 1024  # kB
+
+
+def _peak_memory(
+        function,
+        args,
+        kwargs):
+    """
+    Call *function*, and return its result and the increase of the peak
+    resident set size of the process during the call
+
+    numpy < 1.13 does not report its allocations to tracemalloc, so the
+    resident set size is measured instead. This is done in a separate
+    process, whose peak resident set size is reset first (Linux). The
+    GDAL block cache is kept small, since it is not part of the budget.
+    """
+    with open("/proc/self/clear_refs", "w") as file:
+        file.write("5")
+
+    rss = _process_status("VmRSS")
+
+    with gdal_environment(GDAL_CACHEMAX=1):
+        result = function(*args, **kwargs)
+
+    return result, _process_status("VmHWM") - rss
+
+
 class DataToolsTest(test_case.TestCase):
 
 
@@ -62,6 +101,61 @@ class DataToolsTest(test_case.TestCase):
             raster.write(self.cells(dtype), 1)
 
 
+    def create_raster(self,
+            pathname,
+            cells,
+            cell_size,
+            west=0.0,
+            north=None,
+            crs="EPSG:3857"):
+
+        if north is None:
+            north = 0.0 + cells.shape[0] * cell_size
+
+        profile = {
+            "driver": "GTiff",
+            "width": cells.shape[1],
+            "height": cells.shape[0],
+            "dtype": cells.dtype,
+            "count": 1,
+            "crs": crs,
+            "transform": rasterio.transform.from_origin(
+                west, north, cell_size, cell_size),
+            "nodata": -999.0
+        }
+
+        with rasterio.open(pathname, "w", **profile) as raster:
+            raster.write(cells, 1)
+
+
+    def create_rgba_test_raster(self,
+            pathname,
+            rgba,
+            crs="EPSG:3857"):
+
+        nr_rows = len(rgba[0])
+        nr_cols = len(rgba[0][0])
+        cell_size = 1.0
+        transformation = rasterio.transform.from_origin(
+            0.0, 0.0 + nr_rows * cell_size, cell_size, cell_size)
+
+        profile = {
+            "driver": "GTiff",
+            "width": nr_cols,
+            "height": nr_rows,
+            "dtype": numpy.uint8,
+            "count": 4,
+            "crs": crs,
+            "transform": transformation,
+            # Mark the fourth band as alpha band
+            "photometric": "RGB",
+            "alpha": "YES"
+        }
+
+        with rasterio.open(pathname, "w", **profile) as raster:
+            raster.write(numpy.array(rgba, dtype=numpy.uint8))
+
+
     def test_is_name_of_graphics_file(self):
         self.assertTrue(is_name_of_graphics_file("blah.png"))
         self.assertTrue(is_name_of_graphics_file("/blah.png"))
@@ -144,6 +238,559 @@ class DataToolsTest(test_case.TestCase):
         os.remove(raster_pathname)
 
 
+    def test_convert_palette_graphics_file_to_geotiff(self):
+
+        palette = [(255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 255, 255),
+            (0, 0, 0, 0)]
+        indices = [
+            (0, 1, 2),
+            (2, 3, 0),
+        ]
+        graphics_pathname = self.temporary_file("plan.png")
+
+        with open(graphics_pathname, "wb") as png_file:
+            writer = png.Writer(3, 2, palette=palette, bitdepth=8)
+            writer.write(png_file, indices)
+
+        raster_pathname = geotiff_pathname(graphics_pathname)
+        convert_graphics_file_to_geotiff(graphics_pathname, raster_pathname)
+
+        with rasterio.open(raster_pathname) as raster_file:
+
+            # Indices and palette are kept. The transparent cell is
+            # marked as no-data.
+            self.assertEqual(raster_file.count, 1)
+            self.assertEqual(raster_file.dtypes[0], "uint8")
+            self.assertEqual(raster_file.nodata, 4)
+            assert_array_equal(raster_file.read(1), [[0, 1, 2], [2, 4, 0]])
+            self.assertEqual(raster_file.colormap(1)[1], (0, 255, 0, 255))
+            assert_array_equal(raster_file.dataset_mask(),
+                [[255, 255, 255], [255, 0, 255]])
+
+        self.assertEqual(retrieve_colors(raster_pathname),
+            [(0, 0, 255), (0, 255, 0), (255, 0, 0)])
+        self.assertEqual(retrieve_colors(raster_pathname,
+            window=((0, 1), (0, 2))), [(0, 255, 0), (255, 0, 0)])
+
+        classified_pathname = self.temporary_file("plan_classified.tif")
+        _classify_raster(raster_pathname, {(255, 0, 0): 1, (0, 0, 255): 3},
+            classified_pathname)
+
+        with rasterio.open(classified_pathname) as classified_raster:
+            nodata = classified_raster.nodata
+            assert_array_equal(classified_raster.read(1), [
+                [1, nodata, 3],
+                [3, nodata, 1],
+            ])
+
+
+    def test_classify_raster(self):
+
+        raster_pathname = self.temporary_file("plan.tif")
+        self.create_rgba_test_raster(raster_pathname, [
+                # Red, green, blue, alpha
+                [[255, 0,   0], [0, 0,   0]],
+                [[0,   255, 0], [0, 0,   0]],
+                [[0,   0,   9], [0, 0,   0]],
+                [[255, 255, 255], [0, 255, 255]],
+            ])
+
+        lut = {
+            (255, 0, 0): 1,
+            (0, 255, 0): 2,
+            (0, 0, 0): 3,
+        }
+
+
+        # Small class ids fit in a byte
+        classified_pathname = self.temporary_file("plan_classified.tif")
+        _classify_raster(raster_pathname, lut, classified_pathname,
+            color_table=True)
+
+        with rasterio.open(classified_pathname) as classified_raster:
+            profile = classified_raster.profile
+
+            self.assertEqual(profile["dtype"], "uint8")
+            self.assertEqual(profile["nodata"], 255)
+            self.assertEqual(profile["count"], 1)
+            self.assertTrue(profile["tiled"])
+
+            self.assertArraysEqual(classified_raster.read(1),
+                numpy.array([[1, 2, 255], [255, 3, 3]], dtype=numpy.uint8))
+
+            colormap = classified_raster.colormap(1)
+            self.assertEqual(colormap[1], (255, 0, 0, 255))
+            self.assertEqual(colormap[2], (0, 255, 0, 255))
+            self.assertEqual(colormap[3], (0, 0, 0, 255))
+
+
+        # Larger class ids need more bits
+        lut[(0, 0, 0)] = 1000
+        _classify_raster(raster_pathname, lut, classified_pathname)
+
+        with rasterio.open(classified_pathname) as classified_raster:
+            profile = classified_raster.profile
+
+            self.assertEqual(profile["dtype"], "uint16")
+            self.assertEqual(profile["nodata"], 65535)
+
+            self.assertArraysEqual(classified_raster.read(1),
+                numpy.array([[1, 2, 65535], [65535, 1000, 1000]],
+                    dtype=numpy.uint16))
+
+
+    def test_retrieve_dominant_colors(self):
+
+        nr_rows, nr_cols = 400, 300
+        palette = numpy.array([[255, 0, 0], [0, 255, 0], [0, 0, 255]],
+            dtype=numpy.uint8)
+        random = numpy.random.RandomState(1)
+        indices = random.choice(3, size=(nr_rows, nr_cols), p=[0.6, 0.3, 0.1])
+        alpha = numpy.full((1, nr_rows, nr_cols), 255, dtype=numpy.uint8)
+        alpha[0, :10, :] = 0
+
+        raster_pathname = self.temporary_file("plan.tif")
+        self.create_rgba_test_raster(raster_pathname, numpy.concatenate([
+            numpy.moveaxis(palette[indices], 2, 0), alpha]))
+
+        exact = retrieve_dominant_colors(raster_pathname, exact=True)
+        self.assertTrue(exact["exact"])
+        self.assertEqual(exact["colors"],
+            [(255, 0, 0), (0, 255, 0), (0, 0, 255)])
+        self.assertEqual(exact["nr_cells"], (nr_rows - 10) * nr_cols)
+        self.assertEqual(exact["margins"], [0.0, 0.0, 0.0])
+
+        approximate = retrieve_dominant_colors(raster_pathname, nr_colors=2,
+            sample_size=10000)
+        self.assertFalse(approximate["exact"])
+        self.assertEqual(approximate["colors"], [(255, 0, 0), (0, 255, 0)])
+        self.assertLess(approximate["nr_cells"], exact["nr_cells"])
+
+        for frequency, margin, exact_frequency in zip(
+                approximate["frequencies"], approximate["margins"],
+                exact["frequencies"]):
+            self.assertGreater(margin, 0.0)
+            self.assertLess(abs(frequency - exact_frequency), 2 * margin)
+
+        # Running out of time still results in an estimate
+        approximate = retrieve_dominant_colors(raster_pathname,
+            sample_size=10000, time_budget=0)
+        self.assertGreater(approximate["nr_cells"], 0)
+
+        # The time budget is checked after each read, which covers a
+        # bounded number of cells of the raster. Decimated by 4, a read
+        # covering at most 1600 cells counts at most 100 cells.
+        approximate = retrieve_dominant_colors(raster_pathname,
+            sample_size=10000, time_budget=0, max_cells_per_read=1600)
+        self.assertLessEqual(approximate["nr_cells"], 100)
+
+        approximate = retrieve_dominant_colors(raster_pathname,
+            sample_size=10000, max_cells_per_read=1600)
+        self.assertEqual(approximate["colors"],
+            [(255, 0, 0), (0, 255, 0), (0, 0, 255)])
+
+
+    def test_color_pages(self):
+
+        raster_pathname = self.temporary_file("plan.tif")
+        self.create_rgba_test_raster(raster_pathname, [
+                [[255, 255, 0], [0, 255, 0]],
+                [[0, 0, 255], [0, 0, 0]],
+                [[0, 0, 0], [255, 0, 0]],
+                [[255, 255, 255], [255, 255, 0]],
+            ])
+
+        colors, counts = count_colors(raster_pathname)
+        self.assertTrue(os.path.exists(color_counts_pathname(raster_pathname)))
+        self.assertArraysEqual(colors,
+            numpy.array([0x0000ff, 0x00ff00, 0xff0000], dtype=numpy.uint32))
+        self.assertArraysEqual(counts,
+            numpy.array([1, 1, 3], dtype=numpy.int64))
+
+        # Counts are read from the cache
+        cached_colors, cached_counts = count_colors(raster_pathname)
+        self.assertArraysEqual(cached_colors, colors)
+        self.assertArraysEqual(cached_counts, counts)
+
+        colors = numpy.array([0x0000ff, 0x00ff00, 0xff0000],
+            dtype=numpy.uint32)
+        counts = numpy.array([3, 7, 5], dtype=numpy.int64)
+        page = color_page(colors, counts, color_format="hex",
+            sort="frequency", page_size=2)
+        self.assertEqual(page["colors"], "00ff00ff0000")
+        self.assertEqual(page["counts"], [7, 5])
+        self.assertEqual(page["nr_colors"], 3)
+
+        page = color_page(colors, counts,
+            **decode_continuation(page["continuation"]))
+        self.assertEqual(page["colors"], "0000ff")
+        self.assertEqual(page["offset"], 2)
+        self.assertNotIn("continuation", page)
+
+        self.assertEqual(color_page(colors, counts)["colors"],
+            [[0, 0, 255], [0, 255, 0], [255, 0, 0]])
+        self.assertEqual(
+            color_page(colors, counts, color_format="uint32")["colors"],
+            colors.tolist())
+        self.assertArraysEqual(numpy.frombuffer(base64.b64decode(
+            color_page(colors, counts, color_format="base64")["colors"]),
+            dtype="<u4").astype(numpy.uint32), colors)
+
+
+    def test_classify_raster_nearest_color(self):
+
+        # Anti-aliased and degraded versions of red and blue
+        raster_pathname = self.temporary_file("plan.tif")
+        self.create_rgba_test_raster(raster_pathname, [
+                [[255, 250, 128], [0, 10, 255]],
+                [[0, 4, 128], [0, 0, 0]],
+                [[0, 0, 128], [255, 240, 0]],
+                [[255, 255, 255], [255, 255, 0]],
+            ])
+        lut = {(255, 0, 0): 1, (0, 0, 255): 2}
+
+        classified_pathname = self.temporary_file("plan_classified.tif")
+        _classify_raster(raster_pathname, lut, classified_pathname)
+
+        with rasterio.open(classified_pathname) as classified_raster:
+            self.assertEqual(classified_raster.nodata, 255)
+            self.assertArraysEqual(classified_raster.read(1),
+                numpy.array([[1, 255, 255], [2, 255, 255]],
+                    dtype=numpy.uint8))
+
+        _classify_raster(raster_pathname, lut, classified_pathname,
+            max_color_distance=20)
+
+        with rasterio.open(classified_pathname) as classified_raster:
+            # Mid-gray is too far from both colors. The last cell is
+            # masked out.
+            self.assertArraysEqual(classified_raster.read(1),
+                numpy.array([[1, 1, 255], [2, 2, 255]], dtype=numpy.uint8))
+
+        # Colors resolved before are cached
+        lookup = NearestColorLookup.from_lut(lut, 20)
+        red, green, blue = numpy.array([[250, 0, 128]], dtype=numpy.uint8), \
+            numpy.array([[4, 0, 128]], dtype=numpy.uint8), \
+            numpy.array([[0, 240, 128]], dtype=numpy.uint8)
+
+        for _ in range(2):
+            self.assertArraysEqual(
+                lookup.classify(red, green, blue, 255, numpy.uint8),
+                numpy.array([[1, 2, 255]], dtype=numpy.uint8))
+            self.assertEqual(len(lookup.resolved_colors), 5)
+
+        # The cache is cleared once it would become too large, keeping the
+        # colors in the lookup
+        lookup.max_resolved_colors = 6
+        self.assertArraysEqual(
+            lookup.classify(
+                numpy.array([251, 1], dtype=numpy.uint8),
+                numpy.array([0, 0], dtype=numpy.uint8),
+                numpy.array([0, 250], dtype=numpy.uint8), 255, numpy.uint8),
+            numpy.array([1, 2], dtype=numpy.uint8))
+        self.assertEqual(len(lookup.resolved_colors), 4)
+
+        # Colors in neighbouring buckets of the color cube are found
+        lookup = NearestColorLookup.from_lut({(21, 0, 0): 1}, 20)
+        self.assertArraysEqual(
+            lookup.classify(
+                numpy.array([1, 0], dtype=numpy.uint8),
+                numpy.array([0, 0], dtype=numpy.uint8),
+                numpy.array([0, 0], dtype=numpy.uint8), 255, numpy.uint8),
+            numpy.array([1, 255], dtype=numpy.uint8))
+
+        # Searching the neighbouring buckets gives the same result as
+        # searching all colors
+        random = numpy.random.RandomState(0)
+        lut_colors = random.randint(0, 256, (200, 3))
+        lut = {tuple(int(value) for value in color): class_ % 7 for
+            class_, color in enumerate(lut_colors)}
+        lookup = NearestColorLookup.from_lut(lut, 30)
+        red, green, blue = random.randint(0, 256, (3, 1000)).astype(
+            numpy.uint8)
+
+        components = numpy.stack([red, green, blue], axis=1).astype(
+            numpy.int64)
+        differences = components[:, numpy.newaxis, :] - \
+            lookup.components[numpy.newaxis, :, :]
+        distances = (differences ** 2).sum(axis=2)
+        nearest = distances.argmin(axis=1)
+        expected = numpy.where(
+            distances[numpy.arange(1000), nearest] <= 30 ** 2,
+            lookup.classes[nearest], 255).astype(numpy.uint8)
+
+        self.assertArraysEqual(
+            lookup.classify(red, green, blue, 255, numpy.uint8), expected)
+
+
+    def test_decode_lut(self):
+
+        lut = {(0, 127, 0): 2, (0, 0, 0): 3, (255, 0, 0): 70000}
+        red = numpy.array([0, 0, 255, 1], dtype=numpy.uint8)
+        green = numpy.array([127, 0, 0, 1], dtype=numpy.uint8)
+        blue = numpy.array([0, 0, 0, 1], dtype=numpy.uint8)
+        encodings = [
+            {"(0, 127, 0)": 2, "(0, 0, 0)": 3, "(255, 0, 0)": 70000},
+            {"colors": [32512, 0, 0xFF0000], "classes": [2, 3, 70000]},
+            {"colors": [[0, 127, 0], [0, 0, 0], [255, 0, 0]],
+                "classes": [2, 3, 70000]},
+            encode_lut(lut),
+        ]
+
+        for encoding in encodings:
+            lookup = decode_lut(encoding)
+            self.assertEqual(len(lookup), 3)
+            self.assertArraysEqual(
+                lookup.classify(red, green, blue, -999, numpy.int32),
+                numpy.array([2, 3, 70000, -999], dtype=numpy.int32))
+
+        # The compact encoding survives a JSON round trip
+        self.assertEqual(json.loads(json.dumps(encode_lut(lut))),
+            encode_lut(lut))
+
+
+    def test_stages(self):
+
+        pathname = self.temporary_file("raster.tif")
+        key = stage_key("http://plans/1", "classify", {"(0, 0, 0)": 1})
+
+        self.assertEqual(
+            key, stage_key("http://plans/1", "classify", {"(0, 0, 0)": 1}))
+        self.assertNotEqual(
+            key, stage_key("http://plans/2", "classify", {"(0, 0, 0)": 1}))
+        self.assertFalse(stage_completed(pathname, key))
+
+
+        # A failing write leaves nothing behind
+        with self.assertRaises(RuntimeError):
+            with atomic_pathname(pathname) as temporary_pathname:
+                self.create_test_raster(temporary_pathname)
+                raise RuntimeError("crash")
+
+        self.assertEqual(os.listdir(self.temporary_directory.name), [])
+
+
+        # A succeeding write commits the raster and its stage record
+        with atomic_pathname(pathname) as temporary_pathname:
+            self.create_test_raster(temporary_pathname)
+            mark_stage_completed(temporary_pathname, key)
+            self.assertFalse(os.path.exists(pathname))
+
+        self.assertEqual(os.listdir(self.temporary_directory.name),
+            ["raster.tif"])
+        self.assertTrue(stage_completed(pathname, key))
+
+
+    def test_superseding_cancellation_token(self):
+
+        pathname = self.temporary_file("plan.tif")
+
+        token1 = SupersedingCancellationToken(pathname, "classify", 10,
+            check_interval=0)
+        self.assertFalse(token1.cancelled)
+
+        # Job for another stage does not affect the first job
+        token2 = SupersedingCancellationToken(pathname, "georeference", 11,
+            check_interval=0)
+        self.assertFalse(token1.cancelled)
+
+        # Newer job for the same stage supersedes the first job
+        token3 = SupersedingCancellationToken(pathname, "classify", 12,
+            check_interval=0)
+        self.assertTrue(token1.cancelled)
+        self.assertFalse(token3.cancelled)
+
+        with self.assertRaises(Cancelled):
+            token1.raise_if_cancelled()
+
+        # Older job is cancelled right away
+        token4 = SupersedingCancellationToken(pathname, "classify", 11,
+            check_interval=0)
+        self.assertTrue(token4.cancelled)
+        self.assertFalse(token3.cancelled)
+
+        for token in [token1, token2, token3, token4]:
+            token.release()
+
+        self.assertEqual(os.listdir(self.temporary_directory.name), [])
+
+
+    def test_classify_raster_cancelled(self):
+
+        raster_pathname = self.temporary_file("plan.tif")
+        self.create_rgba_test_raster(raster_pathname, [
+                [[255, 0]], [[0, 0]], [[0, 0]], [[255, 255]],
+            ])
+
+        token = CancellationToken()
+        token.cancel()
+        classified_pathname = self.temporary_file("plan_classified.tif")
+
+        with self.assertRaises(Cancelled):
+            with atomic_pathname(classified_pathname) as temporary_pathname:
+                _classify_raster(raster_pathname, {(255, 0, 0): 1},
+                    temporary_pathname, cancellation_token=token)
+
+        self.assertEqual(os.listdir(self.temporary_directory.name),
+            ["plan.tif"])
+
+
+    def test_plan_execution(self):
+
+        # No budget, or a budget large enough: process at once
+        plan = plan_execution("operation", (1000, 800), 10)
+        self.assertTrue(plan.whole_array)
+        self.assertEqual(plan.windows(), [((0, 1000), (0, 800))])
+
+        plan = plan_execution("operation", (1000, 800), 10,
+            max_memory=10 * 1000 * 800)
+        self.assertTrue(plan.whole_array)
+
+        # Strips of full rows, aligned
+        plan = plan_execution("operation", (1000, 800), 10,
+            max_memory=10 * 300 * 800, alignment=256)
+        self.assertFalse(plan.whole_array)
+        self.assertEqual(plan.window_shape, (256, 800))
+        self.assertEqual(len(plan.windows()), 4)
+        self.assertLessEqual(plan.estimated_memory, 10 * 300 * 800)
+
+        # Square tiles, when not even a row fits
+        plan = plan_execution("operation", (1000, 800), 10,
+            max_memory=10 * 400)
+        self.assertEqual(plan.window_shape, (20, 20))
+        self.assertEqual(sum([
+            (rows[1] - rows[0]) * (cols[1] - cols[0]) for rows, cols in
+                plan.windows()]), 1000 * 800)
+
+
+    def test_memory_budget(self):
+
+        nr_rows, nr_cols = 2048, 2048
+        palette = numpy.array([
+            [255, 0, 0], [0, 255, 0], [0, 0, 255], [10, 20, 30]],
+            dtype=numpy.uint8)
+        random = numpy.random.RandomState(3)
+        colors = palette[random.randint(len(palette), size=(nr_rows, nr_cols))]
+        rgba = numpy.concatenate([
+            numpy.moveaxis(colors, 2, 0),
+            numpy.full((1, nr_rows, nr_cols), 255, dtype=numpy.uint8)])
+
+        raster_pathname = self.temporary_file("plan.tif")
+        self.create_rgba_test_raster(raster_pathname, rgba)
+        lut = {(255, 0, 0): 1, (0, 255, 0): 2, (0, 0, 255): 3}
+        max_memory = 16 * 1024 * 1024
+
+        # Memory used besides the arrays processed, like code paged in
+        overhead = 4 * 1024 * 1024
+
+        pool = multiprocessing.get_context("spawn").Pool(1)
+        self.addCleanup(pool.terminate)
+
+        def peak_memory(
+                function,
+                *args,
+                **kwargs):
+
+            return pool.apply(_peak_memory, (function, args, kwargs))
+
+        # Processing the raster at once exceeds the budget
+        colors, peak = peak_memory(retrieve_colors, raster_pathname)
+        self.assertGreater(peak, max_memory)
+
+        budgeted_colors, peak = peak_memory(retrieve_colors,
+            raster_pathname, max_memory=max_memory)
+        self.assertLessEqual(peak, max_memory + overhead)
+        self.assertEqual(budgeted_colors, colors)
+        self.assertEqual(len(colors), 4)
+
+        classified_pathname = self.temporary_file("plan_classified.tif")
+        _, peak = peak_memory(_classify_raster, raster_pathname, lut,
+            classified_pathname)
+        self.assertGreater(peak, max_memory)
+
+        with rasterio.open(classified_pathname) as raster:
+            classes = raster.read(1)
+
+        budgeted_classified_pathname = self.temporary_file(
+            "plan_classified_budget.tif")
+        _, peak = peak_memory(_classify_raster, raster_pathname, lut,
+            budgeted_classified_pathname, max_memory=max_memory)
+        self.assertLessEqual(peak, max_memory + overhead)
+
+        with rasterio.open(budgeted_classified_pathname) as raster:
+            self.assertArraysEqual(raster.read(1), classes)
+
+
+    def test_gdal_environment(self):
+
+        self.assertEqual(gdal_environment_options(), {})
+
+        with gdal_environment(GDAL_CACHEMAX=128, VSI_CACHE=True) as options:
+            self.assertEqual(options,
+                {"GDAL_CACHEMAX": 128, "VSI_CACHE": True})
+
+            # Inner options override outer ones
+            with gdal_environment(GDAL_CACHEMAX=64, GDAL_NUM_THREADS=None):
+                self.assertEqual(gdal_environment_options(),
+                    {"GDAL_CACHEMAX": 64, "VSI_CACHE": True})
+
+                environment = gdal_command_environment()
+                self.assertEqual(environment["GDAL_CACHEMAX"], "64")
+                self.assertEqual(environment["VSI_CACHE"], "YES")
+
+            self.assertEqual(gdal_environment_options(),
+                {"GDAL_CACHEMAX": 128, "VSI_CACHE": True})
+
+        self.assertEqual(gdal_environment_options(), {})
+
+
+    def test_fit_affine_transform(self):
+
+        gcps = [
+            [[0, 0], [1000, 2000]],
+            [[10, 0], [1020, 2000]],
+            [[0, 10], [1000, 1970]],
+            [[10, 10], [1020, 1970]],
+        ]
+
+        transform, residuals = fit_affine_transform(gcps)
+
+        self.assertAlmostEqual(transform.a, 2.0)
+        self.assertAlmostEqual(transform.b, 0.0)
+        self.assertAlmostEqual(transform.c, 1000.0)
+        self.assertAlmostEqual(transform.d, 0.0)
+        self.assertAlmostEqual(transform.e, -3.0)
+        self.assertAlmostEqual(transform.f, 2000.0)
+        self.assertLess(residuals.max(), 1e-6)
+
+        # Move one GCP away from the affine fit
+        gcps[3][1][0] += 1.0
+        transform, residuals = fit_affine_transform(gcps)
+        self.assertAlmostEqual(residuals.max(), 0.25)
+
+        with self.assertRaises(RuntimeError):
+            fit_affine_transform(gcps[:2])
+
+
+    def test_update_georeference(self):
+
+        pathname = self.temporary_file("raster.tif")
+        self.create_test_raster(pathname)
+        transform = rasterio.transform.from_origin(1000.0, 2000.0, 2.0, 3.0)
+
+        key = stage_key("http://plans/1", "georeference")
+        update_georeference(pathname, transform, crs="EPSG:28992",
+            idempotency_key=key)
+
+        with rasterio.open(pathname) as raster:
+            self.assertEqual(raster.affine, transform)
+            self.assertEqual(raster.crs,
+                rasterio.crs.CRS.from_string("EPSG:28992"))
+            self.assertArraysEqual(raster.read(1), self.cells(numpy.int32))
+
+        self.assertTrue(stage_completed(pathname, key))
+
+
     def test_reproject_raster(self):
         # Given a geotiff in EPSG:3857, reproject it in EPSG:28992
 
@@ -179,6 +826,90 @@ class DataToolsTest(test_case.TestCase):
             self.assertEqual(target_raster.height, nr_rows)
 
 
+    def test_reproject_raster_overviews(self):
+
+        self.assertEqual(overview_factor(3.9), 1)
+        self.assertEqual(overview_factor(4), 2)
+        self.assertEqual(overview_factor(100), 32)
+        self.assertEqual(overview_factor(100, oversampling=8), 8)
+
+        # Smooth surface, at 10 m, aggregated to 320 m
+        rows, cols = numpy.mgrid[0:512, 0:512]
+        source_pathname = self.temporary_file("source.tif")
+        self.create_raster(source_pathname,
+            (rows + cols).astype(numpy.float32), 10.0)
+        template_pathname = self.temporary_file("template.tif")
+        self.create_raster(template_pathname,
+            numpy.zeros((16, 16), dtype=numpy.float32), 320.0)
+
+        full_resolution_pathname = self.temporary_file("full.tif")
+        reproject_raster_given_template(
+            source_pathname, template_pathname, full_resolution_pathname,
+            resampling_method=warp.RESAMPLING.average,
+            source_options={"overviews": False})
+
+        # The decimated source raster is written window by window
+        overview_pathname = self.temporary_file("overview.tif")
+        reproject_raster_given_template(
+            source_pathname, template_pathname, overview_pathname,
+            resampling_method=warp.RESAMPLING.average, max_memory=1024)
+
+        with rasterio.open(full_resolution_pathname) as full_raster, \
+                rasterio.open(overview_pathname) as overview_raster:
+            full_cells = full_raster.read(1)
+            overview_cells = overview_raster.read(1)
+
+        numpy.testing.assert_allclose(overview_cells, full_cells, atol=2.0)
+
+        # The decimated source raster is cached, and reused
+        decimated_pathname = decimated_raster_pathname(
+            source_pathname, 16, warp.RESAMPLING.average)
+        self.assertTrue(os.path.exists(decimated_pathname))
+        mtime = os.path.getmtime(decimated_pathname)
+
+        reproject_raster_given_template(
+            source_pathname, template_pathname, overview_pathname,
+            resampling_method=warp.RESAMPLING.average)
+        self.assertEqual(os.path.getmtime(decimated_pathname), mtime)
+
+        with rasterio.open(overview_pathname) as overview_raster:
+            self.assertArraysEqual(overview_raster.read(1), overview_cells)
+
+        # The decimated source raster is not reused for other resampling
+        # methods
+        nearest_pathname = self.temporary_file("nearest.tif")
+        reproject_raster_given_template(
+            source_pathname, template_pathname, nearest_pathname,
+            resampling_method=warp.RESAMPLING.nearest,
+            source_options={"overviews": True})
+        self.assertTrue(os.path.exists(decimated_raster_pathname(
+            source_pathname, 16, warp.RESAMPLING.nearest)))
+        self.assertEqual(os.path.getmtime(decimated_pathname), mtime)
+
+        with rasterio.open(decimated_pathname) as raster:
+            self.assertEqual(raster.tags()["NC_RESAMPLING"], "average")
+
+        # Without caching, no decimated raster is left behind
+        uncached_source_pathname = self.temporary_file("uncached.tif")
+        self.create_raster(uncached_source_pathname,
+            (rows + cols).astype(numpy.float32), 10.0)
+        reproject_raster_given_template(
+            uncached_source_pathname, template_pathname, overview_pathname,
+            resampling_method=warp.RESAMPLING.average,
+            source_options={"cache_overviews": False})
+        self.assertFalse(os.path.exists(decimated_raster_pathname(
+            uncached_source_pathname, 16, warp.RESAMPLING.average)))
+
+        with rasterio.open(overview_pathname) as overview_raster:
+            self.assertArraysEqual(overview_raster.read(1), overview_cells)
+
+        # Temporary overviews do not modify the source raster
+        self.assertFalse(os.path.exists("{}.ovr".format(source_pathname)))
+
+        with rasterio.open(source_pathname) as source_raster:
+            self.assertEqual(source_raster.overviews(1), [])
+
+
     def test_reformat_geotiff_to_ascii(self):
         # Given a geotiff, reformat it to ascii
         source_pathname = self.temporary_file("reformat_raster.tif")
@@ -232,6 +963,62 @@ class DataToolsTest(test_case.TestCase):
                 rasterio.crs.CRS.from_string(crs))
 
 
+    def test_reformat_geotiff_to_netcdf(self):
+        # Given a geotiff, reformat it to netcdf
+        source_pathname = self.temporary_file("reformat_raster.tif")
+        dtype = numpy.int32
+        self.create_test_raster(source_pathname, dtype=dtype)
+
+        with rasterio.open(source_pathname) as source_raster:
+            profile = output_profile(source_raster.profile, "raster.nc")
+
+        self.assertEqual(profile["driver"], "netCDF")
+        self.assertEqual(profile["format"], "NC4C")
+        self.assertEqual(profile["compress"], "DEFLATE")
+
+        # Reformat
+        target_pathname = self.temporary_file("reformat_raster.nc")
+
+        reformat_raster(source_pathname, target_pathname)
+
+
+        # Verify format of new raster.
+        self.assertTrue(os.path.exists(target_pathname))
+
+        with rasterio.open(target_pathname) as target_raster:
+
+            profile = target_raster.profile
+            self.assertEqual(profile["driver"], "netCDF")
+
+            data = target_raster.read(1)
+            self.assertArraysEqual(self.cells(dtype), data)
+
+        # The intermediate GeoTIFF is removed
+        self.assertEqual([name for name in
+            os.listdir(self.temporary_directory.name) if
+                name.startswith("tmp")], [])
+
+        # Stack the differences between rasters in the bands of a single
+        # netcdf
+        lhs_pathname = self.temporary_file("stack_0.tif")
+        rhs_pathname = self.temporary_file("stack_1.tif")
+        self.create_test_raster(lhs_pathname, dtype=dtype)
+        self.create_test_raster(rhs_pathname, dtype=dtype)
+        target_pathname = self.temporary_file("stack.nc")
+
+        subtract_raster_stack([lhs_pathname, rhs_pathname, lhs_pathname],
+            target_pathname)
+
+        with rasterio.open(target_pathname) as target_raster:
+            self.assertEqual(target_raster.driver, "netCDF")
+            self.assertEqual(target_raster.count, 2)
+            differences = target_raster.read()
+            self.assertEqual(target_raster.nodata, 999)
+            self.assertTrue((differences[:, 1, 1] == 999).all())
+            differences[:, 1, 1] = 0
+            self.assertTrue((differences == 0).all())
+
+
     def test_reproject_raster2(self):
 
         dtype = numpy.int32
@@ -360,6 +1147,54 @@ class DataToolsTest(test_case.TestCase):
             self.assertEqual(target_raster.bounds, small_raster.bounds)
 
 
+    def test_clip_raster_not_aligned(self):
+
+        # Cells of the large raster contain their column index
+        large_pathname = self.temporary_file("large.tif")
+        self.create_raster(large_pathname,
+            numpy.tile(numpy.arange(100, dtype=numpy.float32), (100, 1)),
+            west=0.0, north=1000.0, cell_size=10.0)
+
+        # Shifted by a quarter cell, with cells twice as large
+        small_pathname = self.temporary_file("small.tif")
+        self.create_raster(small_pathname,
+            numpy.zeros((10, 15), dtype=numpy.float32),
+            west=202.5, north=802.5, cell_size=20.0)
+
+        target_pathname = self.temporary_file("clip.tif")
+        clip_raster(large_pathname, small_pathname, target_pathname,
+            max_memory=200)
+
+        with rasterio.open(target_pathname) as target_raster, \
+                rasterio.open(small_pathname) as small_raster:
+            self.assertEqual(target_raster.crs, small_raster.crs)
+            self.assertEqual(target_raster.transform, small_raster.transform)
+            self.assertEqual(target_raster.shape, small_raster.shape)
+
+            # Cell centers are at x = 212.5, 232.5, ..., which fall in
+            # columns 21, 23, ... of the large raster
+            cells = target_raster.read(1)
+            self.assertArraysEqual(cells[0],
+                numpy.arange(21, 51, 2, dtype=numpy.float32))
+            self.assertArraysEqual(cells[-1], cells[0])
+
+        # Different CRS
+        small_pathname = self.temporary_file("small-28992.tif")
+        self.create_raster(small_pathname,
+            numpy.zeros((5, 5), dtype=numpy.float32),
+            west=155000.0, north=463000.0, cell_size=10.0,
+            crs="EPSG:28992")
+        clip_raster(large_pathname, small_pathname, target_pathname)
+
+        with rasterio.open(target_pathname) as target_raster:
+            self.assertEqual(target_raster.crs,
+                rasterio.crs.CRS.from_string("EPSG:28992"))
+            self.assertEqual(target_raster.shape, (5, 5))
+
+            # No overlap with the large raster
+            self.assertTrue((target_raster.read(1) == -999.0).all())
+
+
     def test_subtract_rasters(self):
 
         dtype = numpy.float32
@@ -393,5 +1228,278 @@ class DataToolsTest(test_case.TestCase):
             self.assertEqual(result[2][1], 0.0)
 
 
+    def test_subtract_raster_stack(self):
+
+        nodata = 999
+        layers = [
+            [[1, 2], [3, nodata]],
+            [[2, 2], [1, 5]],
+            [[5, nodata], [0, 6]],
+        ]
+        pathnames = []
+
+        for i, layer in enumerate(layers + [[[1000, 2], [3, 4]]]):
+            pathname = self.temporary_file("stack-{}.tif".format(i))
+            profile = {
+                "driver": "GTiff",
+                "width": 2,
+                "height": 2,
+                "count": 1,
+                "dtype": numpy.int32,
+                "crs": "EPSG:3857",
+                "transform": rasterio.transform.from_origin(0, 20, 10, 10),
+                "nodata": nodata,
+            }
+
+            with rasterio.open(pathname, "w", **profile) as raster:
+                raster.write(numpy.array([layer], dtype=numpy.int32))
+
+            pathnames.append(pathname)
+
+        # Successive differences, as bands of a single raster
+        target_pathname = self.temporary_file("stack.tif")
+        cumulative_pathname = self.temporary_file("cumulative.tif")
+        max_pathname = self.temporary_file("max.tif")
+        subtract_raster_stack(pathnames[:3], target_pathname,
+            aggregate_raster_pathnames={
+                "cumulative": cumulative_pathname, "max": max_pathname},
+            max_memory=20)
+
+        with rasterio.open(target_pathname) as target_raster:
+            self.assertEqual(target_raster.count, 2)
+            self.assertArraysEqual(target_raster.read(), numpy.array([
+                [[1, 0], [-2, nodata]],
+                [[3, nodata], [-1, 1]],
+            ], dtype=numpy.int32))
+
+        with rasterio.open(cumulative_pathname) as cumulative_raster:
+            self.assertArraysEqual(cumulative_raster.read(1),
+                numpy.array([[4, 0], [-3, 1]], dtype=numpy.int32))
+
+        with rasterio.open(max_pathname) as max_raster:
+            self.assertArraysEqual(max_raster.read(1),
+                numpy.array([[3, 0], [-2, 1]], dtype=numpy.int32))
+
+        # Differences with the first raster, as separate rasters
+        target_pathnames = [self.temporary_file("baseline-{}.tif".format(i))
+            for i in range(2)]
+        subtract_raster_stack(pathnames[:3], target_pathnames, baseline=True)
+
+        with rasterio.open(target_pathnames[1]) as target_raster:
+            self.assertArraysEqual(target_raster.read(1),
+                numpy.array([[4, nodata], [-3, nodata]], dtype=numpy.int32))
+
+        # Valid differences equal to the no-data value are aggregated
+        subtract_raster_stack([pathnames[0], pathnames[3], pathnames[0]],
+            self.temporary_file("round_trip.tif"),
+            aggregate_raster_pathnames={"cumulative": cumulative_pathname})
+
+        with rasterio.open(cumulative_pathname) as cumulative_raster:
+            self.assertArraysEqual(cumulative_raster.read(1),
+                numpy.array([[0, 0], [0, nodata]], dtype=numpy.int32))
+
+
+    def test_sparse_output(self):
+
+        pathname = self.temporary_file("sparse.tif")
+        profile = sparse_profile({
+            "driver": "GTiff",
+            "width": 512,
+            "height": 512,
+            "count": 1,
+            "dtype": numpy.int32,
+            "crs": "EPSG:3857",
+            "transform": rasterio.transform.from_origin(0, 512, 1, 1),
+            "nodata": -999,
+            "tiled": True,
+            "blockxsize": 256,
+            "blockysize": 256,
+        })
+        self.assertEqual(profile.get("sparse_ok", False), sparse_supported)
+
+        cells = numpy.full((1, 512, 512), -999, dtype=numpy.int32)
+        cells[0, 10:20, 300:310] = 5
+        valid = cells[0] != -999
+
+        with rasterio.open(pathname, "w", **profile) as raster:
+            self.assertEqual(is_sparse(raster), sparse_supported)
+            self.assertEqual(
+                write_valid_blocks(raster, cells, valid, ((0, 512), (0, 512))),
+                3 if sparse_supported else 0)
+
+        # Unwritten blocks are not stored, and read as no-data
+        if sparse_supported:
+            block_size = 256 * 256 * numpy.dtype(numpy.int32).itemsize
+            self.assertLess(os.path.getsize(pathname), 2 * block_size)
+
+        with rasterio.open(pathname) as raster:
+            self.assertArraysEqual(raster.read(), cells)
+
+        # Transparent margins are classified as no-data
+        rgba = numpy.zeros((4, 300, 300), dtype=numpy.uint8)
+        rgba[0, 260:280, 260:280] = 255
+        rgba[3, 260:280, 260:280] = 255
+        raster_pathname = self.temporary_file("margins.tif")
+        self.create_rgba_test_raster(raster_pathname, rgba)
+        classified_pathname = self.temporary_file("margins_classified.tif")
+        _classify_raster(raster_pathname, {(255, 0, 0): 1},
+            classified_pathname, max_memory=256 * 300 * 32)
+
+        with rasterio.open(classified_pathname) as classified_raster:
+            classes = classified_raster.read(1)
+            nodata = classified_raster.nodata
+            self.assertTrue((classes[260:280, 260:280] == 1).all())
+            classes[260:280, 260:280] = nodata
+            self.assertTrue((classes == nodata).all())
+
+
+    def test_raster_statistics(self):
+
+        def numpy_statistics(
+                cells):
+
+            cells = cells[cells != -999].astype(numpy.float64)
+
+            return cells.size, cells.min(), cells.max(), cells.mean(), \
+                cells.std()
+
+        def assert_statistics_equal(
+                statistics,
+                cells):
+
+            count, min_, max_, mean, std = numpy_statistics(cells)
+            self.assertEqual(statistics["count"], count)
+            self.assertEqual(statistics["min"], min_)
+            self.assertEqual(statistics["max"], max_)
+            self.assertAlmostEqual(statistics["mean"], mean)
+            self.assertAlmostEqual(statistics["std"], std, places=5)
+
+            histogram = statistics["histogram"]
+            self.assertLessEqual(len(histogram["counts"]), 64)
+            self.assertArraysEqual(
+                numpy.array(histogram["counts"], dtype=numpy.int64),
+                numpy.histogram(cells[cells != -999],
+                    bins=histogram["edges"])[0])
+
+        pathname = self.temporary_file("statistics.tif")
+        cells = numpy.random.RandomState(0).randint(
+            -500, 1000, size=(1, 1500, 1100)).astype(numpy.int16)
+        cells[0, :100, :] = -999
+        profile = {
+            "driver": "GTiff",
+            "width": 1100,
+            "height": 1500,
+            "count": 1,
+            "dtype": numpy.int16,
+            "crs": "EPSG:3857",
+            "transform": rasterio.transform.from_origin(0, 1500, 1, 1),
+            "nodata": -999,
+        }
+
+        with rasterio.open(pathname, "w", **profile) as raster:
+            raster.write(cells)
+
+        statistics = raster_statistics(pathname, nr_bins=64)
+        self.assertEqual(len(statistics), 1)
+        assert_statistics_equal(statistics[0], cells[0])
+        self.assertTrue(os.path.exists(statistics_pathname(pathname)))
+
+        # Statistics of a window not aligned with the cached blocks
+        window = ((50, 1200), (300, 1100))
+        statistics = raster_statistics(pathname, window=window, nr_bins=64)
+        assert_statistics_equal(statistics[0], cells[0, 50:1200, 300:1100])
+
+        # Rewriting part of a raster invalidates the whole cache
+        cells[0, 1400:, 1000:] = 2000
+
+        with rasterio.open(pathname, "r+") as raster:
+            raster.write(cells[:, 1400:, 1000:], window=((1400, 1500),
+                (1000, 1100)))
+
+        statistics = raster_statistics(pathname, nr_bins=64)
+        assert_statistics_equal(statistics[0], cells[0])
+
+        # Unless the blocks rewritten are invalidated. Only those are read
+        # again. Block (0, 0) is rewritten without invalidating it, so its
+        # cached statistics remain in use.
+        with rasterio.open(pathname, "r+") as raster:
+            raster.write(numpy.full((1, 10, 10), 5000, dtype=numpy.int16),
+                window=((200, 210), (200, 210)))
+            raster.write(numpy.full((1, 10, 10), -500, dtype=numpy.int16),
+                window=((1200, 1210), (1050, 1060)))
+        cells[0, 1200:1210, 1050:1060] = -500
+
+        invalidate_statistics(pathname, ((1200, 1210), (1050, 1060)))
+        statistics = raster_statistics(pathname, nr_bins=64)
+        assert_statistics_equal(statistics[0], cells[0])
+
+        # Merging summaries does not lose precision for cells with a large
+        # mean and a small spread
+        cells = 1e9 + numpy.random.RandomState(0).rand(2000)
+        statistics = BandSummary.merge(
+            [BandSummary.from_cells(part, 64) for part in
+                numpy.array_split(cells, 5)], 64).statistics()
+        self.assertAlmostEqual(statistics["mean"], cells.mean())
+        self.assertAlmostEqual(statistics["std"], cells.std(), places=6)
+
+
+    def test_pipeline(self):
+
+        # Source at 10 m, reprojected to 20 m, clipped to 3 x 2 cells,
+        # minus 1
+        rows, cols = numpy.mgrid[0:40, 0:40]
+        source_pathname = self.temporary_file("source.tif")
+        self.create_raster(source_pathname,
+            (rows + cols).astype(numpy.float32), 10.0, 0.0, 400.0)
+
+        template_pathname = self.temporary_file("template.tif")
+        self.create_raster(template_pathname,
+            numpy.zeros((20, 20), dtype=numpy.float32), 20.0, 0.0, 400.0)
+
+        clip_pathname = self.temporary_file("clip.tif")
+        self.create_raster(clip_pathname,
+            numpy.zeros((3, 2), dtype=numpy.float32), 20.0, 100.0, 200.0)
+
+        rhs_pathname = self.temporary_file("rhs.tif")
+        self.create_raster(rhs_pathname,
+            numpy.ones((3, 2), dtype=numpy.float32), 20.0, 100.0, 200.0)
+
+        # The first reformat step only changes the format and is skipped
+        spec = {
+            "source": source_pathname,
+            "steps": [
+                {"operation": "reformat"},
+                {"operation": "reformat", "crs": "EPSG:3857"},
+                {"operation": "reproject", "template": template_pathname,
+                    "resampling": "average"},
+                {"operation": "clip", "clip": clip_pathname},
+                {"operation": "subtract", "rhs": rhs_pathname},
+            ],
+        }
+        pipeline = Pipeline.from_spec(dict(spec,
+            target=self.temporary_file("pipeline.tif")))
+        self.assertEqual(len(pipeline.fused_steps()), 4)
+
+        # Averages of 2 x 2 source cells, of the rows and columns clipped,
+        # minus 1
+        rows, cols = numpy.mgrid[10:13, 5:7]
+        expected_cells = (2 * rows + 2 * cols).astype(numpy.float32)
+
+        # Intermediate rasters are stored in memory by default
+        for options in [{}, {"in_memory": False}]:
+            target_pathname = self.temporary_file(
+                "pipeline-{}.tif".format(len(options)))
+            Pipeline.from_spec(dict(spec, target=target_pathname)).run(
+                max_memory=100, **options)
+
+            with rasterio.open(target_pathname) as target_raster, \
+                    rasterio.open(clip_pathname) as clip_raster_:
+                self.assertEqual(target_raster.crs, clip_raster_.crs)
+                self.assertEqual(
+                    target_raster.transform, clip_raster_.transform)
+                self.assertEqual(target_raster.shape, (3, 2))
+                self.assertArraysEqual(target_raster.read(1), expected_cells)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,88 @@
+import json
+import tempfile
+import unittest
+from nc_data_tools import create_app
+from nc_data_tools.load_test import LoadTest
+import test_case
+
+
+class FailingLoadTest(LoadTest):
+    """
+    Load test whose first message refers to a plan which does not exist
+    """
+
+    def _message(self,
+            plan_service,
+            template_pathname,
+            queue_name,
+            index):
+
+        body = super()._message(
+            plan_service, template_pathname, queue_name, index)
+
+        if index == 0:
+            message = json.loads(body)
+            message["uri"] = "{}/plans/missing".format(plan_service.uri)
+            body = json.dumps(message)
+
+        return body
+
+
+class LoadTestTest(test_case.TestCase):
+
+    def test_run(self):
+
+        with tempfile.TemporaryDirectory() as directory_pathname:
+            load_test = LoadTest(
+                directory_pathname,
+                nr_workers=2,
+                rate=20,
+                duration=1,
+                nr_rows=64,
+                nr_cols=64,
+                message_mix={
+                    "register_raster": 1,
+                    "retrieve_colors_of_raster": 1,
+                    "classify_raster": 1,
+                })
+            report = load_test.run()
+
+        self.assertEqual(report["nr_messages"], 20)
+        self.assertEqual(report["nr_handled"], 20)
+        self.assertEqual(report["nr_failures"], 0)
+        self.assertEqual(report["nr_dead_lettered"], 0)
+        self.assertGreater(report["messages_per_second"], 0)
+        self.assertIn("p50", report["latency"])
+        self.assertLessEqual(
+            set(report["latency_by_queue"]),
+            {"register_raster", "retrieve_colors_of_raster",
+                "classify_raster"})
+
+
+    def test_failing_message(self):
+
+        nr_retries = create_app("test").config["NC_MAX_RETRIES"]
+
+        with tempfile.TemporaryDirectory() as directory_pathname:
+            load_test = FailingLoadTest(
+                directory_pathname,
+                rate=20,
+                duration=0.5,
+                nr_rows=64,
+                nr_cols=64,
+                message_mix={"retrieve_colors_of_raster": 1},
+                retry_delay=0.01)
+            report = load_test.run()
+
+        # The failing message is retried until it ends up in the
+        # dead-letter queue, and is not counted as handled
+        self.assertEqual(report["nr_messages"], 10)
+        self.assertEqual(report["nr_handled"], 9)
+        self.assertEqual(report["nr_failures"], nr_retries + 1)
+        self.assertEqual(report["failures_by_queue"],
+            {"retrieve_colors_of_raster": nr_retries + 1})
+        self.assertEqual(report["nr_dead_lettered"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
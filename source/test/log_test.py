@@ -0,0 +1,42 @@
+import json
+import logging
+import unittest
+from nc_data_tools.log import StructuredFormatter, summarise
+
+
+class LogTest(unittest.TestCase):
+
+    def test_summarise(self):
+        self.assertEqual(summarise(5), 5)
+        self.assertEqual(summarise("abc"), "abc")
+        self.assertEqual(summarise([1, 2, 3], max_size=3), [1, 2, 3])
+        self.assertEqual(
+            summarise([1, 2, 3, 4], max_size=3), [1, 2, 3, "... (4 items)"])
+
+        lut = {"({}, 0, 0)".format(i): i for i in range(100)}
+        summary = summarise({"uri": "http://plans/1", "lut": lut}, max_size=2)
+        self.assertEqual(summary["uri"], "http://plans/1")
+        self.assertEqual(summary["lut"], {
+            "(0, 0, 0)": 0, "(1, 0, 0)": 1, "...": "100 items"})
+
+        summary = summarise("x" * 100, max_size=2)
+        self.assertEqual(summary, "{}... (100 characters)".format("x" * 20))
+
+
+    def test_structured_formatter(self):
+        record = logging.makeLogRecord({
+            "name": "nc_data_tools",
+            "levelname": "INFO",
+            "msg": "Received message of %d bytes",
+            "args": (5,),
+            "fields": {"correlation_id": "abc"}
+        })
+        document = json.loads(StructuredFormatter().format(record))
+
+        self.assertEqual(document["level"], "INFO")
+        self.assertEqual(document["message"], "Received message of 5 bytes")
+        self.assertEqual(document["correlation_id"], "abc")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import glob
+import json
+import os.path
+import tempfile
+import unittest
+from nc_data_tools.local_broker import MethodFrame, Properties
+from nc_data_tools.profiling import MessageProfiler, summarise_profiles
+import test_case
+
+
+class ProfilingTest(test_case.TestCase):
+
+    def handler(self,
+            channel,
+            method_frame,
+            header_frame,
+            body):
+
+        return sum([value * value for value in range(10000)])
+
+
+    def test_profile_messages(self):
+
+        with tempfile.TemporaryDirectory() as directory_pathname:
+            profiler = MessageProfiler(
+                directory_pathname, queue_names=["classify_raster"])
+            handler = profiler.wrap(self.handler)
+            body = json.dumps({"uri": "http://plans/1"}).encode("utf-8")
+
+            # Messages from the heavy queue are profiled as well
+            for queue_name in ["classify_raster", "classify_raster_heavy",
+                    "register_raster"]:
+                handler(None, MethodFrame(queue_name, 1),
+                    Properties(correlation_id="abc"), body)
+
+            self.assertEqual(len(glob.glob(
+                os.path.join(directory_pathname, "*.prof"))), 2)
+
+            document_pathname = sorted(glob.glob(
+                os.path.join(directory_pathname, "*.json")))[0]
+
+            with open(document_pathname) as file:
+                document = json.load(file)
+
+            self.assertEqual(document["fields"]["uri"], "http://plans/1")
+            self.assertEqual(document["fields"]["correlation_id"], "abc")
+            self.assertGreater(document["peak_memory"], 0)
+
+            summary = summarise_profiles(directory_pathname, nr_functions=5)
+
+            self.assertEqual(summary["nr_messages"], 2)
+            self.assertEqual(len(summary["functions"]), 5)
+            self.assertTrue(any([function["function"].endswith("(handler)")
+                for function in summary["functions"]]))
+
+            summary = summarise_profiles(directory_pathname,
+                queue_name="classify_raster_heavy")
+
+            self.assertEqual(summary["nr_messages"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
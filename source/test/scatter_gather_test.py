@@ -0,0 +1,166 @@
+import os
+import tempfile
+import unittest
+import numpy
+import rasterio
+from nc_data_tools import create_app
+from nc_data_tools.data_tools import *
+from nc_data_tools.data_tools import _classify_raster
+from nc_data_tools.local_broker import LocalBroker
+from nc_data_tools.scatter_gather import scatter, tile_queue_name
+import test_case
+
+
+class ScatterGatherTest(test_case.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+
+        self.app = create_app("test")
+        self.app.config["TESTING"] = True
+
+        # Capture colors sent to clients, instead of posting them
+        self.notifications = []
+        self.app.notify_colors = lambda client_id, colors: \
+            self.notifications.append((client_id, colors))
+
+        self.broker = LocalBroker()
+        self.channel = self.broker.channel()
+        self.app.channel = self.channel
+        self.app.declare_queue(tile_queue_name)
+
+        # Two workers consuming the tile queue
+        for _ in range(2):
+            self.broker.channel().basic_consume(
+                self.app.on_process_raster_tile, queue=tile_queue_name)
+
+
+    def temporary_file(self,
+            filename):
+        return os.path.join(self.temporary_directory.name, filename)
+
+
+    def create_plan(self,
+            pathname,
+            nr_rows,
+            nr_cols):
+
+        palette = numpy.array([
+            [255, 0, 0], [0, 255, 0], [0, 0, 255], [10, 20, 30]],
+            dtype=numpy.uint8)
+        random = numpy.random.RandomState(5)
+        colors = palette[random.randint(len(palette), size=(nr_rows, nr_cols))]
+        alpha = numpy.full((nr_rows, nr_cols), 255, dtype=numpy.uint8)
+        alpha[0, :] = 0
+
+        profile = {
+            "driver": "GTiff",
+            "width": nr_cols,
+            "height": nr_rows,
+            "dtype": numpy.uint8,
+            "count": 4,
+            "crs": "EPSG:3857",
+            "transform": rasterio.transform.from_origin(
+                0.0, float(nr_rows), 1.0, 1.0),
+            "photometric": "RGB",
+            "alpha": "YES"
+        }
+
+        with rasterio.open(pathname, "w", **profile) as raster:
+            for b in range(3):
+                raster.write(colors[:, :, b], b + 1)
+            raster.write(alpha, 4)
+
+
+    def test_classify_raster(self):
+
+        pathname = self.temporary_file("plan.tif")
+        self.create_plan(pathname, 50, 70)
+        lut = {
+            "(255, 0, 0)": 1,
+            "(0, 255, 0)": 2,
+            "(0, 0, 255)": 3,
+        }
+
+        job_directory_pathname = scatter(self.channel, "classify_raster",
+            pathname, arguments={"lut": lut, "color_table": True},
+            continuation=None, tile_size=16)
+
+        self.assertEqual(
+            self.broker.queue_depths()[tile_queue_name], 4 * 5)
+
+        self.broker.deliver_all()
+
+        self.assertEqual(self.broker.queue_depths()[tile_queue_name], 0)
+        self.assertEqual(len(self.broker.unacked), 0)
+        self.assertFalse(os.path.exists(job_directory_pathname))
+
+
+        # Result must equal the one of classifying in one go
+        expected_pathname = self.temporary_file("expected.tif")
+        _classify_raster(pathname, parse_lut(lut), expected_pathname,
+            color_table=True)
+
+        with rasterio.open(classified_raster_pathname(pathname)) as \
+                    result_raster, \
+                rasterio.open(expected_pathname) as expected_raster:
+            self.assertEqual(result_raster.profile["dtype"], "uint8")
+            self.assertEqual(result_raster.transform,
+                expected_raster.transform)
+            self.assertArraysEqual(result_raster.read(1),
+                expected_raster.read(1))
+            self.assertEqual(result_raster.colormap(1)[3],
+                expected_raster.colormap(1)[3])
+
+
+    def test_retrieve_colors(self):
+
+        pathname = self.temporary_file("plan.tif")
+        self.create_plan(pathname, 40, 30)
+
+        scatter(self.channel, "retrieve_colors", pathname, arguments={},
+            continuation={"client_id": "client"}, tile_size=16)
+        self.broker.deliver_all()
+
+        self.assertEqual(len(self.notifications), 1)
+        client_id, colors = self.notifications[0]
+        self.assertEqual(client_id, "client")
+        self.assertEqual(
+            sorted(colors), sorted(retrieve_colors(pathname)))
+
+
+
+    def test_retry_gather(self):
+
+        pathname = self.temporary_file("plan.tif")
+        self.create_plan(pathname, 40, 30)
+        self.app.config["NC_RETRY_DELAY"] = 0
+        self.app.declare_queue(tile_queue_name)
+
+        # Notifying the client fails once. The job must be gathered again
+        # when the tile message is retried.
+        notify_colors = self.app.notify_colors
+
+        def notify_colors_once_failing(
+                client_id,
+                colors):
+
+            self.app.notify_colors = notify_colors
+            raise RuntimeError("Client unreachable")
+
+        self.app.notify_colors = notify_colors_once_failing
+
+        job_directory_pathname = scatter(self.channel, "retrieve_colors",
+            pathname, arguments={}, continuation={"client_id": "client"},
+            tile_size=16)
+        self.broker.deliver_all(timeout=10)
+
+        self.assertEqual(len(self.notifications), 1)
+        client_id, colors = self.notifications[0]
+        self.assertEqual(
+            sorted(colors), sorted(retrieve_colors(pathname)))
+        self.assertFalse(os.path.exists(job_directory_pathname))
+        self.assertEqual(len(self.broker.unacked), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import multiprocessing
+import time
+import unittest
+from nc_data_tools.local_broker import LocalBroker
+from nc_data_tools.supervisor import ScalingPolicy, Supervisor
+import test_case
+
+
+def wait_for_interrupt(
+        started):
+
+    started.put(True)
+
+    while True:
+        time.sleep(1)
+
+
+class SupervisorTest(test_case.TestCase):
+
+    def test_scaling_policy(self):
+
+        policy = ScalingPolicy(min_workers=1, max_workers=4,
+            backlog_per_worker=10, max_load=0.9)
+
+        # Scale up to the number of workers required for the backlog, up
+        # to the maximum
+        self.assertEqual(policy.nr_workers(1, 25, 0.5), 3)
+        self.assertEqual(policy.nr_workers(1, 100, 0.5), 4)
+        self.assertEqual(policy.nr_workers(3, 25, 0.5), 3)
+
+        # Don't scale up when the CPUs are busy
+        self.assertEqual(policy.nr_workers(1, 25, 1.5), 1)
+
+        # Scale down one worker at a time, down to the minimum
+        self.assertEqual(policy.nr_workers(4, 0, 0.5), 3)
+        self.assertEqual(policy.nr_workers(1, 0, 0.5), 1)
+        self.assertEqual(policy.nr_workers(0, 0, 0.5), 1)
+
+
+    def test_supervisor(self):
+
+        broker = LocalBroker()
+        channel = broker.channel()
+        queue_names = ["classify_raster", "process_raster_tile"]
+
+        def handler(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+
+
+        for queue_name in queue_names:
+            channel.queue_declare(queue=queue_name)
+            channel.basic_consume(handler, queue=queue_name)
+
+        for i in range(15):
+            broker.publish("classify_raster", "job")
+
+        broker.publish("process_raster_tile", "job")
+
+        policy = ScalingPolicy(min_workers=0, max_workers=2,
+            backlog_per_worker=10, max_load=float("inf"))
+        started = multiprocessing.get_context("spawn").Queue()
+        supervisor = Supervisor(channel, queue_names, policy,
+            worker_target=wait_for_interrupt, worker_args=(started,))
+
+        self.assertEqual(supervisor.backlog(), 16)
+
+        try:
+            supervisor.check()
+            self.assertEqual(len(supervisor.workers), 2)
+
+            # Wait for the workers to have started
+            for worker in supervisor.workers:
+                self.assertTrue(started.get(timeout=30))
+                self.assertTrue(worker.is_alive())
+
+            # Once the backlog is cleared, workers are stopped one at a
+            # time
+            broker.deliver_all()
+            self.assertEqual(supervisor.backlog(), 0)
+
+            supervisor.check()
+            self.assertEqual(len(supervisor.workers), 1)
+            self.assertEqual(len(supervisor.draining_workers), 1)
+
+            supervisor.draining_workers[0].join(30)
+            supervisor.reap()
+            self.assertEqual(len(supervisor.draining_workers), 0)
+        finally:
+            supervisor.shutdown()
+
+        self.assertEqual(len(supervisor.workers), 0)
+        self.assertEqual(len(supervisor.draining_workers), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
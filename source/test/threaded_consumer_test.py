@@ -0,0 +1,144 @@
+import threading
+import unittest
+from nc_data_tools.local_broker import LocalBroker
+from nc_data_tools.threaded_consumer import ThreadedConsumer
+import test_case
+
+
+class Connection(object):
+    """
+    Stand-in for a pika.BlockingConnection, collecting thread-safe
+    callbacks until data events are processed
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+
+    def add_callback_threadsafe(self,
+            callback):
+
+        with self.lock:
+            self.callbacks.append(callback)
+
+
+    def process_data_events(self,
+            time_limit=0):
+
+        with self.lock:
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            callback()
+
+
+class ThreadedConsumerTest(test_case.TestCase):
+
+    def test_threaded_consumer(self):
+
+        broker = LocalBroker()
+        channel = broker.channel()
+        channel.queue_declare(queue="jobs")
+        channel.queue_declare(queue="results")
+
+        connection = Connection()
+        consumer = ThreadedConsumer(connection)
+        handler_threads = []
+        proceed = threading.Event()
+
+
+        def handler(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            handler_threads.append(threading.current_thread())
+            proceed.wait()
+            channel.basic_publish(exchange="", routing_key="results",
+                body=body)
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+
+
+        channel.basic_consume(consumer.wrap(handler), queue="jobs")
+        broker.publish("jobs", "job")
+
+        # Delivering the message returns immediately, while the job is
+        # still running
+        self.assertTrue(broker.deliver_one())
+        self.assertEqual(len(broker.unacked), 1)
+
+        proceed.set()
+        consumer.shutdown()
+
+        self.assertEqual(len(handler_threads), 1)
+        self.assertIsNot(handler_threads[0], threading.current_thread())
+
+        # The channel calls of the job were performed by this thread,
+        # in order
+        self.assertEqual(len(broker.unacked), 0)
+        self.assertEqual(broker.queue_depths()["results"], 1)
+
+
+    def test_failing_handler(self):
+
+        def fail_before_ack(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            raise RuntimeError("Failure outside of the handler's try")
+
+
+        def fail_after_ack(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            raise RuntimeError("Failure outside of the handler's try")
+
+
+        def retry_later(
+                channel,
+                method_frame,
+                header_frame,
+                body):
+
+            channel.basic_publish(exchange="", routing_key="jobs.retry",
+                body=body)
+
+
+        # Messages whose handler fails are retried later, unless they
+        # have been acknowledged already. Without a way to retry them,
+        # they are rejected. They are never requeued.
+        for handler, retry, nr_retried in [
+                (fail_before_ack, retry_later, 1),
+                (fail_after_ack, retry_later, 0),
+                (fail_before_ack, None, 0),
+                ]:
+
+            broker = LocalBroker()
+            channel = broker.channel()
+            channel.queue_declare(queue="jobs")
+            channel.queue_declare(queue="jobs.retry")
+
+            connection = Connection()
+            consumer = ThreadedConsumer(connection, retry_later=retry)
+
+            channel.basic_consume(consumer.wrap(handler), queue="jobs")
+            broker.publish("jobs", "job")
+
+            self.assertTrue(broker.deliver_one())
+            consumer.shutdown()
+
+            self.assertEqual(len(broker.unacked), 0)
+            self.assertEqual(broker.queue_depths()["jobs"], 0)
+            self.assertEqual(broker.queue_depths()["jobs.retry"], nr_retried)
+
+
+if __name__ == "__main__":
+    unittest.main()